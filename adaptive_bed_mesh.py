@@ -1,17 +1,92 @@
+import argparse
 import configparser
 import numpy
 import math
-from contextlib import contextmanager
+from contextlib import contextmanager, closing, nullcontext
 import traceback
 import os
+import sys
+import threading
+import json
+import time
+import collections
+import ctypes
+import ctypes.util
+import logging
+import re
+import mmap
+import gzip
+import zlib
+import struct
+import multiprocessing
+import concurrent.futures
+import itertools
+import hashlib
+import base64
+import cProfile
+import pstats
+import tracemalloc
+from array import array
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where the offline analyzer may run
+    fcntl = None
+
+
+# Work counters of the gcode analysis, see AdaptiveBedMesh.get_layer_extents()
+gcode_analysis_counters = ['bytes', 'lines', 'moves', 'arcs']
+
+# Motion and positioning mode commands decoded by the python gcode analysis backend, up to the comment
+gcode_command_pattern = re.compile(rb'^[ \t]*((?:G[0-3]|G9[01])(?![^ \t\r;\n])[^;\n]*)', re.MULTILINE | re.IGNORECASE)
+
+# Motion commands decoded by the numpy gcode analysis backend. The parameters may appear in any order, the last one wins
+_motion_param_value = rb'([^ \t;\r\n]*)'
+gcode_motion_params = ['X', 'Y', 'Z', 'E', 'I', 'J', 'R']
+gcode_motion_pattern = re.compile(
+    rb'^[ \t]*(G[0-3]|G9[01])(?:[ \t]+(?:' +
+    b'|'.join(p.encode() + _motion_param_value for p in gcode_motion_params) +
+    rb'|[^ \t;\r\n]+))*[ \t\r]*(?:;|$)',
+    re.MULTILINE | re.IGNORECASE)
+gcode_motion_header_codes = {b'G0': 0, b'G1': 1, b'G2': 2, b'G3': 3, b'G90': 90, b'G91': 91}
+
+# Slicer metadata
+gcode_metadata_first_layer_print_pattern = re.compile(
+    r'^;\s*first_layer_print_(min|max)\s*[=:]\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*$')
+gcode_metadata_polygon_pattern = re.compile(r'POLYGON=(\[\[.*?\]\])')
+gcode_metadata_cura_min_max_pattern = re.compile(r'^;\s*(MINX|MINY|MAXX|MAXY)\s*:\s*(-?[\d.]+)\s*$', re.IGNORECASE)
+
+# Binary gcode (.bgcode) block types and compression types, see the libbgcode specification
+bgcode_block_types = {'file_metadata': 0, 'gcode': 1, 'slicer_metadata': 2, 'printer_metadata': 3, 'print_metadata': 4,
+                      'thumbnail': 5}
+bgcode_metadata_block_types = [bgcode_block_types[name] for name in ['file_metadata', 'slicer_metadata',
+                                                                      'printer_metadata', 'print_metadata']]
+bgcode_heatshrink_params = {2: (11, 4), 3: (12, 4)}
+bgcode_meatpack_encodings = [1, 2]
+
+# File name extensions of the gcode files the analysis supports
+gcode_file_extensions = ('.gcode', '.gcode.gz', '.bgcode')
 
 
 class AdaptiveBedMesh(object):
+    # Sections that configure a Z probe, the first one found is used
+    probe_section_names = ['probe', 'bltouch', 'smart_effector']
+    # The bed_mesh profile a mesh derived from a reference mesh is loaded as
+    reused_profile_name = 'adaptive_bed_mesh'
+    # The bed_mesh profiles of the memoized meshes are named with this prefix and a sequence number
+    memo_profile_prefix = 'adaptive_bed_mesh_memo_'
+    # Number of extrude moves the python backend decodes between two checks of the analysis time budget
+    budget_check_interval = 10000
+
     def __init__(self, config):
         self._move_gcmd_interpreter = {'G0': self._move_gcmd_decoder,
                                        'G1': self._move_gcmd_decoder,
-                                       'G2': self._arc_move_gcmd_decoder,
-                                       'G3': self._arc_move_gcmd_decoder}
+                                       'G2': self._arc_extents_gcmd_decoder,
+                                       'G3': self._arc_extents_gcmd_decoder}
+        # Debug only: Decode arcs into arc_segments linear moves
+        self._sampled_move_gcmd_interpreter = dict(self._move_gcmd_interpreter,
+                                                   G2=self._arc_move_gcmd_decoder,
+                                                   G3=self._arc_move_gcmd_decoder)
 
         # Read user configurations
         self.arc_segments = config.getint('arc_segments', 80)
@@ -23,15 +98,48 @@ class AdaptiveBedMesh(object):
         # Enable/Disable boundary detection
         self.disable_slicer_min_max_boundary_detection = config.getboolean('disable_slicer_min_max_boundary_detection', False)
         self.disable_exclude_object_boundary_detection = config.getboolean('disable_exclude_object_boundary_detection', False)
+        self.disable_gcode_metadata_boundary_detection = config.getboolean('disable_gcode_metadata_boundary_detection', False)
         self.disable_gcode_analysis_boundary_detection = config.getboolean('disable_gcode_analysis_boundary_detection', False)
 
+        # Gcode metadata options
+        # Number of bytes to read from both the head and the tail of the gcode file
+        self.gcode_metadata_scan_size = config.getint('gcode_metadata_scan_size', 256 * 1024, minval=1024)
+
+        # Gcode analysis options
+        self.gcode_analysis_stop_at_fade_end = config.getboolean('gcode_analysis_stop_at_fade_end', True)
+        self.gcode_analysis_first_layer_only = config.getboolean('gcode_analysis_first_layer_only', False)
+        # The numpy backend decodes the gcode file in chunks with array operations
+        self.gcode_analysis_backend = config.getchoice('gcode_analysis_backend', {'python': 'python', 'numpy': 'numpy'},
+                                                       'python')
+        self.gcode_analysis_chunk_size = config.getint('gcode_analysis_chunk_size', 1024 * 1024, minval=4096)
+        # Number of processes the numpy backend splits the gcode file across
+        self.gcode_analysis_workers = config.getint('gcode_analysis_workers', 1, minval=1)
+        # The gcode analysis runs in a worker thread, fallback to the default bed mesh if it takes too long
+        self.gcode_analysis_timeout = config.getfloat('gcode_analysis_timeout', 30., above=0.)
+        # Stop the gcode analysis after this long and use the layers analysed so far, 0 to analyse up to the fade height
+        self.gcode_analysis_time_budget = config.getfloat('gcode_analysis_time_budget', 0., minval=0.)
+
+        # Resolution of the printed footprint raster used to find the probe points away from the print, 0 to disable
+        self.occupancy_resolution = config.getfloat('occupancy_resolution', 0., minval=0.)
+
+        # Number of recent calibrations shown by ADAPTIVE_BED_MESH_STATS
+        self.stats_history_size = config.getint('stats_history_size', 10, minval=1)
+        self.calibration_stats = collections.deque(maxlen=self.stats_history_size)
+
         # Debug options
         # By enabling the `debug_mode` the Python exception won't cause Klipper to shutdown
         self.debug_mode = config.getboolean('debug_mode', False)
+        # Profile every calibration, or only the ones called with PROFILE=1
+        self.profile = config.getboolean('profile', False)
+        # Defaults to the Klipper log directory
+        self.profile_path = config.get('profile_path', None)
 
         # Some constants
         self.minimum_axis_probe_counts = 3
 
+        # {object name: (polygon, [x_min, y_min, x_max, y_max])} of the current print
+        self.object_bounds_cache = dict()
+
         # Read klipper objects
         self.printer = config.get_printer()
         self.gcode = self.printer.lookup_object('gcode')
@@ -56,6 +164,9 @@ class AdaptiveBedMesh(object):
         self.gcode.register_command('ADAPTIVE_BED_MESH_CALIBRATE',
                                     self.cmd_ADAPTIVE_BED_MESH_CALIBRATE,
                                     desc='Run the adaptive bed mesh based on either the user input or the loaded gcode')
+        self.gcode.register_command('ADAPTIVE_BED_MESH_STATS',
+                                    self.cmd_ADAPTIVE_BED_MESH_STATS,
+                                    desc='Show the timing and counters of the recent adaptive bed mesh calibrations')
 
         # Read [bed_mesh] section information
         self.bed_mesh_config = config.getsection('bed_mesh')
@@ -63,12 +174,100 @@ class AdaptiveBedMesh(object):
         self.bed_mesh_config_mesh_max = self.bed_mesh_config.getfloatlist('mesh_max', count=2)
         self.bed_mesh_config_fade_end = self.bed_mesh_config.getfloat('fade_end', 0)
         self.bed_mesh_config_algorithm = self.bed_mesh_config.get('algorithm', 'lagrange').strip().lower()
+        self.bed_mesh_config_speed = self.bed_mesh_config.getfloat('speed', 50., above=0.)
+        self.bed_mesh_config_horizontal_move_z = self.bed_mesh_config.getfloat('horizontal_move_z', 5.)
+
+        # Read the probe section information for the probe time estimation, with the Klipper defaults
+        probe_config = next((config.getsection(name) for name in self.probe_section_names if config.has_section(name)),
+                            None)
+        if probe_config is not None:
+            self.probe_speed = probe_config.getfloat('speed', 5., above=0.)
+            self.probe_lift_speed = probe_config.getfloat('lift_speed', self.probe_speed, above=0.)
+            self.probe_samples = probe_config.getint('samples', 1, minval=1)
+            self.probe_sample_retract_dist = probe_config.getfloat('sample_retract_dist', 2., above=0.)
+        else:
+            self.probe_speed = self.probe_lift_speed = 5.
+            self.probe_samples = 1
+            self.probe_sample_retract_dist = 2.
 
         # Read [virtual_sdcard] section information
         self.virtual_sdcard_config = config.getsection('virtual_sdcard')
         sd = self.virtual_sdcard_config.get('path')
         self.virtual_sdcard_path = os.path.normpath(os.path.expanduser(sd))
 
+        # Persistent gcode analysis cache, stored next to the virtual sdcard directory by default
+        gcode_analysis_cache_size = config.getint('gcode_analysis_cache_size', 32, minval=0)
+        # The layer indexes are larger than the results, and are limited separately
+        gcode_analysis_index_cache_size = config.getint('gcode_analysis_index_cache_size', gcode_analysis_cache_size,
+                                                        minval=0)
+        gcode_analysis_cache_path = config.get('gcode_analysis_cache_path', None)
+        if gcode_analysis_cache_path is None:
+            gcode_analysis_cache_path = os.path.join(os.path.dirname(self.virtual_sdcard_path),
+                                                     'adaptive_bed_mesh_cache.json')
+        else:
+            gcode_analysis_cache_path = os.path.normpath(os.path.expanduser(gcode_analysis_cache_path))
+
+        if gcode_analysis_cache_size > 0:
+            self.gcode_analysis_cache = GcodeAnalysisCache(gcode_analysis_cache_path, gcode_analysis_cache_size,
+                                                           gcode_analysis_index_cache_size)
+        else:
+            self.gcode_analysis_cache = None
+
+        # Reuse a recent full bed mesh probed by ADAPTIVE_BED_MESH_REFERENCE_CALIBRATE instead of probing
+        self.reuse_reference_mesh = config.getboolean('reuse_reference_mesh', False)
+        self.reuse_reference_max_age = config.getfloat('reuse_reference_max_age', 3600., above=0.)
+        self.reuse_reference_temperature_tolerance = config.getfloat('reuse_reference_temperature_tolerance', 5.,
+                                                                     minval=0.)
+        # Probe the zero reference and the corners to check the drift, 0 to skip the verification
+        self.reuse_reference_max_drift = config.getfloat('reuse_reference_max_drift', 0.05, minval=0.)
+        self.reference_meshes = ReferenceMeshStore(os.path.join(os.path.dirname(gcode_analysis_cache_path),
+                                                                'adaptive_bed_mesh_references.json'))
+        self.gcode.register_command('ADAPTIVE_BED_MESH_REFERENCE_CALIBRATE',
+                                    self.cmd_ADAPTIVE_BED_MESH_REFERENCE_CALIBRATE,
+                                    desc='Probe the full bed mesh that later adaptive bed meshes may be derived from')
+
+        # Probe fewer points where the recent meshes predict the interpolation error stays within the tolerance, 0 to
+        #   always probe at the max_probe_horizontal/vertical_distance
+        self.probe_density_tolerance = config.getfloat('probe_density_tolerance', 0., minval=0.)
+        self.probe_density_max_age = config.getfloat('probe_density_max_age', 7 * 24 * 3600., above=0.)
+        self.probe_density_temperature_tolerance = config.getfloat('probe_density_temperature_tolerance', 5.,
+                                                                   minval=0.)
+        self.mesh_history = MeshHistoryStore(os.path.join(os.path.dirname(gcode_analysis_cache_path),
+                                                          'adaptive_bed_mesh_history.json'),
+                                             config.getint('probe_density_history_size', 10, minval=1))
+
+        # Load the mesh of a recent calibration with the same BED_MESH_CALIBRATE parameters instead of probing, 0 to
+        #   always probe
+        self.mesh_memo_size = config.getint('mesh_memo_size', 0, minval=0)
+        self.mesh_memo_max_age = config.getfloat('mesh_memo_max_age', 3600., above=0.)
+        self.mesh_memo_temperature_tolerance = config.getfloat('mesh_memo_temperature_tolerance', 5., minval=0.)
+        # {(params, zero reference position): {'profile_name', 'time', 'bed_temperature', 'z_offsets'}}, oldest first
+        self.mesh_memo = collections.OrderedDict()
+        self.mesh_memo_sequence = 0
+        if self.mesh_memo_size > 0:
+            # PRINT_END macros and the idle_timeout turn the motors off between prints, so only opt-in for a gantry that
+            #   may sag while the motors are off
+            if config.getboolean('mesh_memo_clear_on_motor_off', False):
+                self.printer.register_event_handler('stepper_enable:motor_off',
+                                                    lambda print_time: self.clear_mesh_memo())
+
+        # Analyse new gcode files in the background while the printer is idle
+        if config.getboolean('gcode_pre_analysis', False):
+            if self.gcode_analysis_cache is None:
+                raise configparser.Error("[adaptive_bed_mesh] gcode_pre_analysis requires gcode_analysis_cache_size > 0")
+            self.gcode_pre_analyser = GcodePreAnalyser(
+                self, config.getfloat('gcode_pre_analysis_interval', 60., above=0.))
+            self.printer.register_event_handler('klippy:ready', self.gcode_pre_analyser.handle_ready)
+        else:
+            self.gcode_pre_analyser = None
+
+    def get_status(self, eventtime=None):
+        status = dict()
+        if self.gcode_pre_analyser is not None:
+            status['pre_analysis'] = self.gcode_pre_analyser.get_status()
+        status['last_calibration'] = self.calibration_stats[-1] if self.calibration_stats else None
+        return status
+
     def log_to_gcmd_respond(self, gcmd, text):
         gcmd.respond_info("AdaptiveBedMesh:" + text)
 
@@ -81,11 +280,127 @@ class AdaptiveBedMesh(object):
             if not self.debug_mode:
                 raise
 
+    @contextmanager
+    def measure_time(self, times, name):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            times[name] = time.monotonic() - start_time
+
+    def get_profile_dir(self):
+        if self.profile_path is not None:
+            return os.path.normpath(os.path.expanduser(self.profile_path))
+
+        log_file = self.printer.get_start_args().get('log_file')
+        if log_file:
+            return os.path.dirname(os.path.abspath(log_file))
+
+        # Klipper logs to stdout, fallback to the directory that contains the virtual_sdcard path
+        return os.path.dirname(self.virtual_sdcard_path)
+
     def cmd_ADAPTIVE_BED_MESH_CALIBRATE(self, gcmd):
+        stats = {'time': time.time(), 'method': 'default', 'method_times': dict(), 'gcode_analysis': dict()}
+        start_time = time.monotonic()
+
+        profiler = None
+        if gcmd.get_int('PROFILE', int(self.profile), minval=0, maxval=1):
+            profiler = CalibrationProfiler()
+            profiler.start()
+
         with self.catch_exception_to_console(gcmd):
-            while True:
-                # Method 1: Slicer min max boundary detection
-                if not self.disable_slicer_min_max_boundary_detection:
+            try:
+                mesh_min, mesh_max = self.detect_mesh_boundary(gcmd, stats, profiler)
+            finally:
+                if profiler is not None:
+                    profiler.stop()
+
+            stats['detection_time'] = time.monotonic() - start_time
+
+            if profiler is not None:
+                filename_prefix = os.path.join(self.get_profile_dir(), time.strftime(
+                    'adaptive_bed_mesh-%Y%m%d-%H%M%S', time.localtime(stats['time'])))
+                stats['profile'] = profiler.save(filename_prefix)
+                self.log_to_gcmd_respond(gcmd, "Profile saved to {}\n{}".format(
+                    stats['profile'], '\n'.join(profiler.format_summary())))
+
+            if self.debug_mode:
+                self.log_to_gcmd_respond(gcmd, "mesh_min: {}, mesh_max: {}".format(mesh_min, mesh_max))
+                self.log_to_gcmd_respond(gcmd, "mesh_area_clearance: {}".format(self.mesh_area_clearance))
+
+            # Find the probe points away from the printed footprint
+            if self.occupancy_resolution > 0:
+                try:
+                    self.find_idle_probe_points(gcmd, mesh_min, mesh_max, stats)
+                except Exception as e:
+                    self.log_to_gcmd_respond(gcmd, "Failed to find the idle probe points: {}".format(e))
+
+            # Derive the mesh from a recent full bed mesh if one covers the area
+            if self.reuse_reference_mesh:
+                try:
+                    if self.load_reference_mesh(gcmd, mesh_min, mesh_max, stats):
+                        stats['total_time'] = time.monotonic() - start_time
+                        self.calibration_stats.append(stats)
+                        return
+                except Exception as e:
+                    self.log_to_gcmd_respond(gcmd, "Failed to reuse the reference mesh: {}".format(e))
+
+            # Apply the bed mesh margin and limit, then generate the bed_mesh_calibrate parameter
+            params = self.generate_bed_mesh_params(mesh_min, mesh_max, stats)
+
+            # Load the mesh of a recent calibration with the same parameters
+            if self.mesh_memo_size > 0:
+                memo_key = (params, tuple(stats['zero_reference_position']))
+                try:
+                    if self.load_memoized_mesh(gcmd, memo_key, stats):
+                        stats['total_time'] = time.monotonic() - start_time
+                        self.calibration_stats.append(stats)
+                        return
+                except Exception as e:
+                    self.log_to_gcmd_respond(gcmd, "Failed to load the memoized mesh: {}".format(e))
+
+            cmd = "BED_MESH_CALIBRATE {}".format(params)
+            self.log_to_gcmd_respond(gcmd, cmd)
+            self.log_to_gcmd_respond(gcmd, "Estimated probing time: {:.1f}s".format(stats['estimated_probe_time']))
+
+            with self.measure_time(stats, 'bed_mesh_calibrate_time'):
+                self.gcode.run_script_from_command(cmd)
+
+            logging.info("adaptive_bed_mesh: BED_MESH_CALIBRATE took %.1fs, estimated %.1fs",
+                         stats['bed_mesh_calibrate_time'], stats['estimated_probe_time'])
+
+            # A mesh probed at the reduced density would hide the shape of the bed between its points
+            if self.probe_density_tolerance > 0 and 'full_probe_count' not in stats:
+                try:
+                    self.record_mesh_history('default')
+                except Exception as e:
+                    self.log_to_gcmd_respond(gcmd, "Failed to record the mesh history: {}".format(e))
+
+            if self.mesh_memo_size > 0:
+                try:
+                    self.memoize_mesh(memo_key)
+                except Exception as e:
+                    self.log_to_gcmd_respond(gcmd, "Failed to memoize the mesh: {}".format(e))
+
+            stats['total_time'] = time.monotonic() - start_time
+            self.calibration_stats.append(stats)
+
+    def detect_mesh_boundary(self, gcmd, stats, profiler=None):
+        """
+        Try each boundary detection method in turn, the first one that succeeds wins.
+        :return: mesh_min, mesh_max
+        """
+        gcode_analysis = self.generate_mesh_with_gcode_analysis
+        if profiler is not None:
+            # The gcode analysis runs in a worker thread, which needs a profiler of its own
+            gcode_analysis = profiler.wrap(gcode_analysis)
+        # Waiting for the worker thread would otherwise hide the hot functions
+        waiting_for_worker = profiler.paused if profiler is not None else nullcontext
+
+        while True:
+            # Method 1: Slicer min max boundary detection
+            if not self.disable_slicer_min_max_boundary_detection:
+                with self.measure_time(stats['method_times'], 'slicer_min_max'):
                     self.log_to_gcmd_respond(gcmd, "Attempting to detect boundary by slicer min max")
                     area_start = gcmd.get("AREA_START", default=None)
                     area_end = gcmd.get("AREA_END", default=None)
@@ -93,57 +408,565 @@ class AdaptiveBedMesh(object):
                         mesh_min = [float(s) for s in area_start.split(',')]
                         mesh_max = [float(s) for s in area_end.split(',')]
                         self.log_to_gcmd_respond(gcmd, "Use min max boundary detection")
+                        stats['method'] = 'slicer_min_max'
                         break
                     else:
                         self.log_to_gcmd_respond(gcmd, "Failed to run slicer min max: No information available")
 
-                # Method 2: Exclude object boundary detection
-                if not self.disable_exclude_object_boundary_detection:
+            # Method 2: Exclude object boundary detection
+            if not self.disable_exclude_object_boundary_detection:
+                with self.measure_time(stats['method_times'], 'exclude_object'):
                     self.log_to_gcmd_respond(gcmd, "Attempting to detect boundary by exclude boundary")
                     try:
                         if self.debug_mode:
                             self.log_to_gcmd_respond(gcmd, str(self.exclude_object.objects))
 
                         if self.exclude_object.objects:
-                            mesh_min, mesh_max = self.generate_mesh_with_exclude_object(self.exclude_object.objects)
+                            mesh_min, mesh_max = self.generate_mesh_with_exclude_object(
+                                self.exclude_object.objects, self.exclude_object.excluded_objects)
                             self.log_to_gcmd_respond(gcmd, "Use exclude object boundary detection")
+                            stats['method'] = 'exclude_object'
                             break
                         else:
                             self.log_to_gcmd_respond(gcmd, "Failed to run exclude object analysis: No exclude object information available")
                     except Exception as e:
                         self.log_to_gcmd_respond(gcmd, "Failed to run exclude object analysis: {}".format(e))
 
-                # Method 3: Gcode analysis boundary detection
-                if not self.disable_gcode_analysis_boundary_detection:
+            # Method 3: Gcode metadata boundary detection
+            if not self.disable_gcode_metadata_boundary_detection:
+                with self.measure_time(stats['method_times'], 'gcode_metadata'):
+                    self.log_to_gcmd_respond(gcmd, "Attempting to detect boundary by Gcode metadata")
+                    try:
+                        gcode_filepath = self.get_gcode_filepath(gcmd.get("GCODE_FILEPATH", None))
+                        # Decompressing a gzip or binary gcode file takes a while, the worker stops at the timeout
+                        with waiting_for_worker():
+                            mesh_min, mesh_max = self.run_in_worker_thread(self.generate_mesh_with_gcode_metadata,
+                                                                           self.gcode_analysis_timeout,
+                                                                           gcode_filepath, self.gcode_analysis_timeout)
+                        self.log_to_gcmd_respond(gcmd, "Use Gcode metadata boundary detection")
+                        stats['method'] = 'gcode_metadata'
+                        break
+                    except Exception as e:
+                        self.log_to_gcmd_respond(gcmd, "Failed to run Gcode metadata analysis: {}".format(e))
+
+            # Method 4: Gcode analysis boundary detection
+            if not self.disable_gcode_analysis_boundary_detection:
+                with self.measure_time(stats['method_times'], 'gcode_analysis'):
                     self.log_to_gcmd_respond(gcmd, "Attempting to detect boundary by Gcode analysis")
+                    analysis_start_time = time.monotonic()
                     try:
-                        gcode_filepath = gcmd.get("GCODE_FILEPATH", None)
-                        mesh_min, mesh_max = self.generate_mesh_with_gcode_analysis(gcode_filepath)
-                        self.log_to_gcmd_respond(gcmd, "Use Gcode analysis boundary detection")
+                        gcode_filepath = self.get_gcode_filepath(gcmd.get("GCODE_FILEPATH", None))
+                        # The worker fills stats of its own, which are dropped if it times out. It stops at the
+                        #   timeout too, rather than running on in the background.
+                        analysis_stats = dict()
+                        with waiting_for_worker():
+                            mesh_min, mesh_max = self.run_in_worker_thread(gcode_analysis,
+                                                                           self.gcode_analysis_timeout,
+                                                                           gcode_filepath, None, analysis_stats,
+                                                                           self.gcode_analysis_time_budget or None,
+                                                                           self.gcode_analysis_timeout)
+                        stats['gcode_analysis'].update(analysis_stats)
+                        self.log_to_gcmd_respond(gcmd, "Use Gcode analysis boundary detection ({}, {:.2f}s)".format(
+                            stats['gcode_analysis']['mode'], stats['gcode_analysis']['elapsed']))
+                        stats['method'] = 'gcode_analysis'
                         break
                     except Exception as e:
+                        stats['gcode_analysis']['mode'] = 'fallback'
+                        logging.info("adaptive_bed_mesh: gcode analysis fallback after %.3fs: %s",
+                                     time.monotonic() - analysis_start_time, e)
                         self.log_to_gcmd_respond(gcmd, "Failed to run Gcode analysis: {}".format(e))
 
-                self.log_to_gcmd_respond(gcmd, "Fallback to default bed mesh")
-                # Method 4: use default bed mesh settings
-                mesh_min = self.bed_mesh_config_mesh_min
-                mesh_max = self.bed_mesh_config_mesh_max
+            self.log_to_gcmd_respond(gcmd, "Fallback to default bed mesh")
+            # Method 5: use default bed mesh settings
+            mesh_min = self.bed_mesh_config_mesh_min
+            mesh_max = self.bed_mesh_config_mesh_max
 
-                break
+            break
 
-            if self.debug_mode:
-                self.log_to_gcmd_respond(gcmd, "mesh_min: {}, mesh_max: {}".format(mesh_min, mesh_max))
-                self.log_to_gcmd_respond(gcmd, "mesh_area_clearance: {}".format(self.mesh_area_clearance))
+        return mesh_min, mesh_max
 
-            # Apply the bed mesh margin and limit, then generate the bed_mesh_calibrate parameter
-            params = self.generate_bed_mesh_params(mesh_min, mesh_max)
+    def analyse_gcode_file(self, gcode_filepath):
+        """
+        Offline counterpart of detect_mesh_boundary() and generate_bed_mesh_params() for one gcode file. The slicer min
+        max and exclude object methods need a running print, so only the gcode metadata and the gcode analysis are
+        tried. The gcode analysis runs in the calling thread without a timeout.
+        :return: {'method', 'mesh_min', 'mesh_max', 'params', 'probe_count', 'probe_points',
+                  'relative_reference_index', 'estimated_probe_time', 'method_times', 'gcode_analysis', 'total_time'},
+                  or {'error', ...} if the file can't be read
+        """
+        result = {'method': 'default', 'method_times': dict(), 'gcode_analysis': dict()}
+        start_time = time.monotonic()
 
-            cmd = "BED_MESH_CALIBRATE {}".format(params)
-            self.log_to_gcmd_respond(gcmd, cmd)
+        try:
+            mesh_min, mesh_max = self.bed_mesh_config_mesh_min, self.bed_mesh_config_mesh_max
+            os.stat(gcode_filepath)
+
+            if not self.disable_gcode_metadata_boundary_detection:
+                with self.measure_time(result['method_times'], 'gcode_metadata'):
+                    try:
+                        mesh_min, mesh_max = self.generate_mesh_with_gcode_metadata(gcode_filepath)
+                        result['method'] = 'gcode_metadata'
+                    except Exception as e:
+                        result['gcode_metadata_error'] = str(e)
+
+            if result['method'] == 'default' and not self.disable_gcode_analysis_boundary_detection:
+                with self.measure_time(result['method_times'], 'gcode_analysis'):
+                    mesh_min, mesh_max = self.generate_mesh_with_gcode_analysis(gcode_filepath, None,
+                                                                                result['gcode_analysis'])
+                    result['method'] = 'gcode_analysis'
+
+            stats = dict()
+            result['params'] = self.generate_bed_mesh_params(mesh_min, mesh_max, stats)
+            probe_count, probe_points, relative_reference_index = self.get_probe_points(
+                *self.apply_min_max_limit(*self.apply_min_max_margin(mesh_min, mesh_max)))
+        except Exception as e:
+            result['error'] = str(e)
+            return result
+        finally:
+            result['total_time'] = time.monotonic() - start_time
+
+        result.update(mesh_min=[float(v) for v in mesh_min], mesh_max=[float(v) for v in mesh_max],
+                      probe_count=list(probe_count), probe_points=[[float(x), float(y)] for x, y in probe_points],
+                      relative_reference_index=relative_reference_index,
+                      estimated_probe_time=stats['estimated_probe_time'])
+        return result
+
+    def cmd_ADAPTIVE_BED_MESH_STATS(self, gcmd):
+        if not self.calibration_stats:
+            self.log_to_gcmd_respond(gcmd, "No calibration recorded")
+            return
+
+        self.log_to_gcmd_respond(gcmd, "\n".join(self.format_calibration_stats(stats)
+                                                 for stats in self.calibration_stats))
+
+    @staticmethod
+    def format_calibration_stats(stats):
+        text = "{}: {} {:.3f}s ({})".format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['time'])), stats['method'],
+            stats['detection_time'],
+            ', '.join('{} {:.3f}s'.format(name, t) for name, t in stats['method_times'].items()))
+
+        gcode_analysis = stats['gcode_analysis']
+        if gcode_analysis.get('cache_hit'):
+            text += ", gcode analysis cache hit"
+        elif 'bytes' in gcode_analysis:
+            text += ", parsed {:.1f}MB {} lines {} moves {} arcs".format(
+                gcode_analysis['bytes'] / 1e6, gcode_analysis['lines'], gcode_analysis['moves'],
+                gcode_analysis['arcs'])
+        if gcode_analysis.get('mode') == 'partial':
+            text += " (partial, time budget spent)"
+
+        if 'memo_profile' in stats:
+            text += ", probe count {}x{} from memoized profile {} ({:.0f}s old)".format(
+                stats['probe_count'][0], stats['probe_count'][1], stats['memo_profile'], stats['memo_age'])
+        elif 'reused_profile' in stats:
+            text += ", probe count {}x{} from profile {} (drift {:.3f}mm)".format(
+                stats['probe_count'][0], stats['probe_count'][1], stats['reused_profile'], stats['drift'])
+            text += ", verification {:.1f}s (estimated {:.1f}s)".format(stats['bed_mesh_calibrate_time'],
+                                                                        stats['estimated_probe_time'])
+        else:
+            text += ", probe count {}x{}, BED_MESH_CALIBRATE {:.1f}s (estimated {:.1f}s)".format(
+                stats['probe_count'][0], stats['probe_count'][1], stats['bed_mesh_calibrate_time'],
+                stats['estimated_probe_time'])
+        if 'full_probe_count' in stats:
+            text += " (reduced from {}x{}, predicted error {:.3f}mm)".format(
+                stats['full_probe_count'][0], stats['full_probe_count'][1], stats['predicted_interpolation_error'])
+        if stats.get('idle_probe_points'):
+            text += ", {} probe points away from the print".format(len(stats['idle_probe_points']))
+        text += ", total {:.1f}s".format(stats['total_time'])
+
+        return text
+
+    def cmd_ADAPTIVE_BED_MESH_REFERENCE_CALIBRATE(self, gcmd):
+        profile_name = gcmd.get('NAME', 'default')
+        with self.catch_exception_to_console(gcmd):
+            # Full bed mesh with the [bed_mesh] settings
+            self.gcode.run_script_from_command("BED_MESH_CALIBRATE PROFILE={}".format(profile_name))
+            bed_temperature = self.get_bed_temperature()
+            self.reference_meshes.put(profile_name, time.time(), bed_temperature)
+            if self.probe_density_tolerance > 0:
+                self.record_mesh_history(profile_name)
+            self.log_to_gcmd_respond(gcmd, "Recorded reference mesh {} at bed temperature {}".format(
+                profile_name, bed_temperature))
+
+    def get_bed_temperature(self):
+        heater_bed = self.printer.lookup_object('heater_bed', None)
+        if heater_bed is None:
+            return None
+        return heater_bed.get_status(self.printer.get_reactor().monotonic())['temperature']
+
+    def find_reference_mesh(self, mesh_min, mesh_max):
+        """
+        Find the most recent reference mesh that covers the area, is young enough and was probed at about the current
+        bed temperature.
+        :return: (profile name, profile) or None
+        """
+        now = time.time()
+        bed_temperature = self.get_bed_temperature()
+        profiles = self.bed_mesh.pmgr.get_profiles()
+
+        candidates = []
+        for profile_name, reference in self.reference_meshes.load().items():
+            # The profile is lost on restart unless saved by SAVE_CONFIG
+            profile = profiles.get(profile_name)
+            if profile is None or now - reference['time'] > self.reuse_reference_max_age:
+                continue
+
+            if (bed_temperature is None) != (reference['bed_temperature'] is None):
+                continue
+            if bed_temperature is not None and abs(
+                    bed_temperature - reference['bed_temperature']) > self.reuse_reference_temperature_tolerance:
+                continue
+
+            mesh_params = profile['mesh_params']
+            if not (mesh_params['min_x'] <= mesh_min[0] and mesh_params['min_y'] <= mesh_min[1] and
+                    mesh_params['max_x'] >= mesh_max[0] and mesh_params['max_y'] >= mesh_max[1]):
+                continue
+
+            candidates.append((reference['time'], profile_name, profile))
+
+        if not candidates:
+            return None
+
+        _, profile_name, profile = max(candidates, key=lambda candidate: candidate[0])
+        return profile_name, profile
+
+    def probe_heights(self, points):
+        """
+        Probe the bed height at each (x, y) with the PROBE command.
+        :return: list of the probed heights
+        """
+        probe = self.printer.lookup_object('probe')
+        x_offset, y_offset = probe.get_offsets()[:2]
+
+        heights = []
+        for x, y in points:
+            self.gcode.run_script_from_command("G90\nG0 Z{:.3f} F{:.0f}\nG0 X{:.3f} Y{:.3f} F{:.0f}\nPROBE".format(
+                self.bed_mesh_config_horizontal_move_z, self.probe_lift_speed * 60, x - x_offset, y - y_offset,
+                self.bed_mesh_config_speed * 60))
+            heights.append(probe.get_status(self.printer.get_reactor().monotonic())['last_z_result'])
+
+        self.gcode.run_script_from_command("G0 Z{:.3f} F{:.0f}".format(self.bed_mesh_config_horizontal_move_z,
+                                                                       self.probe_lift_speed * 60))
+        return heights
+
+    def load_reference_mesh(self, gcmd, mesh_min, mesh_max, stats):
+        """
+        Resample a reference mesh that covers the area onto the adaptive probe grid, and load it instead of probing.
+        The zero reference and the corners are probed first, unless reuse_reference_max_drift is 0, and the mesh is
+        rejected if the bed moved more than that since the reference was probed.
+        :return: True if loaded
+        """
+        mesh_min, mesh_max = self.apply_min_max_margin(mesh_min, mesh_max)
+        mesh_min, mesh_max = self.apply_min_max_limit(mesh_min, mesh_max)
 
-            self.gcode.run_script_from_command(cmd)
+        reference = self.find_reference_mesh(mesh_min, mesh_max)
+        if reference is None:
+            self.log_to_gcmd_respond(gcmd, "No reference mesh covers the area")
+            return False
+        profile_name, profile = reference
+
+        (num_horizontal_probes, num_vertical_probes), probe_points, relative_reference_index = \
+            self.get_probe_points(mesh_min, mesh_max)
+        zero_reference_position = probe_points[relative_reference_index]
+        stats['probe_count'] = [num_horizontal_probes, num_vertical_probes]
+
+        # Heights relative to the zero reference, as if the area were probed
+        x_coords = numpy.linspace(mesh_min[0], mesh_max[0], num_horizontal_probes)
+        y_coords = numpy.linspace(mesh_min[1], mesh_max[1], num_vertical_probes)
+        points = resample_mesh(profile['points'], profile['mesh_params'], x_coords, y_coords)
+        points -= resample_mesh(profile['points'], profile['mesh_params'], [zero_reference_position[0]],
+                                [zero_reference_position[1]])[0, 0]
+
+        with self.measure_time(stats, 'bed_mesh_calibrate_time'):
+            stats['drift'] = 0.
+            if self.reuse_reference_max_drift > 0:
+                verification_points = [zero_reference_position, (mesh_min[0], mesh_min[1]),
+                                       (mesh_max[0], mesh_min[1]), (mesh_max[0], mesh_max[1]),
+                                       (mesh_min[0], mesh_max[1])]
+                stats['estimated_probe_time'] = self.estimate_probe_time(verification_points)
+
+                heights = numpy.array(self.probe_heights(verification_points))
+                expected_heights = numpy.array([resample_mesh(profile['points'], profile['mesh_params'], [x], [y])[0, 0]
+                                                for x, y in verification_points])
+                drifts = (heights - heights[0]) - (expected_heights - expected_heights[0])
+                stats['drift'] = float(numpy.abs(drifts).max())
+                if stats['drift'] > self.reuse_reference_max_drift:
+                    self.log_to_gcmd_respond(gcmd, "Reference mesh {} drifted by {:.3f}mm, probe the area".format(
+                        profile_name, stats['drift']))
+                    return False
+            else:
+                stats['estimated_probe_time'] = 0.
+
+            # Load as a temporary profile, which is only saved to the config by an explicit BED_MESH_PROFILE SAVE
+            mesh_params = dict(profile['mesh_params'], min_x=mesh_min[0], min_y=mesh_min[1], max_x=mesh_max[0],
+                               max_y=mesh_max[1], x_count=num_horizontal_probes, y_count=num_vertical_probes)
+            self.bed_mesh.pmgr.get_profiles()[self.reused_profile_name] = {'points': points.tolist(),
+                                                                          'mesh_params': mesh_params}
+            self.gcode.run_script_from_command("BED_MESH_PROFILE LOAD={}".format(self.reused_profile_name))
+
+        stats['reused_profile'] = profile_name
+        self.log_to_gcmd_respond(gcmd, "Derived the {}x{} mesh from the reference mesh {} (drift {:.3f}mm)".format(
+            num_horizontal_probes, num_vertical_probes, profile_name, stats['drift']))
+        return True
+
+    def get_z_offsets(self):
+        """
+        :return: (gcode Z offset, probe Z offset), a memoized mesh is only valid as long as both are unchanged
+        """
+        eventtime = self.printer.get_reactor().monotonic()
+        gcode_move = self.printer.lookup_object('gcode_move', None)
+        gcode_z_offset = gcode_move.get_status(eventtime)['homing_origin'][2] if gcode_move is not None else None
+        probe = self.printer.lookup_object('probe', None)
+        probe_z_offset = probe.get_offsets()[2] if probe is not None else None
+
+        return gcode_z_offset, probe_z_offset
+
+    def clear_mesh_memo(self):
+        profiles = self.bed_mesh.pmgr.get_profiles()
+        for entry in self.mesh_memo.values():
+            profiles.pop(entry['profile_name'], None)
+        self.mesh_memo.clear()
+
+    def memoize_mesh(self, memo_key):
+        """
+        Keep the mesh just probed as a temporary bed_mesh profile, which is only saved to the config by an explicit
+        BED_MESH_PROFILE SAVE. The oldest memoized meshes are evicted beyond the mesh_memo_size.
+        """
+        profiles = self.bed_mesh.pmgr.get_profiles()
+        profile = profiles.get('default')
+        if profile is None:
+            return
+
+        self.mesh_memo_sequence += 1
+        profile_name = '{}{}'.format(self.memo_profile_prefix, self.mesh_memo_sequence)
+        profiles[profile_name] = {'points': [list(row) for row in profile['points']],
+                                  'mesh_params': dict(profile['mesh_params'])}
+
+        previous = self.mesh_memo.pop(memo_key, None)
+        if previous is not None:
+            profiles.pop(previous['profile_name'], None)
+        self.mesh_memo[memo_key] = {'profile_name': profile_name, 'time': time.monotonic(),
+                                    'bed_temperature': self.get_bed_temperature(), 'z_offsets': self.get_z_offsets()}
+
+        while len(self.mesh_memo) > self.mesh_memo_size:
+            _, entry = self.mesh_memo.popitem(last=False)
+            profiles.pop(entry['profile_name'], None)
+
+    def load_memoized_mesh(self, gcmd, memo_key, stats):
+        """
+        Load the memoized mesh with the same parameters, if it is young enough and was probed at about the current bed
+        temperature. The whole memo is cleared once the Z offsets changed.
+        :return: True if the mesh is loaded
+        """
+        now = time.monotonic()
+        profiles = self.bed_mesh.pmgr.get_profiles()
+        for key, entry in list(self.mesh_memo.items()):
+            if now - entry['time'] > self.mesh_memo_max_age or entry['profile_name'] not in profiles:
+                del self.mesh_memo[key]
+                profiles.pop(entry['profile_name'], None)
+
+        entry = self.mesh_memo.get(memo_key)
+        if entry is None:
+            return False
+
+        if entry['z_offsets'] != self.get_z_offsets():
+            self.log_to_gcmd_respond(gcmd, "The Z offset changed, clear the memoized meshes")
+            self.clear_mesh_memo()
+            return False
+
+        bed_temperature = self.get_bed_temperature()
+        if (bed_temperature is None) != (entry['bed_temperature'] is None):
+            return False
+        if bed_temperature is not None and abs(
+                bed_temperature - entry['bed_temperature']) > self.mesh_memo_temperature_tolerance:
+            return False
+
+        self.gcode.run_script_from_command("BED_MESH_PROFILE LOAD={}".format(entry['profile_name']))
+        stats['memo_profile'] = entry['profile_name']
+        stats['memo_age'] = now - entry['time']
+        self.log_to_gcmd_respond(gcmd, "Loaded the memoized mesh {} ({:.0f}s old) instead of probing".format(
+            entry['profile_name'], stats['memo_age']))
+        return True
+
+    def record_mesh_history(self, profile_name):
+        profile = self.bed_mesh.pmgr.get_profiles().get(profile_name)
+        if profile is not None:
+            self.mesh_history.put(time.time(), self.get_bed_temperature(), profile['points'], profile['mesh_params'])
+
+    def find_history_meshes(self, mesh_min, mesh_max):
+        """
+        :return: list of the recent history meshes that cover the area, probed at about the current bed temperature
+        """
+        now = time.time()
+        bed_temperature = self.get_bed_temperature()
+
+        meshes = []
+        for entry in self.mesh_history.load():
+            if now - entry['time'] > self.probe_density_max_age:
+                continue
+
+            if (bed_temperature is None) != (entry['bed_temperature'] is None):
+                continue
+            if bed_temperature is not None and abs(
+                    bed_temperature - entry['bed_temperature']) > self.probe_density_temperature_tolerance:
+                continue
+
+            mesh_params = entry['mesh_params']
+            if not (mesh_params['min_x'] <= mesh_min[0] and mesh_params['min_y'] <= mesh_min[1] and
+                    mesh_params['max_x'] >= mesh_max[0] and mesh_params['max_y'] >= mesh_max[1]):
+                continue
+
+            meshes.append(entry)
+
+        return meshes
+
+    @staticmethod
+    def predict_interpolation_error(meshes, mesh_min, mesh_max, num_horizontal_probes, num_vertical_probes,
+                                    resolution=25):
+        """
+        Sample each mesh on the probe grid over the area, interpolate the samples back onto a dense grid, and compare
+        with the mesh itself. Both sides are interpolated bilinearly, which approximates the bed_mesh algorithms.
+        :return: the largest difference (in mm)
+        """
+        x_coords = numpy.linspace(mesh_min[0], mesh_max[0], num_horizontal_probes)
+        y_coords = numpy.linspace(mesh_min[1], mesh_max[1], num_vertical_probes)
+        dense_x_coords = numpy.linspace(mesh_min[0], mesh_max[0], resolution)
+        dense_y_coords = numpy.linspace(mesh_min[1], mesh_max[1], resolution)
+        probe_grid = {'min_x': mesh_min[0], 'max_x': mesh_max[0], 'x_count': num_horizontal_probes,
+                      'min_y': mesh_min[1], 'max_y': mesh_max[1], 'y_count': num_vertical_probes}
+
+        error = 0.
+        for mesh in meshes:
+            samples = resample_mesh(mesh['points'], mesh['mesh_params'], x_coords, y_coords)
+            truth = resample_mesh(mesh['points'], mesh['mesh_params'], dense_x_coords, dense_y_coords)
+            estimate = resample_mesh(samples, probe_grid, dense_x_coords, dense_y_coords)
+            error = max(error, float(numpy.abs(estimate - truth).max()))
+
+        return error
+
+    def reduce_probe_counts(self, mesh_min, mesh_max, num_horizontal_probes, num_vertical_probes):
+        """
+        Find the fewest probe points, at most the given counts per axis, whose interpolation error predicted from the
+        history meshes is within the probe_density_tolerance. The counts follow the apply_probe_point_limits() rules.
+        :return: (num_horizontal_probes, num_vertical_probes), predicted error or None without any history mesh
+        """
+        meshes = self.find_history_meshes(mesh_min, mesh_max)
+        if not meshes:
+            return (num_horizontal_probes, num_vertical_probes), None
+
+        candidates = sorted(((x_count * y_count, x_count, y_count)
+                             for x_count in range(self.minimum_axis_probe_counts, num_horizontal_probes + 1)
+                             for y_count in range(self.minimum_axis_probe_counts, num_vertical_probes + 1)
+                             if self.apply_probe_point_limits(x_count, y_count) == (x_count, y_count)))
+        for _, x_count, y_count in candidates:
+            error = self.predict_interpolation_error(meshes, mesh_min, mesh_max, x_count, y_count)
+            if error <= self.probe_density_tolerance:
+                return (x_count, y_count), error
+
+        return (num_horizontal_probes, num_vertical_probes), self.predict_interpolation_error(
+            meshes, mesh_min, mesh_max, num_horizontal_probes, num_vertical_probes)
+
+    def find_idle_probe_points(self, gcmd, mesh_min, mesh_max, stats):
+        """
+        Rasterize the printed footprint found by the exclude object or the gcode analysis, and report the probe points
+        with no printed material in any of their adjacent grid cells. Klipper only reads the faulty regions from the
+        config and can't skip them on BED_MESH_CALIBRATE, so they're reported as candidates.
+
+        Reading the footprint from the gcode delays the calibration, so it's only done with OCCUPANCY=1. Otherwise only
+        a footprint cached by an earlier OCCUPANCY=1 calibration of the file is used.
+        """
+        read_gcode = gcmd.get_int('OCCUPANCY', 0, minval=0, maxval=1)
+        area_min, area_max = self.apply_min_max_margin(mesh_min, mesh_max)
+        area_min, area_max = self.apply_min_max_limit(area_min, area_max)
+
+        if stats['method'] == 'exclude_object':
+            occupancy = OccupancyGrid(area_min, area_max, self.occupancy_resolution)
+            for obj in self.filter_excluded_objects(self.exclude_object.objects,
+                                                    self.exclude_object.excluded_objects):
+                occupancy.add_polygon(obj['polygon'])
+        elif stats['method'] == 'gcode_analysis':
+            # The footprint is read within what is left of the timeout and the time budget of the gcode analysis
+            time_left = self.gcode_analysis_timeout - stats['method_times'].get('gcode_analysis', 0.)
+            if self.gcode_analysis_time_budget:
+                time_left = min(time_left,
+                                self.gcode_analysis_time_budget - stats['gcode_analysis'].get('elapsed', 0.))
+            if time_left <= 0:
+                self.log_to_gcmd_respond(gcmd, "No time left to find the idle probe points")
+                return
+
+            gcode_filepath = self.get_gcode_filepath(gcmd.get("GCODE_FILEPATH", None))
+            occupancy = self.run_in_worker_thread(self.get_gcode_occupancy, time_left, gcode_filepath,
+                                                  area_min, area_max, time.monotonic() + time_left, not read_gcode)
+            if occupancy is None and not read_gcode:
+                self.log_to_gcmd_respond(gcmd, "No cached footprint, use OCCUPANCY=1 to find the idle probe points")
+                return
+            if occupancy is None:
+                # A part of the footprint is missing, so would be the probe points over it
+                self.log_to_gcmd_respond(gcmd, "Ran out of time to find the idle probe points")
+                return
+        else:
+            # The slicer min max and the gcode metadata have no footprint
+            return
+
+        (num_horizontal_probes, num_vertical_probes), probe_points, _ = self.get_probe_points(area_min, area_max)
+        spacing = ((area_max[0] - area_min[0]) / (num_horizontal_probes - 1),
+                   (area_max[1] - area_min[1]) / (num_vertical_probes - 1))
+        idle_probe_points = occupancy.get_idle_points(probe_points, spacing)
+
+        stats['occupied_ratio'] = float(occupancy.cells.mean())
+        stats['idle_probe_points'] = [[round(float(x), 2), round(float(y), 2)] for x, y in idle_probe_points]
+        if idle_probe_points:
+            self.log_to_gcmd_respond(gcmd, "{} of {} probe points are away from the print: {}".format(
+                len(idle_probe_points), len(probe_points),
+                ' '.join('{},{}'.format(x, y) for x, y in stats['idle_probe_points'])))
+
+    def get_gcode_occupancy(self, gcode_filepath, area_min, area_max, deadline=None, cached_only=False):
+        """
+        Rasterize the extrude moves below the fade end into an OccupancyGrid over the area. An arc is drawn as the
+        chords between the points that define its bounding box. The grid is cached along with the analysis result.
+
+        :param deadline: optional time.monotonic() to give up at, checked every budget_check_interval extrude moves
+        :param cached_only: only look up the cache, without reading the gcode
+        :return: the OccupancyGrid, or None once past the deadline or if cached_only and not cached
+        """
+        gcode_filepath = self.get_gcode_filepath(gcode_filepath)
+        settings = dict(self.get_gcode_analysis_settings(), area_min=list(area_min), area_max=list(area_max),
+                        resolution=self.occupancy_resolution)
+        if self.gcode_analysis_cache is not None:
+            occupancy = self.gcode_analysis_cache.get_occupancy(gcode_filepath, settings)
+            if occupancy is not None:
+                return occupancy
+        if cached_only:
+            return None
+
+        fade_end = self.bed_mesh_config_fade_end if self.gcode_analysis_stop_at_fade_end else 0
+        segments = [array('d') for _ in range(4)]
+
+        # Number of extrude moves left until the deadline is checked again
+        budget_countdown = self.budget_check_interval
+        with closing(self.iter_extrude_moves(gcode_filepath, with_start=True)) as extrude_moves:
+            for start_x, start_y, x, y, z in extrude_moves:
+                if deadline is not None:
+                    budget_countdown -= 1
+                    if budget_countdown == 0:
+                        budget_countdown = self.budget_check_interval
+                        if time.monotonic() >= deadline:
+                            return None
+                if 0 < fade_end <= z:
+                    break
+                for column, value in zip(segments, (start_x, start_y, x, y)):
+                    column.append(value)
 
-    def generate_bed_mesh_params(self, mesh_min, mesh_max):
+        occupancy = OccupancyGrid(area_min, area_max, self.occupancy_resolution)
+        occupancy.add_segments(*(numpy.frombuffer(column, dtype=numpy.float64) for column in segments))
+
+        if self.gcode_analysis_cache is not None:
+            self.gcode_analysis_cache.put_occupancy(gcode_filepath, settings, occupancy)
+
+        return occupancy
+
+    def generate_bed_mesh_params(self, mesh_min, mesh_max, stats=None):
         # Apply margin
         mesh_min, mesh_max = self.apply_min_max_margin(mesh_min, mesh_max)
 
@@ -151,10 +974,15 @@ class AdaptiveBedMesh(object):
         mesh_min, mesh_max = self.apply_min_max_limit(mesh_min, mesh_max)
 
         # Generate mesh min and max
-        (num_horizontal_probes, num_vertical_probes), probe_points, relative_reference_index = self.get_probe_points(mesh_min, mesh_max)
+        (num_horizontal_probes, num_vertical_probes), probe_points, relative_reference_index = self.get_probe_points(mesh_min, mesh_max, stats)
 
         zero_reference_position = probe_points[relative_reference_index]
 
+        if stats is not None:
+            stats['probe_count'] = [num_horizontal_probes, num_vertical_probes]
+            stats['zero_reference_position'] = [float(v) for v in zero_reference_position]
+            stats['estimated_probe_time'] = self.estimate_probe_time(probe_points)
+
         params = "MESH_MIN={x_min},{y_min} MESH_MAX={x_max},{y_max} PROBE_COUNT={x_counts},{y_counts}".format(
             x_min=mesh_min[0], y_min=mesh_min[1], x_max=mesh_max[0], y_max=mesh_max[1],
             x_counts=num_horizontal_probes, y_counts=num_vertical_probes
@@ -167,25 +995,259 @@ class AdaptiveBedMesh(object):
 
         return params
 
-    def generate_mesh_with_exclude_object(self, objects):
-        object_min_max_list = []
-        for obj in objects:
-            mesh_min, mesh_max = self.get_polygon_min_max(obj['polygon'])
-            object_min_max_list.append(mesh_min)
-            object_min_max_list.append(mesh_max)
+    def generate_mesh_with_exclude_object(self, objects, excluded_objects=()):
+        """
+        Bounds of the objects not excluded yet. The bounds of each named object are cached until its polygon is
+        redefined, so calibrating again after excluding objects doesn't walk the polygons again.
+        """
+        objects = self.filter_excluded_objects(objects, excluded_objects)
+        if not objects:
+            raise ValueError("All objects are excluded")
+
+        object_bounds = [None] * len(objects)
+        cache = dict()
+        missed = []
+        for i, obj in enumerate(objects):
+            cached = self.object_bounds_cache.get(obj.get('name'))
+            # A new print defines new polygons
+            if cached is not None and cached[0] is obj['polygon']:
+                object_bounds[i] = cached[1]
+                cache[obj['name']] = cached
+            elif obj['polygon']:
+                missed.append(i)
+
+        # One batched reduction over the points of all the objects not cached yet
+        if missed:
+            points = numpy.array([point for i in missed for point in objects[i]['polygon']],
+                                 dtype=numpy.float64).reshape(-1, 2)
+            offsets = numpy.cumsum([0] + [len(objects[i]['polygon']) for i in missed[:-1]])
+            bounds = numpy.hstack([numpy.minimum.reduceat(points, offsets), numpy.maximum.reduceat(points, offsets)])
+            for i, object_bound in zip(missed, bounds.tolist()):
+                object_bounds[i] = object_bound
+                if objects[i].get('name') is not None:
+                    cache[objects[i]['name']] = (objects[i]['polygon'], object_bound)
+
+        # Only the current objects are kept
+        self.object_bounds_cache = cache
+
+        object_bounds = numpy.array([bound for bound in object_bounds if bound is not None]).reshape(-1, 4)
+        if len(object_bounds) == 0:
+            raise ValueError("No object polygon defined")
+        x_min, y_min = object_bounds[:, :2].min(axis=0).tolist()
+        x_max, y_max = object_bounds[:, 2:].max(axis=0).tolist()
 
-        mesh_min, mesh_max = self.get_polygon_min_max(object_min_max_list)
+        return (x_min, y_min), (x_max, y_max)
 
-        return mesh_min, mesh_max
+    @staticmethod
+    def filter_excluded_objects(objects, excluded_objects):
+        # Klipper names the objects in upper case
+        excluded_objects = set(name.upper() for name in excluded_objects)
+        return [obj for obj in objects if obj.get('name') is None or obj['name'].upper() not in excluded_objects]
+
+    def run_in_worker_thread(self, func, timeout, *args):
+        """
+        Run the func in a worker thread while the reactor keeps servicing timers. Must be called from the reactor (e.g.
+        gcode command handler), the worker must not access any Klipper object.
+        """
+        reactor = self.printer.get_reactor()
+        completion = reactor.completion()
+        result = dict()
+
+        def worker():
+            try:
+                result['value'] = func(*args)
+            except Exception as e:
+                result['error'] = e
+            # Wake up the reactor from the worker thread
+            reactor.register_async_callback(lambda eventtime: completion.complete(True))
 
-    def generate_mesh_with_gcode_analysis(self, gcode_filepath=None):
+        thread = threading.Thread(target=worker, name='adaptive_bed_mesh', daemon=True)
+        thread.start()
+
+        if not completion.wait(reactor.monotonic() + timeout, False):
+            raise TimeoutError('Timed out after {}s'.format(timeout))
+
+        if 'error' in result:
+            raise result['error']
+
+        return result['value']
+
+    def get_gcode_filepath(self, gcode_filepath=None):
+        # Use the file loaded by the virtual sdcard by default
         if gcode_filepath is None:
             curtime = self.printer.get_reactor().monotonic()
             filename = self.print_stats.get_status(curtime)['filename']
             gcode_filepath = os.path.join(self.virtual_sdcard_path, filename)
 
-        layer_vertices = self.get_layer_vertices(gcode_filepath)
-        mesh_min, mesh_max = self.get_layer_min_max_before_fade(layer_vertices, self.bed_mesh_config_fade_end)
+        return gcode_filepath
+
+    def read_gcode_head_tail(self, gcode_filepath, deadline=None):
+        """
+        Read only the first and last gcode_metadata_scan_size bytes of the file, where the slicers put the metadata.
+
+        A binary gcode file gives the lines of its metadata blocks instead, without reading any gcode. Only the head
+        of a gzip file is read, finding its tail would take decompressing all of it. Decompressing stops at the
+        optional deadline (time.monotonic()), checked between blocks, with a TimeoutError.
+        :return: list of lines. Lines cut at the chunk boundaries are dropped.
+        """
+        scan_size = self.gcode_metadata_scan_size
+        gcode_format = get_gcode_format(gcode_filepath)
+        if gcode_format == 'bgcode':
+            return read_bgcode_metadata_lines(gcode_filepath, deadline)
+
+        if gcode_format == 'gzip':
+            head = bytearray()
+            with open(gcode_filepath, 'rb') as fp, gzip.GzipFile(fileobj=fp) as gzip_file:
+                while len(head) < scan_size:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError('Timed out reading the gcode metadata')
+                    block = gzip_file.read(min(scan_size - len(head), 64 * 1024))
+                    if not block:
+                        break
+                    head += block
+            # Drop the partial line at the end, unless that's the end of the file
+            chunks = [head if len(head) < scan_size else head[:head.rfind(b'\n')]]
+        else:
+            with open(gcode_filepath, 'rb') as fp:
+                file_size = os.fstat(fp.fileno()).st_size
+
+                if file_size <= 2 * scan_size:
+                    chunks = [fp.read()]
+                else:
+                    head = fp.read(scan_size)
+                    fp.seek(file_size - scan_size)
+                    tail = fp.read(scan_size)
+                    # Drop the partial lines at the chunk boundaries
+                    chunks = [head[:head.rfind(b'\n')], tail[tail.find(b'\n') + 1:]]
+
+        lines = []
+        for chunk in chunks:
+            lines.extend(chunk.decode('ascii', errors='ignore').splitlines())
+
+        return lines
+
+    def generate_mesh_with_gcode_metadata(self, gcode_filepath=None, timeout=None):
+        """
+        Detect the print area from the metadata written by the slicer, in the order of
+        1. PrusaSlicer/OrcaSlicer style `; first_layer_print_min = x,y` and `; first_layer_print_max = x,y`
+        2. `EXCLUDE_OBJECT_DEFINE ... POLYGON=[[x,y],...]`
+        3. Cura `;MINX:`, `;MINY:`, `;MAXX:`, `;MAXY:`
+
+        With the optional timeout (in seconds), reading a compressed file stops with a TimeoutError once the timeout is
+        over, like generate_mesh_with_gcode_analysis() does.
+        """
+        gcode_filepath = self.get_gcode_filepath(gcode_filepath)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        first_layer_print_min_max = dict()
+        exclude_objects = []
+        cura_min_max = dict()
+
+        for line in self.read_gcode_head_tail(gcode_filepath, deadline):
+            line = line.strip()
+
+            match = gcode_metadata_first_layer_print_pattern.match(line)
+            if match:
+                first_layer_print_min_max[match.group(1)] = (float(match.group(2)), float(match.group(3)))
+                continue
+
+            if line.upper().startswith('EXCLUDE_OBJECT_DEFINE'):
+                match = gcode_metadata_polygon_pattern.search(line)
+                if match:
+                    exclude_objects.append({'polygon': json.loads(match.group(1))})
+                continue
+
+            match = gcode_metadata_cura_min_max_pattern.match(line)
+            if match:
+                cura_min_max[match.group(1).upper()] = float(match.group(2))
+
+        if len(first_layer_print_min_max) == 2:
+            return first_layer_print_min_max['min'], first_layer_print_min_max['max']
+
+        if exclude_objects:
+            return self.generate_mesh_with_exclude_object(exclude_objects)
+
+        if len(cura_min_max) == 4:
+            return (cura_min_max['MINX'], cura_min_max['MINY']), (cura_min_max['MAXX'], cura_min_max['MAXY'])
+
+        raise ValueError('No print area metadata available')
+
+    def get_gcode_analysis_settings(self):
+        # Settings that change the analysis result
+        return {'arc_segments': self.arc_segments,
+                'fade_end': self.bed_mesh_config_fade_end,
+                'stop_at_fade_end': self.gcode_analysis_stop_at_fade_end,
+                'first_layer_only': self.gcode_analysis_first_layer_only}
+
+    def generate_mesh_with_gcode_analysis(self, gcode_filepath=None, checkpoint=None, stats=None, time_budget=None,
+                                          timeout=None):
+        """
+        The optional stats dict is filled with the cache_hit and index_hit flags, the counters of get_layer_extents(),
+        the mode (complete or partial) and the elapsed time.
+
+        On a cache miss, the layer index of the file (see LayerIndex) answers the query without reading the file if a
+        previous analysis went far enough, e.g. for a lower fade height. Otherwise the analysis continues from where the
+        previous one stopped.
+
+        With the optional time_budget (in seconds), the analysis stops once the budget is spent and the bounds of the
+        layers analysed so far are returned (partial). The first layers come first, so these are often the bounds of
+        every layer below the fade height already. A partial result is not cached, but the layer index is, so the next
+        analysis of the file continues from there. Raises ValueError if no layer was analysed within the budget.
+
+        With the optional timeout (in seconds), the analysis stops the same way once the timeout is over, but raises
+        TimeoutError instead of returning a partial result. This stops a worker thread its caller gave up on.
+        """
+        gcode_filepath = self.get_gcode_filepath(gcode_filepath)
+        if stats is None:
+            stats = dict()
+        start_time = time.monotonic()
+        deadline = start_time + time_budget if time_budget is not None else None
+        is_timeout_first = timeout is not None and (time_budget is None or timeout < time_budget)
+        if is_timeout_first:
+            deadline = start_time + timeout
+
+        # Stop reading the file once the print moves past the fade height, unless told otherwise (e.g. sequential
+        #   printing where each object starts from the bed again)
+        fade_end = self.bed_mesh_config_fade_end if self.gcode_analysis_stop_at_fade_end else 0
+
+        settings = self.get_gcode_analysis_settings()
+
+        if self.gcode_analysis_cache is not None:
+            cached_result = self.gcode_analysis_cache.get(gcode_filepath, settings)
+            stats['cache_hit'] = cached_result is not None
+            if cached_result is not None:
+                stats.update(mode='complete', elapsed=time.monotonic() - start_time)
+                return tuple(cached_result['mesh_min']), tuple(cached_result['mesh_max'])
+
+        first_layer_only = self.gcode_analysis_first_layer_only
+        layer_index = None
+        if self.gcode_analysis_cache is not None:
+            # Only the settings that change the extents of each layer, the index serves any fade height
+            index_settings = {'arc_segments': self.arc_segments}
+            layer_index = self.gcode_analysis_cache.get_layer_index(gcode_filepath, index_settings) or LayerIndex()
+            stats['index_hit'] = layer_index.covers(fade_end, first_layer_only)
+
+        if layer_index is not None and layer_index.covers(fade_end, first_layer_only):
+            layer_extents = layer_index.query(fade_end, first_layer_only)
+        else:
+            layer_extents = self.get_layer_extents(gcode_filepath, fade_end, first_layer_only, checkpoint, stats,
+                                                   layer_index, deadline)
+            if layer_index is not None:
+                self.gcode_analysis_cache.put_layer_index(gcode_filepath, index_settings, layer_index)
+
+        is_partial = stats.pop('budget_exceeded', False)
+        if is_partial and is_timeout_first:
+            # The layer index above keeps the progress for the next analysis
+            raise TimeoutError('Timed out after {}s'.format(timeout))
+        stats.update(mode='partial' if is_partial else 'complete', elapsed=time.monotonic() - start_time)
+        logging.info("adaptive_bed_mesh: gcode analysis %s after %.3fs", stats['mode'], stats['elapsed'])
+
+        mesh_min, mesh_max = self.get_layer_extents_min_max_before_fade(layer_extents, self.bed_mesh_config_fade_end)
+        if is_partial and mesh_min[0] > mesh_max[0]:
+            raise ValueError("No layer analysed within the time budget of {}s".format(time_budget))
+
+        if self.gcode_analysis_cache is not None and not is_partial:
+            self.gcode_analysis_cache.put(gcode_filepath, settings, mesh_min, mesh_max, layer_extents)
 
         return mesh_min, mesh_max
 
@@ -209,8 +1271,9 @@ class AdaptiveBedMesh(object):
 
         return [new_move]
 
-    def _arc_move_gcmd_decoder(self, gcmd, current_coordinate):
+    def _get_arc_params(self, gcmd, current_coordinate):
         gcode_params = self._move_gcmd_decoder(gcmd, current_coordinate)[0]
+        is_clockwise = gcmd[0].upper() == 'G2'
 
         start_coord = (current_coordinate['X'], current_coordinate['Y'])
 
@@ -220,24 +1283,44 @@ class AdaptiveBedMesh(object):
         end_coord = (gcode_params['X'] if gcode_params['X'] is not None else current_coordinate['X'],
                      gcode_params['Y'] if gcode_params['Y'] is not None else current_coordinate['Y'])
 
-        center_coord = (start_coord[0] + gcode_params['I'], start_coord[1] + gcode_params['J'])
-
-        if 'R' in gcode_params:
-            radius = gcode_params['R']
+        if gcode_params.get('R') is not None:
+            center_coord = get_arc_center_from_radius(start_coord, end_coord, gcode_params['R'], is_clockwise)
         else:
-            radius = math.hypot(gcode_params['I'], gcode_params['J'])
+            # The omitted I or J is 0
+            center_coord = (start_coord[0] + gcode_params.get('I', 0), start_coord[1] + gcode_params.get('J', 0))
+
+        return gcode_params, start_coord, end_coord, center_coord, is_clockwise
+
+    def _arc_extents_gcmd_decoder(self, gcmd, current_coordinate):
+        """
+        Decode the arc into the start point, the end point, and the axis extremes the arc sweeps through. These points
+        define the exact bounding box of the arc.
+        """
+        gcode_params, start_coord, end_coord, center_coord, is_clockwise = self._get_arc_params(gcmd, current_coordinate)
+
+        return [{'X': x, 'Y': y, 'E': gcode_params['E'], 'F': gcode_params['F'], 'Z': gcode_params['Z']}
+                for x, y in get_arc_extents(start_coord, end_coord, center_coord, is_clockwise)]
+
+    def _arc_move_gcmd_decoder(self, gcmd, current_coordinate):
+        gcode_params, start_coord, end_coord, center_coord, is_clockwise = self._get_arc_params(gcmd, current_coordinate)
+
+        radius = math.hypot(start_coord[0] - center_coord[0], start_coord[1] - center_coord[1])
 
         start_angle = math.atan2(start_coord[1] - center_coord[1], start_coord[0] - center_coord[0])
         end_angle = math.atan2(end_coord[1] - center_coord[1], end_coord[0] - center_coord[0])
 
         angle_delta = end_angle - start_angle
-        if 'G3' in gcmd:
+        if not is_clockwise:
             if angle_delta < 0:
                 angle_delta += 2 * math.pi
-        elif 'G2' in gcmd:
+        else:
             if angle_delta > 0:
                 angle_delta -= 2 * math.pi
 
+        # Full circle
+        if angle_delta == 0 and start_coord == end_coord:
+            angle_delta = -2 * math.pi if is_clockwise else 2 * math.pi
+
         angle_increment = angle_delta / self.arc_segments
 
         # Generate points on the arc
@@ -250,121 +1333,591 @@ class AdaptiveBedMesh(object):
 
         return arc_points
 
-    def get_layer_vertices(self, gcode_filepath):
+    def iter_extrude_moves(self, gcode_filepath, sample_arcs=False, stats=None, with_start=False, start=None,
+                           cursor=None):
+        """
+        Decode the gcode file and yield the (X, Y, Z) coordinate after each extrude move, one at a time. Nothing but
+        the current toolhead position is kept in memory, so the consumer decides what to keep. With with_start set,
+        (start X, start Y, X, Y, Z) is yielded instead.
+
+        An arc yields only the points that define its bounding box, unless sample_arcs is set to decode the arc into
+        arc_segments linear moves. The optional stats dict accumulates the counters described in get_layer_extents().
+
+        Gzip and binary gcode files are decompressed block by block as the decoding goes, see open_gcode_blocks().
+
+        The optional start ({'pos', 'absolute', 'X', 'Y', 'Z'}) continues the decoding from the line at the byte offset
+        pos (of the decompressed text) with the given modal state. The optional cursor dict is updated with the same fields before each motion
+        command, so the consumer knows where the move it receives started.
+        """
+        move_gcmd_interpreter = self._sampled_move_gcmd_interpreter if sample_arcs else self._move_gcmd_interpreter
         current_coordinate = dict(X=0, Y=0, Z=0)  # don't track E
         is_absolute_move = True
-        extrude_layer_moves = dict()
+        start_pos = 0
+        if start is not None:
+            current_coordinate = dict(X=start['X'], Y=start['Y'], Z=start['Z'])
+            is_absolute_move = start['absolute']
+            start_pos = start['pos']
+
+        with open_gcode_blocks(gcode_filepath, self.gcode_analysis_chunk_size) as blocks:
+            matches = None
+            data = b''
+            block_pos = 0
+            scanned_pos = block_start_pos = start_pos
+            num_lines = num_moves = num_arcs = 0
+            try:
+                for block_pos, data in blocks:
+                    # Decompressed but not decoded up to the start
+                    if block_pos + len(data) <= start_pos:
+                        continue
 
-        with open(gcode_filepath, 'r') as fp:
-            while True:
-                try:
-                    line = fp.readline()
-                except UnicodeDecodeError as e:
-                    # Ignore UnicodeDecodeError (not really important)
-                    continue
+                    # Only the motion commands are copied out of the file, comments and thumbnails are skipped by the
+                    #   regex engine without being decoded
+                    block_start_pos = scanned_pos = max(block_pos, start_pos)
+                    matches = gcode_command_pattern.finditer(data, scanned_pos - block_pos)
+                    for match in matches:
+                        scanned_pos = block_pos + match.end()
+
+                        # Decode gcode
+                        gcmd = match.group(1).decode('ascii', errors='ignore').split()
+                        gcmd_header = gcmd[0].upper()
+
+                        if gcmd_header == 'G90':
+                            is_absolute_move = True
+                        elif gcmd_header == 'G91':
+                            is_absolute_move = False
+
+                        # Skip gcode that is not a motion command
+                        if gcmd_header not in move_gcmd_interpreter.keys():
+                            continue
+
+                        num_moves += 1
+                        if gcmd_header in ('G2', 'G3'):
+                            num_arcs += 1
+
+                        if cursor is not None:
+                            cursor.update(current_coordinate, pos=block_pos + match.start(), absolute=is_absolute_move)
+
+                        # Decode motion command
+                        interpreter = move_gcmd_interpreter[gcmd_header]
+                        new_moves = interpreter(gcmd, current_coordinate)
+
+                        # Each motion command many generate one or more moves. Analyse each move
+                        for new_move in new_moves:
+                            start_x, start_y = current_coordinate['X'], current_coordinate['Y']
+                            for key in current_coordinate.keys():
+                                new_param = new_move[key]
+                                if new_param is not None:
+                                    if is_absolute_move:
+                                        current_coordinate[key] = new_param
+                                    else:
+                                        current_coordinate[key] += new_param
+
+                            # Ignore extrude only move
+                            if all(new_move[p] is None for p in ['X', 'Y', 'Z']):
+                                continue
+
+                            # 0 is either undefined or invalid move
+                            if current_coordinate['Z'] == 0:
+                                continue
+
+                            # Report only the extrude move
+                            if new_move['E'] is not None and new_move['E'] > 0:
+                                if with_start:
+                                    yield start_x, start_y, current_coordinate['X'], current_coordinate['Y'], \
+                                        current_coordinate['Z']
+                                else:
+                                    yield current_coordinate['X'], current_coordinate['Y'], current_coordinate['Z']
+
+                    # The whole block is scanned
+                    scanned_pos = block_pos + len(data)
+                    if stats is not None:
+                        num_lines += count_lines(data, block_start_pos - block_pos, len(data))
+                    block_start_pos = scanned_pos
+            finally:
+                # The memory map can't be closed while the scanner refers to it
+                del matches
+
+                if stats is not None:
+                    # Stopped early by the consumer in the middle of a block
+                    if block_start_pos < scanned_pos:
+                        num_lines += count_lines(data, block_start_pos - block_pos, scanned_pos - block_pos)
+                    add_counters(stats, bytes=scanned_pos - start_pos, lines=num_lines, moves=num_moves,
+                                 arcs=num_arcs)
 
-                if line == '':
-                    break
+    def get_layer_vertices(self, gcode_filepath):
+        """
+        Debug only: Collect every extrude move of every layer. The memory usage grows with the size of the gcode file
+        (24 bytes per move), use get_layer_extents() for the boundary detection.
+        :return: LayerVertices
+        """
+        x, y, z = array('d'), array('d'), array('d')
+
+        # FIXME: Only the extrude move is registered, result in incorrect visual representation of the gcode.
+        for move_x, move_y, move_z in self.iter_extrude_moves(gcode_filepath, sample_arcs=True):
+            x.append(move_x)
+            y.append(move_y)
+            z.append(move_z)
+
+        return LayerVertices(x, y, z)
+
+    def get_layer_extents(self, gcode_filepath, fade_end=0, first_layer_only=False, checkpoint=None, stats=None,
+                          layer_index=None, deadline=None):
+        """
+        Stream the gcode file and keep only the running XY extents of extrude moves for each layer.
+
+        The scan stops as soon as an extrude move is seen at or above the fade_end (0 to analyse all layers), or at the
+        first layer change if first_layer_only is set. Only extrude moves define the printing Z, so a Z-hop travel move
+        won't end the scan early.
+
+        The optional checkpoint is called on every new layer (python backend) or every chunk (numpy backend). It may
+        sleep to throttle the analysis, or raise to abort.
+
+        The optional stats dict accumulates the work done: the bytes and lines scanned, and the motion (moves) and arc
+        commands decoded.
+
+        The optional layer_index (LayerIndex) is extended in place: the analysis continues from where the previous
+        analysis into the index stopped, and the result is taken from the index.
+
+        The analysis also stops at the optional deadline (time.monotonic()), checked every chunk (numpy backend) or
+        every budget_check_interval extrude moves (python backend), and sets stats['budget_exceeded']. The index then
+        continues from there, with the highest layer analysed as the layer that stopped the analysis, since it may be
+        incomplete.
+        :return: {layer_height: [x_min, y_min, x_max, y_max]}
+        """
+        if stats is not None:
+            stats['backend'] = self.gcode_analysis_backend
+
+        if self.gcode_analysis_backend == 'numpy':
+            initial_counters = dict() if stats is None else {
+                key: stats[key] for key in gcode_analysis_counters if key in stats}
+            try:
+                # The first layer is at the start of the file, and the background pre-analysis shall not hog the CPU.
+                #   A compressed file can't be split
+                is_started = layer_index is not None and not layer_index.is_empty()
+                if self.gcode_analysis_workers > 1 and not first_layer_only and checkpoint is None and not is_started \
+                        and get_gcode_format(gcode_filepath) == 'text':
+                    layer_extents = self._get_layer_extents_parallel(gcode_filepath, fade_end, stats, layer_index,
+                                                                     deadline)
+                else:
+                    layer_extents = self._get_layer_extents_numpy(gcode_filepath, fade_end, first_layer_only,
+                                                                  checkpoint, stats, layer_index, deadline)
+                return layer_extents if layer_index is None else layer_index.query(fade_end, first_layer_only)
+            except UnsupportedGcodeError:
+                # Fallback to the python backend for gcode the numpy backend doesn't support
+                if stats is not None:
+                    # Only undo the work of the numpy backend, the flags of the caller stay
+                    for key in gcode_analysis_counters:
+                        stats.pop(key, None)
+                    stats.update(initial_counters)
+                    stats.pop('budget_exceeded', None)
+                    stats['backend'] = 'python'
+                if layer_index is not None:
+                    layer_index.reset()
+
+        layer_extents = self._get_layer_extents_python(gcode_filepath, fade_end, first_layer_only, checkpoint, stats,
+                                                       layer_index, deadline)
+        return layer_extents if layer_index is None else layer_index.query(fade_end, first_layer_only)
+
+    def _get_layer_extents_python(self, gcode_filepath, fade_end, first_layer_only, checkpoint, stats=None,
+                                  layer_index=None, deadline=None):
+        if layer_index is None:
+            layer_extents = dict()
+            start = cursor = None
+        else:
+            layer_extents = layer_index.layer_extents
+            start = layer_index.next
+            cursor = dict()
+            layer_index.next = None
+
+        # Number of extrude moves left until the deadline is checked again
+        budget_countdown = self.budget_check_interval
+        with closing(self.iter_extrude_moves(gcode_filepath, stats=stats, start=start,
+                                             cursor=cursor)) as extrude_moves:
+            for x, y, z in extrude_moves:
+                if deadline is not None:
+                    budget_countdown -= 1
+                    if budget_countdown == 0:
+                        budget_countdown = self.budget_check_interval
+                        if time.monotonic() >= deadline:
+                            if stats is not None:
+                                stats['budget_exceeded'] = True
+                            if layer_index is not None:
+                                # Continue from the move just received, it is merged once the analysis continues
+                                layer_index.next = dict(cursor, z=max(z, max(layer_extents, default=z)))
+                            break
 
-                # Skip comment lines
-                line = line.strip()
+                extents = layer_extents.get(z)
+                if extents is None:
+                    # Moved past the fade height, no need to read the rest of the file
+                    # Moved to the second layer
+                    if 0 < fade_end <= z or (first_layer_only and layer_extents):
+                        if layer_index is not None:
+                            layer_index.next = dict(cursor, z=z)
+                        break
 
-                # Nothing in front of comment
-                raw_gcmd = line.split(';')[0].strip()
-                if raw_gcmd == '':
-                    continue
+                    if checkpoint is not None:
+                        checkpoint()
 
-                # Decode gcode
-                gcmd = raw_gcmd.split()
+                    layer_extents[z] = [x, y, x, y]
+                    if layer_index is not None:
+                        layer_index.offsets[z] = cursor['pos']
+                    continue
 
-                # Skip empty
-                if len(gcmd) == 0:
+                if x < extents[0]:
+                    extents[0] = x
+                elif x > extents[2]:
+                    extents[2] = x
+
+                if y < extents[1]:
+                    extents[1] = y
+                elif y > extents[3]:
+                    extents[3] = y
+
+        return layer_extents
+
+    def _get_layer_extents_numpy(self, gcode_filepath, fade_end, first_layer_only, checkpoint, stats=None,
+                                 layer_index=None, deadline=None):
+        """
+        Scan the memory mapped gcode file in large chunks, decode the motion commands of each chunk into arrays, then
+        reduce the extents of each layer with array operations. The modal state (G90/G91, toolhead position) is carried
+        from one chunk to the next.
+        """
+        layer_extents = dict()
+        state = {'absolute': True, 'X': 0., 'Y': 0., 'Z': 0.}
+        pos = 0
+        if layer_index is not None:
+            layer_extents = layer_index.layer_extents
+            if layer_index.next is not None:
+                pos = layer_index.next['pos']
+                state = {key: layer_index.next[key] for key in state}
+                layer_index.next = None
+
+        with open_gcode_blocks(gcode_filepath, self.gcode_analysis_chunk_size) as blocks:
+            for block_pos, data in blocks:
+                # Decompressed but not decoded up to the start
+                if block_pos + len(data) <= pos:
                     continue
 
-                gcmd_header = gcmd[0].upper()
+                if self._analyse_range(data, max(0, pos - block_pos), len(data), self.gcode_analysis_chunk_size,
+                                       state, layer_extents, fade_end, first_layer_only, checkpoint, stats,
+                                       layer_index, block_pos, deadline):
+                    break
 
-                if gcmd_header == 'G90':
-                    is_absolute_move = True
-                elif gcmd_header == 'G91':
-                    is_absolute_move = False
+        return layer_extents
+
+    def _get_layer_extents_parallel(self, gcode_filepath, fade_end, stats=None, layer_index=None, deadline=None):
+        """
+        Split the gcode file into one range per worker process. Each worker analyses its range from an unknown toolhead
+        position (NaN) assuming absolute positioning, and reports where the position becomes known. The ranges are then
+        merged in order: the unresolved head of each range is analysed again from the end state of the previous range,
+        and the whole range is analysed again if the assumption of absolute positioning was wrong. The result is
+        identical to the serial analysis.
+
+        The optional layer_index shall be empty (LayerIndex.is_empty()), it's filled as by the serial analysis. At the
+        optional deadline, the ranges merged so far are returned, see get_layer_extents().
+        """
+        layer_extents = dict()
+        if layer_index is not None:
+            layer_extents = layer_index.layer_extents
+            layer_index.next = None
+        state = {'absolute': True, 'X': 0., 'Y': 0., 'Z': 0.}
+        chunk_size = self.gcode_analysis_chunk_size
+
+        with open_gcode_mmap(gcode_filepath) as data:
+            ranges = split_line_ranges(data, self.gcode_analysis_workers, chunk_size)
+            if len(ranges) <= 1:
+                self._analyse_range(data, 0, len(data), chunk_size, state, layer_extents, fade_end, False,
+                                    stats=stats, layer_index=layer_index, deadline=deadline)
+                return layer_extents
+
+            # Don't fork the multi-threaded Klipper process
+            executor = concurrent.futures.ProcessPoolExecutor(len(ranges),
+                                                              mp_context=multiprocessing.get_context('spawn'))
+            try:
+                futures = [executor.submit(analyse_gcode_range, gcode_filepath, pos, endpos, chunk_size, fade_end)
+                           for pos, endpos in ranges]
 
-                # Skip gcode that is not a motion command
-                if gcmd_header not in self._move_gcmd_interpreter.keys():
-                    continue
+                for (pos, endpos), future in zip(ranges, futures):
+                    try:
+                        result = future.result(None if deadline is None else max(0., deadline - time.monotonic()))
+                    except concurrent.futures.TimeoutError:
+                        if stats is not None:
+                            stats['budget_exceeded'] = True
+                        if layer_index is not None:
+                            layer_index.next = dict(state, pos=pos, z=max(layer_extents, default=-math.inf))
+                        break
+                    range_state = dict(state)
 
-                # Decode motion command
-                interpreter = self._move_gcmd_interpreter[gcmd_header]
-                new_moves = interpreter(gcmd, current_coordinate)
-
-                # Each motion command many generate one or more moves. Analyse each move
-                for new_move in new_moves:
-                    for key in current_coordinate.keys():
-                        new_param = new_move[key]
-                        if new_param is not None:
-                            if is_absolute_move:
-                                current_coordinate[key] = new_param
-                            else:
-                                current_coordinate[key] += new_param
-
-                    # Ignore extrude only move
-                    if all(new_move[p] is None for p in ['X', 'Y', 'Z']):
-                        continue
+                    # Each byte is counted once, by the worker unless its analysis of the range is dropped
+                    if not state['absolute'] or result['resolved_pos'] is None:
+                        is_stopped = self._analyse_range(data, pos, endpos, chunk_size, state, layer_extents, fade_end,
+                                                         False, stats=stats, layer_index=layer_index)
+                    else:
+                        if stats is not None:
+                            add_counters(stats, **result['stats'])
+                        # The worker has counted the head already
+                        is_stopped = self._analyse_range(data, pos, result['resolved_pos'], chunk_size, state,
+                                                         layer_extents, fade_end, False, layer_index=layer_index)
+                        if not is_stopped:
+                            for layer, x_min, y_min, x_max, y_max in result['layer_extents']:
+                                extents = layer_extents.get(layer)
+                                if extents is None:
+                                    layer_extents[layer] = [x_min, y_min, x_max, y_max]
+                                    if layer_index is not None:
+                                        layer_index.offsets[layer] = result['offsets'][layer]
+                                else:
+                                    extents[0] = min(extents[0], x_min)
+                                    extents[1] = min(extents[1], y_min)
+                                    extents[2] = max(extents[2], x_max)
+                                    extents[3] = max(extents[3], y_max)
+
+                            is_stopped = result['is_stopped']
+                            state.update(result['state'])
+                            if is_stopped and layer_index is not None:
+                                # Continue from the start of the range, which the worker analysed from a known state
+                                layer_index.next = dict(range_state, pos=pos, z=result['stop_z'])
+
+                    if is_stopped:
+                        break
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        return layer_extents
+
+    @classmethod
+    def _analyse_range(cls, data, pos, endpos, chunk_size, state, layer_extents, fade_end, first_layer_only,
+                       checkpoint=None, stats=None, layer_index=None, base_pos=0, deadline=None):
+        """
+        Analyse data[pos:endpos] chunk by chunk, and merge the extrude moves into the layer extents. The range must
+        start and end at line boundaries. Moves from an unknown (NaN) position are ignored.
+
+        The optional layer_index records the chunk each new layer starts in, and the chunk to continue from if stopped,
+        as offsets from base_pos (the offset of data in the gcode text).
+        :return: True if the analysis shall stop
+        """
+        while pos < endpos:
+            # Process up to the end of the line at the chunk boundary
+            end = data.find(b'\n', min(pos + chunk_size, endpos) - 1, endpos) + 1 or endpos
+
+            if checkpoint is not None:
+                checkpoint()
+
+            if deadline is not None and time.monotonic() >= deadline:
+                if stats is not None:
+                    stats['budget_exceeded'] = True
+                if layer_index is not None:
+                    # The last chunk may have ended in the middle of the highest layer
+                    layer_index.next = dict(state, pos=base_pos + pos, z=max(layer_extents, default=-math.inf))
+                return True
+
+            chunk_state = dict(state)
+            num_layers = len(layer_extents)
+
+            x, y, z = cls._decode_motion_chunk(data, state, pos, end, stats)
+            is_known = ~(numpy.isnan(x) | numpy.isnan(y) | numpy.isnan(z))
+            if not is_known.all():
+                x, y, z = x[is_known], y[is_known], z[is_known]
+
+            is_stopped = cls._merge_layer_extents(layer_extents, x, y, z, fade_end, first_layer_only)
+
+            if layer_index is not None:
+                for layer in itertools.islice(layer_extents, num_layers, None):
+                    layer_index.offsets[layer] = base_pos + pos
+                if is_stopped:
+                    # The layers merged from this chunk are merged again when continued from the chunk
+                    stop_z = z[~numpy.isin(z, list(layer_extents))][0]
+                    layer_index.next = dict(chunk_state, pos=base_pos + pos, z=float(stop_z))
+
+            if is_stopped:
+                return True
+
+            pos = end
 
-                    # Register move
-                    current_layer = current_coordinate['Z']
+        return False
 
-                    # 0 is either undefined or invalid move
-                    if current_layer == 0:
-                        continue
+    @staticmethod
+    def _decode_motion_chunk(data, state, pos, endpos, stats=None):
+        """
+        Decode all motion commands of data[pos:endpos], and update the modal state in place. The range must start and
+        end at line boundaries.
+        :return: X, Y, Z arrays of each extrude move, in the order of execution
+        """
+        rows = gcode_motion_pattern.findall(data, pos, endpos)
+        if stats is not None:
+            add_counters(stats, bytes=endpos - pos, lines=count_lines(data, pos, endpos))
+        if not rows:
+            return numpy.empty(0), numpy.empty(0), numpy.empty(0)
+
+        headers, *columns = zip(*rows)
+        codes = numpy.array([gcode_motion_header_codes[h.upper()] for h in headers])
+        row_index = numpy.arange(len(codes))
+
+        # Resolve the G90/G91 mode of each row
+        is_mode = codes >= 90
+        mode_index = numpy.maximum.accumulate(numpy.where(is_mode, row_index, -1))
+        is_absolute = numpy.where(mode_index >= 0, codes[mode_index] == 90, state['absolute'])
+        if is_mode.any():
+            state['absolute'] = bool(codes[row_index[is_mode][-1]] == 90)
+
+        # Keep only the motion commands
+        is_motion = ~is_mode
+        codes = codes[is_motion]
+        is_absolute = is_absolute[is_motion]
+        if len(codes) == 0:
+            return numpy.empty(0), numpy.empty(0), numpy.empty(0)
+
+        params = {}
+        for key, column in zip(gcode_motion_params, columns):
+            column = numpy.array(column)[is_motion]
+            has_param = column != b''
+            values = numpy.zeros(len(column))
+            try:
+                values[has_param] = column[has_param].astype(numpy.float64)
+            except ValueError:
+                raise ValueError('Unable to convert gcmd {} parameter'.format(key))
+            params[key] = has_param, values
+
+        is_arc = codes >= 2
+        if stats is not None:
+            add_counters(stats, moves=len(codes), arcs=int(numpy.count_nonzero(is_arc)))
+        if numpy.any(is_arc & ~is_absolute):
+            raise UnsupportedGcodeError('Arc moves in relative mode')
+
+        # Position of each axis after each row
+        initial_state = dict(state)
+        positions = {}
+        for key in ['X', 'Y', 'Z']:
+            has_param, values = params[key]
+            values, last_set = resolve_axis_positions(values, has_param & is_absolute, has_param & ~is_absolute,
+                                                      state[key])
+            positions[key] = numpy.where(last_set >= 0, values[last_set], state[key])
+            state[key] = float(positions[key][-1])
+
+        x_positions, y_positions, z_positions = positions['X'], positions['Y'], positions['Z']
+
+        # Extrude moves: at least one of XYZ and a positive E, at a non-zero Z
+        has_e, e_values = params['E']
+        is_extrude = has_e & (e_values > 0) & (z_positions != 0)
+        extrude_rows = numpy.flatnonzero(is_extrude & ~is_arc & (params['X'][0] | params['Y'][0] | params['Z'][0]))
+        rows = [extrude_rows]
+        x = [x_positions[extrude_rows]]
+        y = [y_positions[extrude_rows]]
+
+        arc_rows = numpy.flatnonzero(is_extrude & is_arc)
+        if len(arc_rows):
+            # Each arc starts from the end of the previous move
+            start_x = numpy.where(arc_rows > 0, x_positions[arc_rows - 1], initial_state['X'])
+            start_y = numpy.where(arc_rows > 0, y_positions[arc_rows - 1], initial_state['Y'])
+            end_x = x_positions[arc_rows]
+            end_y = y_positions[arc_rows]
+            is_clockwise = codes[arc_rows] == 2
+
+            # I/J form, or R form
+            has_r, r_values = params['R'][0][arc_rows], params['R'][1][arc_rows]
+            center_x = start_x + params['I'][1][arc_rows]
+            center_y = start_y + params['J'][1][arc_rows]
+            if has_r.any():
+                r_center_x, r_center_y = get_arc_centers_from_radius(start_x, start_y, end_x, end_y, r_values,
+                                                                     is_clockwise)
+                center_x = numpy.where(has_r, r_center_x, center_x)
+                center_y = numpy.where(has_r, r_center_y, center_y)
+
+            points_x, points_y, is_point = get_arcs_extents(start_x, start_y, end_x, end_y, center_x, center_y,
+                                                            is_clockwise)
+            for point_x, point_y, is_valid in zip(points_x, points_y, is_point):
+                rows.append(arc_rows[is_valid])
+                x.append(point_x[is_valid])
+                y.append(point_y[is_valid])
+
+        # Sort the moves in the order of execution
+        rows = numpy.concatenate(rows)
+        order = numpy.argsort(rows, kind='stable')
+        x = numpy.concatenate(x)[order]
+        y = numpy.concatenate(y)[order]
+        z = z_positions[rows[order]]
+
+        return x, y, z
+
+    @staticmethod
+    def _merge_layer_extents(layer_extents, x, y, z, fade_end, first_layer_only):
+        """
+        Merge the extrude moves of a chunk into the layer extents, subject to the same early termination rules as the
+        python backend.
+        :return: True if the analysis shall stop
+        """
+        if len(z) == 0:
+            return False
+
+        # Find the first move of each new layer, in the order of execution
+        layers, first_index = numpy.unique(z, return_index=True)
+        new_layer_index = sorted(int(i) for layer, i in zip(layers.tolist(), first_index) if layer not in layer_extents)
+
+        stop_index = None
+        for n, i in enumerate(new_layer_index):
+            if 0 < fade_end <= z[i] or (first_layer_only and (layer_extents or n > 0)):
+                stop_index = i
+                break
 
-                    # Move to a new layer, then register the new layer
-                    if current_layer not in extrude_layer_moves:
-                        extrude_layer_moves[current_layer] = []
+        if stop_index is not None:
+            x, y, z = x[:stop_index], y[:stop_index], z[:stop_index]
+            if len(z) == 0:
+                return True
+
+        layers, first_index, inverse, counts = numpy.unique(z, return_index=True, return_inverse=True,
+                                                            return_counts=True)
+        order = numpy.argsort(inverse, kind='stable')
+        starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+        x_min = numpy.minimum.reduceat(x[order], starts).tolist()
+        x_max = numpy.maximum.reduceat(x[order], starts).tolist()
+        y_min = numpy.minimum.reduceat(y[order], starts).tolist()
+        y_max = numpy.maximum.reduceat(y[order], starts).tolist()
+
+        for n in numpy.argsort(first_index):
+            layer = float(layers[n])
+            extents = layer_extents.get(layer)
+            if extents is None:
+                layer_extents[layer] = [x_min[n], y_min[n], x_max[n], y_max[n]]
+            else:
+                extents[0] = min(extents[0], x_min[n])
+                extents[1] = min(extents[1], y_min[n])
+                extents[2] = max(extents[2], x_max[n])
+                extents[3] = max(extents[3], y_max[n])
 
-                    # Register only the extrude move
-                    # FIXME: This will remove non-extrude move, result in incorrect visual representation of the gcode.
-                    if new_move['E'] is not None and new_move['E'] > 0:
-                        extrude_layer_moves[current_layer].append(current_coordinate.copy())
+        return stop_index is not None
 
-        # Remove layers without extrude move
-        for key in list(extrude_layer_moves.keys()):
-            if len(extrude_layer_moves[key]) == 0:
-                extrude_layer_moves.pop(key)
-        return extrude_layer_moves
+    def get_layer_min_max_before_fade(self, layer_vertices, fade_end=0):
+        # Not defined, then we are going to analyse all layers
+        if fade_end == 0:
+            fade_end = float('inf')
+
+        is_before_fade = layer_vertices.z < fade_end
+        if not is_before_fade.any():
+            return self.get_polygon_min_max([])
+
+        return self.get_move_min_max(LayerMoves(layer_vertices.x[is_before_fade], layer_vertices.y[is_before_fade]))
 
-    def get_layer_min_max_before_fade(self, extrude_layer_moves, fade_end=0):
+    def get_layer_extents_min_max_before_fade(self, layer_extents, fade_end=0):
         layer_min_max_list = list()
 
         # Not defined, then we are going to analyse all layers
         if fade_end == 0:
             fade_end = float('inf')
 
-        for layer_height in extrude_layer_moves:
+        for layer_height, (x_min, y_min, x_max, y_max) in layer_extents.items():
             if layer_height < fade_end:
-
-                mesh_min, mesh_max = self.get_move_min_max(extrude_layer_moves[layer_height])
-                layer_min_max_list.append(mesh_min)
-                layer_min_max_list.append(mesh_max)
+                layer_min_max_list.append((x_min, y_min))
+                layer_min_max_list.append((x_max, y_max))
 
         # Calculate overall min max
         mesh_min, mesh_max = self.get_polygon_min_max(layer_min_max_list)
 
         return mesh_min, mesh_max
 
-    def get_move_min_max(self, move_vertices):
-        x_min, x_max, y_min, y_max = float('inf'), 0, float('inf'), 0
-
-        for pt in move_vertices:
-            x = pt['X']
-            y = pt['Y']
+    def get_move_min_max(self, moves):
+        if len(moves) == 0:
+            return self.get_polygon_min_max([])
 
-            x_min = min(x_min, x)
-            x_max = max(x_max, x)
-
-            y_min = min(y_min, y)
-            y_max = max(y_max, y)
-
-        return (x_min, y_min), (x_max, y_max)
+        return (float(moves.x.min()), float(moves.y.min())), (float(moves.x.max()), float(moves.y.max()))
 
     def get_polygon_min_max(self, polygon):
         x_min, x_max, y_min, y_max = float('inf'), 0, float('inf'), 0
@@ -415,7 +1968,11 @@ class AdaptiveBedMesh(object):
 
         return num_horizontal_probes, num_vertical_probes
 
-    def get_probe_points(self, mesh_min, mesh_max):
+    def get_probe_points(self, mesh_min, mesh_max, stats=None):
+        """
+        The optional stats dict is filled with the predicted_interpolation_error, and the full_probe_count if fewer
+        points are probed, see reduce_probe_counts().
+        """
         horizontal_distance = mesh_max[0] - mesh_min[0]
         vertical_distance = mesh_max[1] - mesh_min[1]
 
@@ -426,6 +1983,16 @@ class AdaptiveBedMesh(object):
         # Apply limits to the number of points subject to the minimum points, as well as algorithm
         num_horizontal_probes, num_vertical_probes = self.apply_probe_point_limits(num_horizontal_probes, num_vertical_probes)
 
+        # Fewer points where the recent meshes show a flat enough bed
+        if self.probe_density_tolerance > 0:
+            full_probe_count = [num_horizontal_probes, num_vertical_probes]
+            (num_horizontal_probes, num_vertical_probes), predicted_error = self.reduce_probe_counts(
+                mesh_min, mesh_max, num_horizontal_probes, num_vertical_probes)
+            if stats is not None and predicted_error is not None:
+                stats['predicted_interpolation_error'] = predicted_error
+                if [num_horizontal_probes, num_vertical_probes] != full_probe_count:
+                    stats['full_probe_count'] = full_probe_count
+
         # Generate probe coordinates
         horizontal_probe_points = numpy.linspace(mesh_min[0], mesh_max[0], num_horizontal_probes)
         vertical_probe_points = numpy.linspace(mesh_min[1], mesh_max[1], num_vertical_probes)
@@ -445,6 +2012,1723 @@ class AdaptiveBedMesh(object):
 
         return (num_horizontal_probes, num_vertical_probes), probe_coordinates, relative_reference_index
 
+    def estimate_probe_time(self, probe_points):
+        """
+        Estimate how long BED_MESH_CALIBRATE takes to probe the points in the given order, from the [bed_mesh] and probe
+        speeds. Every move is assumed to run at its full speed, the acceleration is ignored.
+        :return: time in seconds
+        """
+        # Descend from the horizontal move Z until triggered, then each extra sample retracts and probes again
+        probe_time = self.bed_mesh_config_horizontal_move_z / self.probe_speed + (self.probe_samples - 1) * (
+            self.probe_sample_retract_dist / self.probe_lift_speed + self.probe_sample_retract_dist / self.probe_speed)
+        lift_time = self.bed_mesh_config_horizontal_move_z / self.probe_lift_speed
+
+        # Travel between the points at the horizontal move Z
+        x, y = numpy.array(probe_points, dtype=numpy.float64).reshape(-1, 2).T
+        travel_time = numpy.hypot(numpy.diff(x), numpy.diff(y)).sum() / self.bed_mesh_config_speed
+
+        return float(len(probe_points) * (probe_time + lift_time) + travel_time)
+
+
+class OccupancyGrid(object):
+    """
+    Bool raster of the printed footprint over an area. The cell cells[i, j] covers
+    [x_min + j * resolution, x_min + (j + 1) * resolution) along X, and the same with i along Y. Anything outside the
+    area is ignored.
+    """
+    __slots__ = ('area_min', 'area_max', 'resolution', 'cells')
+
+    def __init__(self, area_min, area_max, resolution):
+        self.area_min = area_min
+        self.area_max = area_max
+        self.resolution = resolution
+        shape = (int(math.ceil((area_max[1] - area_min[1]) / resolution)) + 1,
+                 int(math.ceil((area_max[0] - area_min[0]) / resolution)) + 1)
+        self.cells = numpy.zeros(shape, dtype=bool)
+
+    def add_points(self, x, y):
+        column = numpy.floor((numpy.asarray(x) - self.area_min[0]) / self.resolution).astype(numpy.intp)
+        row = numpy.floor((numpy.asarray(y) - self.area_min[1]) / self.resolution).astype(numpy.intp)
+        is_inside = (row >= 0) & (row < self.cells.shape[0]) & (column >= 0) & (column < self.cells.shape[1])
+        self.cells[row[is_inside], column[is_inside]] = True
+
+    def add_segments(self, x0, y0, x1, y1):
+        x0, y0, x1, y1 = (numpy.asarray(v, dtype=numpy.float64) for v in (x0, y0, x1, y1))
+        if len(x0) == 0:
+            return
+
+        # Sample every segment at half the resolution so that no cell along it is missed
+        counts = numpy.ceil(numpy.hypot(x1 - x0, y1 - y0) / (self.resolution / 2)).astype(numpy.intp) + 1
+        segment = numpy.repeat(numpy.arange(len(counts)), counts)
+        starts = numpy.cumsum(counts) - counts
+        t = (numpy.arange(len(segment)) - starts[segment]) / numpy.maximum(counts - 1, 1)[segment]
+
+        self.add_points(x0[segment] + (x1 - x0)[segment] * t, y0[segment] + (y1 - y0)[segment] * t)
+
+    def add_polygon(self, polygon):
+        x, y = numpy.asarray(polygon, dtype=numpy.float64).reshape(-1, 2).T
+
+        # Even-odd rule on the centers of the cells, which leaves out polygons thinner than a cell
+        center_x = self.area_min[0] + (numpy.arange(self.cells.shape[1]) + 0.5) * self.resolution
+        center_y = self.area_min[1] + (numpy.arange(self.cells.shape[0]) + 0.5) * self.resolution
+        center_x, center_y = numpy.meshgrid(center_x, center_y)
+        is_inside = numpy.zeros(self.cells.shape, dtype=bool)
+        for xa, ya, xb, yb in zip(x, y, numpy.roll(x, 1), numpy.roll(y, 1)):
+            if ya == yb:
+                continue
+            is_crossing = ((ya > center_y) != (yb > center_y)) & (
+                center_x < xa + (center_y - ya) * (xb - xa) / (yb - ya))
+            is_inside ^= is_crossing
+        self.cells |= is_inside
+
+        # So the outline as well
+        self.add_segments(x, y, numpy.roll(x, 1), numpy.roll(y, 1))
+
+    def get_idle_points(self, points, spacing):
+        """
+        :param spacing: (x, y) distance between the probe points
+        :return: the points with no occupied cell within the spacing along each axis, i.e. in the adjacent grid cells
+        """
+        idle_points = []
+        for x, y in points:
+            column_min = max(0, int(math.floor((x - spacing[0] - self.area_min[0]) / self.resolution)))
+            column_max = int(math.floor((x + spacing[0] - self.area_min[0]) / self.resolution))
+            row_min = max(0, int(math.floor((y - spacing[1] - self.area_min[1]) / self.resolution)))
+            row_max = int(math.floor((y + spacing[1] - self.area_min[1]) / self.resolution))
+            if not self.cells[row_min:row_max + 1, column_min:column_max + 1].any():
+                idle_points.append((x, y))
+
+        return idle_points
+
+    def to_json(self):
+        return {'area_min': list(self.area_min), 'area_max': list(self.area_max), 'resolution': self.resolution,
+                'cells': base64.b64encode(numpy.packbits(self.cells).tobytes()).decode('ascii')}
+
+    @classmethod
+    def from_json(cls, value):
+        occupancy = cls(tuple(value['area_min']), tuple(value['area_max']), value['resolution'])
+        cells = numpy.frombuffer(base64.b64decode(value['cells']), dtype=numpy.uint8)
+        occupancy.cells = numpy.unpackbits(cells, count=occupancy.cells.size).astype(bool).reshape(
+            occupancy.cells.shape)
+        return occupancy
+
+
+class LayerMoves(object):
+    """
+    Read only view of the extrude moves of one layer, in the order of execution.
+    """
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        # Convenience only, use the x and y arrays directly where possible
+        return zip(self.x.tolist(), self.y.tolist())
+
+
+class LayerVertices(object):
+    """
+    Extrude moves of all layers stored as contiguous X, Y, Z columns. The moves are grouped by layer, in the order each
+    layer is first printed, and offsets[i]:offsets[i + 1] is the slice of the i-th layer. Indexing by the layer height
+    gives a LayerMoves view without a copy.
+    """
+    __slots__ = ('x', 'y', 'z', 'layers', 'offsets', '_layer_index')
+
+    def __init__(self, x, y, z):
+        x = numpy.frombuffer(x, dtype=numpy.float64)
+        y = numpy.frombuffer(y, dtype=numpy.float64)
+        z = numpy.frombuffer(z, dtype=numpy.float64)
+
+        # Group the moves by layer, a stable sort keeps the order of execution within each layer
+        layers, first_index, inverse, counts = numpy.unique(z, return_index=True, return_inverse=True,
+                                                            return_counts=True)
+        layer_order = numpy.argsort(first_index)
+        rank = numpy.empty_like(layer_order)
+        rank[layer_order] = numpy.arange(len(layer_order))
+        order = numpy.argsort(rank[inverse], kind='stable')
+
+        self.x = x[order]
+        self.y = y[order]
+        self.z = z[order]
+        self.layers = layers[layer_order].tolist()
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(counts[layer_order])]).astype(numpy.intp)
+        self._layer_index = {layer: i for i, layer in enumerate(self.layers)}
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __contains__(self, layer):
+        return layer in self._layer_index
+
+    def __getitem__(self, layer):
+        i = self._layer_index[layer]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return LayerMoves(self.x[start:end], self.y[start:end])
+
+    def keys(self):
+        return list(self.layers)
+
+    def items(self):
+        return [(layer, self[layer]) for layer in self.layers]
+
+
+class LayerIndex(object):
+    """
+    Layer extents of the analysed part of a gcode file, with the byte offset where each layer starts, and where to
+    continue the analysis (next) if it was stopped early. Queries with a different fade height or the first layer only
+    are answered from the index when the analysed part covers them, and the analysis otherwise continues from next
+    instead of the start of the file.
+
+    The offsets are line starts (python backend) or chunk starts (numpy backend). With a non monotonic Z (e.g.
+    sequential printing), the answer is the same as the analysis from scratch, a layer revisited later is merged only
+    once the analysis reaches it.
+    """
+    __slots__ = ('layer_extents', 'offsets', 'next')
+
+    def __init__(self, layer_extents=None, offsets=None, next=None):
+        # {layer_height: [x_min, y_min, x_max, y_max]} in the order of printing
+        self.layer_extents = dict() if layer_extents is None else layer_extents
+        # {layer_height: byte offset}
+        self.offsets = dict() if offsets is None else offsets
+        # {'pos', 'absolute', 'X', 'Y', 'Z', 'z'}: the modal state at pos, and the layer height that stopped the
+        #   analysis. None once the whole file is analysed
+        self.next = self.get_initial_next() if next is None and layer_extents is None else next
+
+    @staticmethod
+    def get_initial_next():
+        # Nothing analysed yet, start from the beginning of the file
+        return {'pos': 0, 'absolute': True, 'X': 0., 'Y': 0., 'Z': 0., 'z': -math.inf}
+
+    def is_empty(self):
+        return not self.layer_extents and self.next is not None and self.next['pos'] == 0
+
+    def reset(self):
+        self.layer_extents.clear()
+        self.offsets.clear()
+        self.next = self.get_initial_next()
+
+    def covers(self, fade_end, first_layer_only=False):
+        if self.next is None:
+            return True
+        if first_layer_only:
+            return len(self.layer_extents) > 0
+        return 0 < fade_end <= self.next['z']
+
+    def query(self, fade_end, first_layer_only=False):
+        """
+        :return: {layer_height: [x_min, y_min, x_max, y_max]}, as analysed from scratch with the fade_end
+        """
+        layer_extents = dict()
+        for layer, extents in self.layer_extents.items():
+            if 0 < fade_end <= layer:
+                break
+            layer_extents[layer] = list(extents)
+            if first_layer_only:
+                break
+
+        return layer_extents
+
+    def to_json(self):
+        return {'layers': [[layer, self.offsets.get(layer)] + list(extents)
+                           for layer, extents in self.layer_extents.items()],
+                'next': self.next}
+
+    @classmethod
+    def from_json(cls, value):
+        layer_extents = {layer: extents for layer, offset, *extents in value['layers']}
+        offsets = {layer: offset for layer, offset, *extents in value['layers']}
+        return cls(layer_extents, offsets, value['next'])
+
+
+class GcodeAnalysisCache(object):
+    """
+    Persistent LRU cache of the gcode analysis result, stored as a JSON file. Each entry is keyed by the gcode file path
+    and the analysis settings, and is invalidated once the file size or modification time changes. Without a
+    cache_filepath, the entries are kept in memory only.
+
+    The results (along with the occupancy grids of the idle probe points) and the layer indexes are evicted separately,
+    up to max_entries and max_layer_indexes (max_entries by default). A cache hit only updates the LRU order in memory,
+    it's written along with the next change.
+
+    Other processes (e.g. `python -m adaptive_bed_mesh analyze --cache`) may write to the same file: it's read again
+    once it changed, and merged before each write. A copy of an analysed file, uploaded to another path or with another
+    modification time, is found by the content hash of the whole file (see get_content_hash()).
+    """
+    # Size of the blocks the gcode file is hashed in
+    content_hash_block_size = 1024 * 1024
+
+    def __init__(self, cache_filepath, max_entries, max_layer_indexes=None):
+        self.cache_filepath = cache_filepath
+        self.max_entries = max_entries
+        self.max_layer_indexes = max_entries if max_layer_indexes is None else max_layer_indexes
+        self.lock = threading.Lock()
+        self._entries = None
+        # (size, mtime_ns) of the cache file when last read or written
+        self._version = None
+        # {(real path, size, mtime_ns): content hash}
+        self._content_hashes = dict()
+
+    @staticmethod
+    def get_key(gcode_filepath, settings):
+        return json.dumps([os.path.realpath(gcode_filepath), settings], sort_keys=True)
+
+    def get_content_hash(self, gcode_filepath, stat):
+        """
+        Hash of the size and the content of the file. It's only computed once an entry of the same size may be a copy,
+        and kept for the size and modification time of the file.
+        """
+        key = (os.path.realpath(gcode_filepath), stat.st_size, stat.st_mtime_ns)
+        content_hash = self._content_hashes.get(key)
+        if content_hash is None:
+            content_hash = hashlib.sha1(str(stat.st_size).encode())
+            with open(gcode_filepath, 'rb') as fp:
+                for block in iter(lambda: fp.read(self.content_hash_block_size), b''):
+                    content_hash.update(block)
+            content_hash = self._content_hashes[key] = content_hash.hexdigest()
+
+        return content_hash
+
+    def _load(self):
+        if self.cache_filepath is None:
+            if self._entries is None:
+                self._entries = dict()
+            return self._entries
+
+        try:
+            stat = os.stat(self.cache_filepath)
+            version = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            version = None
+
+        if self._entries is None or version != self._version:
+            try:
+                with open(self.cache_filepath, 'r') as fp:
+                    entries = json.load(fp)
+            except (OSError, ValueError):
+                # Missing or corrupted cache, start over
+                entries = dict()
+
+            # Keep the most recent use of each entry
+            for key, entry in (self._entries or dict()).items():
+                other = entries.get(key)
+                if other is None or other['last_used'] < entry['last_used']:
+                    entries[key] = entry
+            self._entries = entries
+            self._version = version
+
+        return self._entries
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+
+        with open(self.cache_filepath + '.lock', 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            yield
+
+    def _save(self):
+        if self.cache_filepath is None:
+            return
+
+        try:
+            with self._file_lock():
+                # Merge what other processes wrote in the meantime
+                self._load()
+                self._evict()
+
+                # Write to a temporary file first so a power loss won't leave a truncated cache behind
+                temp_filepath = self.cache_filepath + '.tmp'
+                with open(temp_filepath, 'w') as fp:
+                    json.dump(self._entries, fp)
+                os.replace(temp_filepath, self.cache_filepath)
+
+                stat = os.stat(self.cache_filepath)
+                self._version = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+
+    def _find(self, gcode_filepath, stat, settings):
+        """
+        :return: key, entry of the file, or of a copy of the file with the same content hash. None, None if not found
+        """
+        entries = self._load()
+        key = self.get_key(gcode_filepath, settings)
+        entry = entries.get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return key, entry
+
+        # Only hash the file if an entry of the same size at another path may be a copy. The entry of this path is
+        #   stale, the file has changed since
+        candidates = [(k, e) for k, e in entries.items() if k != key and e['size'] == stat.st_size
+                      and 'content_hash' in e and json.loads(k)[1] == settings]
+        if candidates:
+            content_hash = self.get_content_hash(gcode_filepath, stat)
+            for k, e in candidates:
+                if e['content_hash'] == content_hash:
+                    return k, e
+
+        return None, None
+
+    def get(self, gcode_filepath, settings):
+        try:
+            stat = os.stat(gcode_filepath)
+        except OSError:
+            return None
+
+        key = self.get_key(gcode_filepath, settings)
+        with self.lock:
+            found_key, entry = self._find(gcode_filepath, stat, settings)
+            if entry is None:
+                # The file has changed since the last analysis
+                if self._load().pop(key, None) is not None:
+                    self._save()
+                return None
+
+            if found_key != key:
+                # A copy of the file, remember it under this path
+                entry = self._entries[key] = dict(entry, mtime_ns=stat.st_mtime_ns, last_used=time.time())
+                self._save()
+            else:
+                entry['last_used'] = time.time()
+
+            return entry
+
+    def contains(self, gcode_filepath, settings):
+        # Check for a valid entry without touching the LRU order
+        try:
+            stat = os.stat(gcode_filepath)
+        except OSError:
+            return False
+
+        with self.lock:
+            return self._find(gcode_filepath, stat, settings)[1] is not None
+
+    def put(self, gcode_filepath, settings, mesh_min, mesh_max, layer_extents):
+        self._put(gcode_filepath, settings, {
+            'mesh_min': list(mesh_min),
+            'mesh_max': list(mesh_max),
+            'layer_extents': [[z] + list(extents) for z, extents in layer_extents.items()],
+        })
+
+    def get_layer_index(self, gcode_filepath, settings):
+        """
+        :return: LayerIndex of the file, or None
+        """
+        entry = self.get(gcode_filepath, dict(settings, layer_index=True))
+        return None if entry is None else LayerIndex.from_json(entry['layer_index'])
+
+    def put_layer_index(self, gcode_filepath, settings, layer_index):
+        self._put(gcode_filepath, dict(settings, layer_index=True), {'layer_index': layer_index.to_json()})
+
+    def get_occupancy(self, gcode_filepath, settings):
+        """
+        :return: OccupancyGrid of the file, or None
+        """
+        entry = self.get(gcode_filepath, dict(settings, occupancy=True))
+        return None if entry is None else OccupancyGrid.from_json(entry['occupancy'])
+
+    def put_occupancy(self, gcode_filepath, settings, occupancy):
+        self._put(gcode_filepath, dict(settings, occupancy=True), {'occupancy': occupancy.to_json()})
+
+    def _put(self, gcode_filepath, settings, values):
+        stat = os.stat(gcode_filepath)
+
+        key = self.get_key(gcode_filepath, settings)
+        with self.lock:
+            entries = self._load()
+            entries[key] = dict(values, size=stat.st_size, mtime_ns=stat.st_mtime_ns, last_used=time.time(),
+                                content_hash=self.get_content_hash(gcode_filepath, stat))
+            self._evict()
+            self._save()
+
+    def get_entries(self):
+        with self.lock:
+            return dict(self._load())
+
+    def update(self, entries):
+        """
+        Merge the entries of another cache, e.g. analysed offline by `python -m adaptive_bed_mesh analyze`.
+        """
+        with self.lock:
+            self._load().update(entries)
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        # Evict the least recently used results and layer indexes
+        entries = self._entries
+        for is_layer_index, max_entries in [(False, self.max_entries), (True, self.max_layer_indexes)]:
+            keys = sorted((key for key, entry in entries.items() if ('layer_index' in entry) == is_layer_index),
+                          key=lambda k: entries[k]['last_used'])
+            for key in keys[:max(0, len(keys) - max_entries)]:
+                entries.pop(key)
+
+
+class ReferenceMeshStore(object):
+    """
+    When and at which bed temperature each reference bed_mesh profile was probed, stored as a JSON file. Klipper keeps
+    the profile itself.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def load(self):
+        try:
+            with open(self.filepath, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return dict()
+
+    def put(self, profile_name, probe_time, bed_temperature):
+        entries = self.load()
+        entries[profile_name] = {'time': probe_time, 'bed_temperature': bed_temperature}
+
+        temp_filepath = self.filepath + '.tmp'
+        with open(temp_filepath, 'w') as fp:
+            json.dump(entries, fp)
+        os.replace(temp_filepath, self.filepath)
+
+
+class MeshHistoryStore(object):
+    """
+    The recent meshes probed at the full density (heights, area and bed temperature), stored as a JSON file, the oldest
+    first. Each printer has its own file next to the gcode analysis cache.
+    """
+    mesh_params_keys = ['min_x', 'max_x', 'min_y', 'max_y', 'x_count', 'y_count']
+
+    def __init__(self, filepath, max_entries):
+        self.filepath = filepath
+        self.max_entries = max_entries
+
+    def load(self):
+        try:
+            with open(self.filepath, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return []
+
+    def put(self, probe_time, bed_temperature, points, mesh_params):
+        entries = self.load()
+        entries.append({'time': probe_time,
+                        'bed_temperature': bed_temperature,
+                        'mesh_params': {key: mesh_params[key] for key in self.mesh_params_keys},
+                        # A micron is well below the probe repeatability
+                        'points': [[round(z, 4) for z in row] for row in points]})
+        del entries[:-self.max_entries]
+
+        temp_filepath = self.filepath + '.tmp'
+        with open(temp_filepath, 'w') as fp:
+            json.dump(entries, fp)
+        os.replace(temp_filepath, self.filepath)
+
+
+class UnsupportedGcodeError(Exception):
+    # Gcode the numpy backend can't analyse, the python backend takes over
+    pass
+
+
+class PreAnalysisInterrupted(Exception):
+    pass
+
+
+class GcodePreAnalyser(object):
+    """
+    Watch the virtual sdcard directory and analyse new or modified gcode files one at a time in a low priority worker
+    thread, so the result is already cached when the print starts. The directory is polled at a low frequency, inotify
+    (where available) triggers an early scan. No work is started while printing, and the file being analysed is
+    abandoned and queued again once a print starts.
+    """
+    # inotify(7) constants
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+
+    def __init__(self, adaptive_bed_mesh, scan_interval):
+        self.adaptive_bed_mesh = adaptive_bed_mesh
+        self.scan_interval = scan_interval
+        self.check_interval = 1.
+        self.throttle_period = 0.05
+        self.throttle_sleep = 0.01
+
+        self.queue = collections.deque()
+        self.known_files = dict()
+        self.current_file = None
+        self.completed_files = 0
+        self.worker = None
+        self.is_printing = threading.Event()
+        self.next_scan_time = 0.
+        self.last_throttle_time = 0.
+
+        self.reactor = None
+        self.inotify_fd = None
+
+    def handle_ready(self):
+        self.reactor = self.adaptive_bed_mesh.printer.get_reactor()
+        self.inotify_fd = self.open_inotify(self.adaptive_bed_mesh.virtual_sdcard_path)
+        if self.inotify_fd is not None:
+            self.reactor.register_fd(self.inotify_fd, self.handle_inotify)
+        self.reactor.register_timer(self.handle_timer, self.reactor.NOW)
+
+    @classmethod
+    def open_inotify(cls, path):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd, path.encode(), cls.IN_CLOSE_WRITE | cls.IN_MOVED_TO) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError, TypeError):
+            # Not Linux, fallback to polling
+            return None
+
+    def handle_inotify(self, eventtime):
+        # Drain the events, then scan a bit later to let the upload settle
+        try:
+            while os.read(self.inotify_fd, 4096):
+                pass
+        except OSError:
+            pass
+        self.next_scan_time = min(self.next_scan_time, eventtime + self.check_interval)
+
+    def handle_timer(self, eventtime):
+        state = self.adaptive_bed_mesh.print_stats.get_status(eventtime)['state']
+        if state in ('printing', 'paused'):
+            self.is_printing.set()
+        else:
+            self.is_printing.clear()
+
+            if eventtime >= self.next_scan_time:
+                self.scan_directory()
+                self.next_scan_time = eventtime + self.scan_interval
+
+            if self.queue and (self.worker is None or not self.worker.is_alive()):
+                self.worker = threading.Thread(target=self.analyse, args=(self.queue.popleft(),),
+                                               name='adaptive_bed_mesh_pre_analysis', daemon=True)
+                self.worker.start()
+
+        return eventtime + self.check_interval
+
+    def scan_directory(self):
+        settings = self.adaptive_bed_mesh.get_gcode_analysis_settings()
+        cache = self.adaptive_bed_mesh.gcode_analysis_cache
+
+        gcode_files = dict()
+        for root, dirs, files in os.walk(self.adaptive_bed_mesh.virtual_sdcard_path):
+            for filename in files:
+                if not filename.lower().endswith(gcode_file_extensions):
+                    continue
+                gcode_filepath = os.path.join(root, filename)
+                try:
+                    stat = os.stat(gcode_filepath)
+                except OSError:
+                    continue
+                gcode_files[gcode_filepath] = (stat.st_size, stat.st_mtime_ns)
+
+        # Queue the new or modified files, the most recent first. No point analysing more files than the cache can hold
+        changed_files = [f for f in gcode_files
+                         if self.known_files.get(f) != gcode_files[f] and f != self.current_file and f not in self.queue]
+        changed_files.sort(key=lambda f: gcode_files[f][1], reverse=True)
+        for gcode_filepath in changed_files[:cache.max_entries]:
+            if not cache.contains(gcode_filepath, settings):
+                self.queue.append(gcode_filepath)
+
+        self.known_files = gcode_files
+
+    def checkpoint(self):
+        if self.is_printing.is_set():
+            raise PreAnalysisInterrupted()
+
+        # Give up the CPU (and GIL) regularly
+        now = time.monotonic()
+        if now - self.last_throttle_time > self.throttle_period:
+            time.sleep(self.throttle_sleep)
+            self.last_throttle_time = time.monotonic()
+
+    def analyse(self, gcode_filepath):
+        # Lower the priority of this thread only (Linux)
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        self.current_file = gcode_filepath
+        try:
+            self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, checkpoint=self.checkpoint)
+            self.completed_files += 1
+        except PreAnalysisInterrupted:
+            self.queue.appendleft(gcode_filepath)
+        except Exception:
+            logging.exception('AdaptiveBedMesh: Failed to pre-analyse %s', gcode_filepath)
+        finally:
+            self.current_file = None
+
+    def get_status(self):
+        if self.is_printing.is_set():
+            state = 'paused'
+        elif self.current_file is not None:
+            state = 'analysing'
+        else:
+            state = 'idle'
+
+        return {'state': state,
+                'queue_depth': len(self.queue),
+                'current_file': self.current_file,
+                'completed_files': self.completed_files,
+                'inotify': self.inotify_fd is not None}
+
+
+class CalibrationProfiler(object):
+    """
+    cProfile and tracemalloc capture of a calibration. A cProfile profiler only sees the thread that enabled it, so the
+    functions handed to worker threads are wrapped to be profiled as well. The worker processes of the parallel gcode
+    analysis are not profiled.
+    """
+    memory_statistics_count = 25
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+        self.is_tracing_memory = False
+        self.memory_snapshot = None
+        self.peak_memory = 0
+        self.stats = None
+
+    def start(self):
+        # Leave the memory tracing alone if someone else started it
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.is_tracing_memory = True
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.memory_snapshot = tracemalloc.take_snapshot()
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        if self.is_tracing_memory:
+            tracemalloc.stop()
+            self.is_tracing_memory = False
+
+    @contextmanager
+    def paused(self):
+        self.profile.disable()
+        try:
+            yield
+        finally:
+            self.profile.enable()
+
+    def wrap(self, func):
+        def profiled(*args):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows a single profiler at a time
+                return func(*args)
+
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.thread_profiles.append(profile)
+
+        return profiled
+
+    def save(self, filename_prefix):
+        """
+        Write the merged cProfile stats to <filename_prefix>.prof, and the top allocations to
+        <filename_prefix>-memory.txt.
+        :return: path of the .prof file
+        """
+        self.stats = pstats.Stats(self.profile)
+        with self.lock:
+            for profile in self.thread_profiles:
+                self.stats.add(profile)
+
+        profile_filepath = filename_prefix + '.prof'
+        self.stats.dump_stats(profile_filepath)
+
+        with open(filename_prefix + '-memory.txt', 'w') as fp:
+            fp.write('Peak traced memory: {} bytes\n'.format(self.peak_memory))
+            for statistic in self.memory_snapshot.statistics('lineno')[:self.memory_statistics_count]:
+                fp.write('{}\n'.format(statistic))
+
+        return profile_filepath
+
+    def format_summary(self, count=5):
+        # The functions that spent the most time in their own code
+        entries = sorted(self.stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:count]
+        lines = ['{:.3f}s self {:.3f}s total {}:{}({})'.format(tt, ct, os.path.basename(filename), line, name)
+                 for (filename, line, name), (cc, nc, tt, ct, callers) in entries]
+        lines.append('Peak traced memory {:.1f}MB'.format(self.peak_memory / 1e6))
+        return lines
+
+
+class OfflineConfig(object):
+    """
+    Stand-in of the Klipper config wrapper of one section, backed by a configparser, to build AdaptiveBedMesh outside
+    of Klipper. Only the getters the plugin uses are implemented, with the same validation.
+    """
+    sentinel = object()
+
+    def __init__(self, fileconfig, section, printer):
+        self.fileconfig = fileconfig
+        self.section = section
+        self.printer = printer
+
+    @classmethod
+    def read_sections(cls, config_filepath):
+        """
+        Read a printer.cfg (or a snippet of it). The [include] sections are not followed.
+        :return: {section: {option: value}}
+        """
+        fileconfig = configparser.RawConfigParser(strict=False, inline_comment_prefixes=('#', ';'))
+        with open(config_filepath, 'r') as fp:
+            fileconfig.read_file(fp)
+        return {section: dict(fileconfig.items(section)) for section in fileconfig.sections()}
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.section
+
+    def has_section(self, section):
+        return self.fileconfig.has_section(section)
+
+    def getsection(self, section):
+        return OfflineConfig(self.fileconfig, section, self.printer)
+
+    def _get(self, parser, option, default, minval=None, maxval=None, above=None, below=None):
+        if not self.fileconfig.has_option(self.section, option):
+            if default is self.sentinel:
+                raise configparser.Error("Option '{}' in section '{}' must be specified".format(option, self.section))
+            return default
+
+        value = self.fileconfig.get(self.section, option)
+        try:
+            value = parser(value)
+        except ValueError:
+            raise configparser.Error("Unable to parse option '{}' in section '{}'".format(option, self.section))
+
+        if (minval is not None and value < minval) or (maxval is not None and value > maxval) or \
+                (above is not None and value <= above) or (below is not None and value >= below):
+            raise configparser.Error("Option '{}' in section '{}' is out of range".format(option, self.section))
+        return value
+
+    def get(self, option, default=sentinel):
+        return self._get(str, option, default)
+
+    def getint(self, option, default=sentinel, minval=None, maxval=None):
+        return self._get(int, option, default, minval, maxval)
+
+    def getfloat(self, option, default=sentinel, minval=None, maxval=None, above=None, below=None):
+        return self._get(float, option, default, minval, maxval, above, below)
+
+    def getboolean(self, option, default=sentinel):
+        def parse_boolean(value):
+            if value.strip().lower() not in configparser.RawConfigParser.BOOLEAN_STATES:
+                raise ValueError(value)
+            return configparser.RawConfigParser.BOOLEAN_STATES[value.strip().lower()]
+        return self._get(parse_boolean, option, default)
+
+    def getchoice(self, option, choices, default=sentinel):
+        value = self.get(option, default)
+        if value not in choices:
+            raise configparser.Error("Choice '{}' for option '{}' in section '{}' is not a valid choice".format(
+                value, option, self.section))
+        return choices[value]
+
+    def getfloatlist(self, option, default=sentinel, sep=',', count=None):
+        def parse_list(value):
+            values = [float(v) for v in value.split(sep) if v.strip()]
+            if count is not None and len(values) != count:
+                raise ValueError(value)
+            return values
+        return self._get(parse_list, option, default)
+
+
+class OfflinePrinter(object):
+    """
+    The subset of the Klipper printer AdaptiveBedMesh looks up when built offline. No print is loaded, and the gcode
+    commands and event handlers are registered nowhere.
+    """
+    class NullObject(object):
+        objects = []
+        excluded_objects = []
+
+        def register_command(self, *args, **kwargs):
+            pass
+
+    sentinel = object()
+
+    def __init__(self):
+        self.objects = {name: self.NullObject() for name in ['gcode', 'exclude_object', 'print_stats', 'bed_mesh']}
+
+    def lookup_object(self, name, default=sentinel):
+        if name not in self.objects:
+            if default is self.sentinel:
+                raise configparser.Error("Unknown object '{}'".format(name))
+            return default
+        return self.objects[name]
+
+    def register_event_handler(self, event, callback):
+        pass
+
+    def get_start_args(self):
+        return {}
+
+
+class MeatPackDecoder(object):
+    """
+    Streaming decoder of MeatPack packed gcode. Each byte holds two characters as 4 bit codes (the low nibble first),
+    or 0b1111 for a character that couldn't be packed, which then follows as a full byte. Two 0xFF bytes signal a
+    command byte that enables or disables the packing and the no spaces mode. The spaces removed by the no spaces mode
+    are put back between the parameters of the command lines.
+
+    The full characters are never 0xFF, and a packed 0xFF is followed by two of them, so two 0xFF bytes are always a
+    signal. The bytes up to the next signal are decoded at once with numpy (see decode_packed()). The signal bytes, and
+    the bytes of a packed byte split across two decode() calls, are decoded one at a time.
+    """
+    lookup = b'0123456789. \nGX'
+    signal_byte = 0xFF
+    signal = b'\xff\xff'
+    commands = {'enable_packing': 0xFB, 'disable_packing': 0xFA, 'reset_all': 0xF9, 'query_config': 0xF8,
+                'enable_no_spaces': 0xF7, 'disable_no_spaces': 0xF6}
+    full_char_code = 0xF
+    newline_code = lookup.index(b'\n')
+
+    def __init__(self):
+        self.is_packing = False
+        self.is_no_spaces = False
+        self.num_signal_bytes = 0
+        self.num_full_chars = 0
+        self.second_char = None
+        # The partial line at the end of the decoded data, up to the next decode()
+        self.carry = b''
+
+    def get_lookup(self):
+        return self.lookup if not self.is_no_spaces else self.lookup.replace(b' ', b'E')
+
+    def unpack(self, byte):
+        # :return: (first char, second char), None for a full character that follows
+        lookup = self.get_lookup()
+        first, second = byte & 0xF, byte >> 4
+        return (None if first == 0xF else lookup[first]), (None if second == 0xF else lookup[second])
+
+    def handle_command(self, command):
+        if command == self.commands['enable_packing']:
+            self.is_packing = True
+        elif command == self.commands['disable_packing']:
+            self.is_packing = False
+        elif command == self.commands['reset_all']:
+            self.is_packing = False
+            self.is_no_spaces = False
+        elif command == self.commands['enable_no_spaces']:
+            self.is_no_spaces = True
+        elif command == self.commands['disable_no_spaces']:
+            self.is_no_spaces = False
+
+    def decode(self, data):
+        """
+        :return: the decoded complete lines of data
+        """
+        output = bytearray(self.carry)
+        pos = 0
+        while pos < len(data):
+            if self.num_signal_bytes == 0 and self.num_full_chars == 0:
+                end = data.find(self.signal, pos)
+                if end < 0:
+                    # The last byte may be the first byte of a signal
+                    end = len(data) - 1 if data.endswith(self.signal[:1]) else len(data)
+                if pos < end:
+                    if not self.is_packing:
+                        output += data[pos:end]
+                        pos = end
+                        continue
+                    pos = self.decode_packed(data, pos, end, output)
+                    if pos == end:
+                        continue
+
+            self.decode_signal_or_byte(data[pos], output)
+            pos += 1
+
+        end = output.rfind(b'\n') + 1
+        self.carry = bytes(output[end:])
+        return self.add_spaces(bytes(output[:end]))
+
+    def flush(self):
+        carry, self.carry = self.carry, b''
+        return self.add_spaces(carry)
+
+    def decode_signal_or_byte(self, byte, output):
+        if byte == self.signal_byte:
+            if self.num_signal_bytes:
+                self.num_signal_bytes = 2
+            else:
+                self.num_signal_bytes = 1
+            return
+        if self.num_signal_bytes == 2:
+            self.handle_command(byte)
+            self.num_signal_bytes = 0
+            return
+        if self.num_signal_bytes == 1:
+            # A single 0xFF is a packed byte of two full characters
+            self.num_signal_bytes = 0
+            self.decode_byte(self.signal_byte, output)
+        self.decode_byte(byte, output)
+
+    def decode_packed(self, data, pos, endpos, output):
+        """
+        Decode the packed bytes of data[pos:endpos] that start at pos, where no full character is pending.
+        :return: the position of the first byte left, a packed byte whose full characters are beyond endpos
+        """
+        codes = numpy.frombuffer(data, dtype=numpy.uint8, count=endpos - pos, offset=pos)
+        num_codes = len(codes)
+        first, second = codes & 0xF, codes >> 4
+        is_first_full = first == self.full_char_code
+        # A newline ends the byte
+        has_second = first != self.newline_code
+        is_second_full = has_second & (second == self.full_char_code)
+        step = 1 + is_first_full.astype(numpy.intp) + is_second_full
+
+        # The packed bytes are the chain of steps from the first byte, marked by pointer jumping: after each round the
+        #   bytes less than twice as many steps away are marked
+        is_packed = numpy.zeros(num_codes + 1, dtype=bool)
+        is_packed[0] = True
+        jump = numpy.append(numpy.minimum(numpy.arange(num_codes) + step, num_codes), num_codes)
+        num_steps = 1
+        while num_steps < num_codes:
+            is_packed[jump[numpy.flatnonzero(is_packed)]] = True
+            jump = jump[jump]
+            num_steps *= 2
+        packed = numpy.flatnonzero(is_packed[:num_codes])
+
+        # The last packed byte may lack its full characters
+        endpos = pos + num_codes
+        if len(packed) and packed[-1] + step[packed[-1]] > num_codes:
+            endpos = pos + int(packed[-1])
+            packed = packed[:-1]
+
+        lookup = numpy.frombuffer(self.get_lookup() + b'\0', dtype=numpy.uint8)
+        padded_codes = numpy.append(codes, numpy.zeros(2, dtype=numpy.uint8))
+        first_chars = numpy.where(is_first_full[packed], padded_codes[packed + 1], lookup[first[packed]])
+        second_chars = numpy.where(is_second_full[packed], padded_codes[packed + 1 + is_first_full[packed]],
+                                   lookup[second[packed]])
+
+        has_second = has_second[packed]
+        sizes = 1 + has_second
+        offsets = numpy.cumsum(sizes) - sizes
+        chars = numpy.empty(int(sizes.sum()), dtype=numpy.uint8)
+        chars[offsets] = first_chars
+        chars[offsets[has_second] + 1] = second_chars[has_second]
+        output += chars.tobytes()
+
+        return endpos
+
+    def decode_byte(self, byte, output):
+        if not self.is_packing:
+            output.append(byte)
+        elif self.num_full_chars:
+            output.append(byte)
+            if self.second_char is not None:
+                output.append(self.second_char)
+                self.second_char = None
+            self.num_full_chars -= 1
+        else:
+            first, second = self.unpack(byte)
+            if first is None:
+                self.num_full_chars += 1
+                if second is None:
+                    self.num_full_chars += 1
+                else:
+                    self.second_char = second
+            else:
+                output.append(first)
+                # A newline ends the byte
+                if first != ord('\n'):
+                    if second is None:
+                        self.num_full_chars += 1
+                    else:
+                        output.append(second)
+
+    @staticmethod
+    def add_spaces(text):
+        # G1X10Y10E.5 to G1 X10 Y10 E.5: a space before each capital letter that follows a digit or a period, in the
+        #   command lines up to their comment. Lines with spaces are left as is
+        chars = numpy.frombuffer(text, dtype=numpy.uint8)
+        if len(chars) < 2:
+            return text
+
+        is_newline = chars == ord('\n')
+        line = numpy.cumsum(is_newline) - is_newline
+        line_starts = numpy.concatenate(([0], numpy.flatnonzero(is_newline) + 1))
+        padded_chars = numpy.append(chars, numpy.zeros(2, dtype=numpy.uint8))
+        first, second = padded_chars[line_starts], padded_chars[line_starts + 1]
+        is_command_line = numpy.isin(first, numpy.frombuffer(b'GMT', dtype=numpy.uint8)) & (second >= ord('0')) & (
+            second <= ord('9'))
+
+        is_semicolon = chars == ord(';')
+        num_semicolons = numpy.cumsum(is_semicolon)
+        is_comment = num_semicolons > (num_semicolons - is_semicolon)[line_starts[line]]
+
+        is_param = (chars >= ord('A')) & (chars <= ord('Z'))
+        is_param[1:] &= ((chars[:-1] >= ord('0')) & (chars[:-1] <= ord('9'))) | (chars[:-1] == ord('.'))
+        is_param[0] = False
+        positions = numpy.flatnonzero(is_param & is_command_line[line] & ~is_comment)
+        if len(positions) == 0:
+            return text
+        return numpy.insert(chars, positions, ord(' ')).tobytes()
+
+
+@contextmanager
+def open_gcode_mmap(gcode_filepath):
+    """
+    Memory map the gcode file read only, so the regex engine scans the raw bytes without reading or decoding the file.
+    An empty file (which can't be mapped) gives b''.
+    """
+    with open(gcode_filepath, 'rb') as fp:
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            data = None
+
+    if data is None:
+        yield b''
+    else:
+        with data:
+            yield data
+
+
+def get_gcode_format(gcode_filepath):
+    """
+    :return: 'gzip', 'bgcode' (binary gcode) or 'text', by the magic number of the file
+    """
+    with open(gcode_filepath, 'rb') as fp:
+        magic = fp.read(4)
+
+    if magic.startswith(b'\x1f\x8b'):
+        return 'gzip'
+    if magic == b'GCDE':
+        return 'bgcode'
+    return 'text'
+
+
+@contextmanager
+def open_gcode_blocks(gcode_filepath, block_size):
+    """
+    Open the gcode file as an iterator of (pos, data) blocks of gcode text, each ends at a line boundary and pos is its
+    offset in the text. A text file is memory mapped as a single block. A gzip or binary gcode file is decompressed one
+    block of about block_size bytes at a time as the iterator advances, the whole text is never held in memory.
+    """
+    gcode_format = get_gcode_format(gcode_filepath)
+    if gcode_format == 'text':
+        with open_gcode_mmap(gcode_filepath) as data:
+            yield iter([(0, data)])
+        return
+
+    with open(gcode_filepath, 'rb') as fp:
+        if gcode_format == 'gzip':
+            chunks = iter_gzip_chunks(fp, block_size)
+        else:
+            chunks = iter_bgcode_chunks(fp)
+
+        with closing(iter_line_blocks(chunks, block_size)) as blocks:
+            yield blocks
+
+
+def iter_gzip_chunks(fp, size):
+    with gzip.GzipFile(fileobj=fp) as gzip_file:
+        for chunk in iter(lambda: gzip_file.read(size), b''):
+            yield chunk
+
+
+def iter_bgcode_chunks(fp):
+    # The gcode blocks hold 64 KiB of gcode text each
+    decoder = None
+    for block_type, encoding, payload in iter_bgcode_blocks(fp, [bgcode_block_types['gcode']]):
+        if encoding in bgcode_meatpack_encodings:
+            decoder = decoder or MeatPackDecoder()
+            yield decoder.decode(payload)
+        else:
+            yield payload
+
+    if decoder is not None:
+        yield decoder.flush()
+
+
+def iter_line_blocks(chunks, block_size):
+    """
+    Join the chunks of text into (pos, data) blocks of at least block_size bytes that end at line boundaries.
+    """
+    pos = 0
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size < block_size:
+            continue
+
+        data = b''.join(pending)
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            # A line longer than the block
+            pending = [data]
+            continue
+
+        yield pos, data[:end]
+        pos += end
+        pending = [data[end:]]
+        pending_size = len(pending[0])
+
+    if pending_size:
+        yield pos, b''.join(pending)
+
+
+def iter_bgcode_blocks(fp, block_types, until_type=None):
+    """
+    Read the blocks of a binary gcode file one at a time, and yield (block_type, encoding, payload) of the block types
+    asked for with the payload decompressed. The other blocks are skipped without being read, and the iteration stops
+    at the first block of until_type. The checksums are not verified.
+    """
+    header = fp.read(10)
+    if len(header) < 10 or header[:4] != b'GCDE':
+        raise ValueError('Not a binary gcode file')
+    _, _, checksum_type = struct.unpack('<4sIH', header)
+    checksum_size = 4 if checksum_type == 1 else 0
+
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return
+        block_type, compression, uncompressed_size = struct.unpack('<HHI', header)
+        compressed_size = uncompressed_size
+        if compression != 0:
+            compressed_size, = struct.unpack('<I', fp.read(4))
+
+        if block_type == until_type:
+            return
+
+        # Thumbnail blocks have the format, width and height as parameters, the other blocks have the encoding
+        params_size = 6 if block_type == bgcode_block_types['thumbnail'] else 2
+        if block_type not in block_types:
+            fp.seek(params_size + compressed_size + checksum_size, os.SEEK_CUR)
+            continue
+
+        params = fp.read(params_size)
+        payload = fp.read(compressed_size)
+        if len(payload) < compressed_size:
+            raise ValueError('Truncated binary gcode file')
+        fp.seek(checksum_size, os.SEEK_CUR)
+
+        yield block_type, struct.unpack_from('<H', params)[0], decompress_bgcode_block(payload, compression,
+                                                                                       uncompressed_size)
+
+
+def decompress_bgcode_block(payload, compression, uncompressed_size):
+    if compression == 0:
+        return payload
+    if compression == 1:
+        return zlib.decompress(payload)
+    if compression in bgcode_heatshrink_params:
+        return heatshrink_decompress(payload, *bgcode_heatshrink_params[compression], size=uncompressed_size)
+
+    raise ValueError('Unsupported binary gcode compression {}'.format(compression))
+
+
+def heatshrink_decompress(data, window_sz2, lookahead_sz2, size):
+    """
+    Decode heatshrink (LZSS) compressed data into size bytes. The bit stream is MSB first: a 1 bit and 8 bits for a
+    literal byte, or a 0 bit, window_sz2 bits of the distance - 1 and lookahead_sz2 bits of the count - 1 for a back
+    reference to the output. The window before the output starts with zeros.
+
+    Only the walk from one token to the next is sequential. Each byte of a back reference is then a copy of the byte
+    distance before it, which numpy resolves for all of them at once by pointer jumping.
+    """
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))
+    num_bits = len(bits)
+    backref_bits = 1 + window_sz2 + lookahead_sz2
+
+    # Indexing bytes is the fastest lookup from python
+    steps = numpy.where(bits, 9, backref_bits).astype(numpy.uint8).tobytes()
+    token_pos = []
+    add_token = token_pos.append
+    pos = 0
+    while pos < num_bits:
+        add_token(pos)
+        pos += steps[pos]
+    if pos > num_bits:
+        # The padding bits of the last byte
+        token_pos.pop()
+    token_pos = numpy.array(token_pos, dtype=numpy.intp)
+
+    padded_bits = numpy.append(bits, numpy.zeros(backref_bits, dtype=numpy.uint8)).astype(numpy.intp)
+
+    def read_fields(offset, num_field_bits):
+        # The num_field_bits bits value starting offset bits after each token
+        values = numpy.zeros(len(token_pos), dtype=numpy.intp)
+        for i in range(offset, offset + num_field_bits):
+            values <<= 1
+            values |= padded_bits[token_pos + i]
+        return values
+
+    is_literal = bits[token_pos].astype(bool)
+    counts = numpy.where(is_literal, 1, read_fields(1 + window_sz2, lookahead_sz2) + 1)
+    distances = read_fields(1, window_sz2) + 1
+
+    # The token of each output byte, up to the size
+    num_tokens = int(numpy.searchsorted(numpy.cumsum(counts), size)) + 1
+    token = numpy.repeat(numpy.arange(min(num_tokens, len(counts))), counts[:num_tokens])[:size]
+    index = numpy.arange(len(token))
+
+    output = numpy.zeros(len(token), dtype=numpy.uint8)
+    is_literal_byte = is_literal[token]
+    output[is_literal_byte] = read_fields(1, 8)[token[is_literal_byte]]
+
+    # Point each byte of a back reference to the byte it copies, until all point to a literal or the initial window
+    source = index - distances[token]
+    parent = numpy.where(is_literal_byte | (source < 0), index, source)
+    while True:
+        grandparent = parent[parent]
+        if numpy.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    return output[parent].tobytes()
+
+
+def read_bgcode_metadata_lines(gcode_filepath, deadline=None):
+    """
+    Read the metadata blocks at the start of a binary gcode file, without reading any gcode block.
+    :param deadline: optional time.monotonic() to stop at with a TimeoutError, checked between blocks
+    :return: the metadata as gcode comment lines `; key = value`, and the objects_info polygons as
+             EXCLUDE_OBJECT_DEFINE lines
+    """
+    lines = []
+    with open(gcode_filepath, 'rb') as fp:
+        for _, _, payload in iter_bgcode_blocks(fp, bgcode_metadata_block_types,
+                                                until_type=bgcode_block_types['gcode']):
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError('Timed out reading the gcode metadata')
+            for line in payload.decode('utf-8', errors='ignore').splitlines():
+                key, _, value = line.partition('=')
+                key, value = key.strip(), value.strip()
+                lines.append('; {} = {}'.format(key, value))
+
+                if key == 'objects_info':
+                    try:
+                        objects = json.loads(value)['objects']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    for obj in objects:
+                        if 'polygon' in obj:
+                            lines.append('EXCLUDE_OBJECT_DEFINE NAME={} POLYGON={}'.format(
+                                obj.get('name', '').replace(' ', '_'), json.dumps(obj['polygon'])))
+
+    return lines
+
+
+def create_offline_adaptive_bed_mesh(sections):
+    """
+    Build AdaptiveBedMesh outside of Klipper, from {section: {option: value}} as in printer.cfg. The gcode analysis
+    cache is kept in memory, see GcodeAnalysisCache.update() to merge it into a cache file.
+    """
+    fileconfig = configparser.RawConfigParser()
+    fileconfig.read_dict(sections)
+    if not fileconfig.has_section('adaptive_bed_mesh'):
+        fileconfig.add_section('adaptive_bed_mesh')
+    # No printer to pre-analyse the gcode files of
+    fileconfig.set('adaptive_bed_mesh', 'gcode_pre_analysis', 'False')
+
+    adaptive_bed_mesh = AdaptiveBedMesh(OfflineConfig(fileconfig, 'adaptive_bed_mesh', OfflinePrinter()))
+    adaptive_bed_mesh.gcode_analysis_cache = GcodeAnalysisCache(None, 1024)
+    return adaptive_bed_mesh
+
+
+def find_gcode_files(paths):
+    # Files as given, and the gcode files under the directories in the order of their paths
+    gcode_filepaths = []
+    for path in paths:
+        if not os.path.isdir(path):
+            gcode_filepaths.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            gcode_filepaths.extend(os.path.join(root, filename) for filename in sorted(files)
+                                   if filename.lower().endswith(gcode_file_extensions))
+
+    return gcode_filepaths
+
+
+# The AdaptiveBedMesh of each offline analysis worker process
+_offline_adaptive_bed_mesh = None
+
+
+def init_offline_worker(sections):
+    global _offline_adaptive_bed_mesh
+    _offline_adaptive_bed_mesh = create_offline_adaptive_bed_mesh(sections)
+
+
+def analyse_gcode_file_offline(gcode_filepath):
+    """
+    Worker process of the offline analysis.
+    :return: the result of AdaptiveBedMesh.analyse_gcode_file(), and the entries of the gcode analysis cache
+    """
+    adaptive_bed_mesh = _offline_adaptive_bed_mesh
+    adaptive_bed_mesh.gcode_analysis_cache = GcodeAnalysisCache(None, 1024)
+    result = adaptive_bed_mesh.analyse_gcode_file(gcode_filepath)
+    return result, adaptive_bed_mesh.gcode_analysis_cache.get_entries()
+
+
+def parse_point(value):
+    # X,Y command line argument
+    x, y = (float(v) for v in value.split(','))
+    return x, y
+
+
+def main(argv=None):
+    """
+    Offline analysis of whole directories of gcode files, e.g. for a print farm server to pre-compute the analysis
+    before the jobs are dispatched:
+
+        python -m adaptive_bed_mesh analyze --config printer.cfg --cache adaptive_bed_mesh_cache.json gcodes/
+
+    The result of each file is written as JSON. The --cache file is in the format of the plugin's gcode analysis cache,
+    and may be written while Klipper runs with it. The entries are keyed by the real path of the gcode file and checked
+    against its size and modification time. A file uploaded to another path, or with another modification time, is
+    matched by its content hash instead.
+    """
+    parser = argparse.ArgumentParser(prog='python -m adaptive_bed_mesh', description=main.__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    analyze_parser = subparsers.add_parser('analyze', help='Analyse gcode files and directories')
+    analyze_parser.add_argument('paths', nargs='+', help='Gcode files, or directories to search for gcode files')
+    analyze_parser.add_argument('--config', help='printer.cfg with the [bed_mesh] and [adaptive_bed_mesh] sections')
+    analyze_parser.add_argument('--mesh-min', type=parse_point, metavar='X,Y', help='Overrides [bed_mesh] mesh_min')
+    analyze_parser.add_argument('--mesh-max', type=parse_point, metavar='X,Y', help='Overrides [bed_mesh] mesh_max')
+    analyze_parser.add_argument('--fade-end', type=float, help='Overrides [bed_mesh] fade_end')
+    analyze_parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                                help='Overrides an [adaptive_bed_mesh] option, may be repeated')
+    analyze_parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of worker processes')
+    analyze_parser.add_argument('--output', help='Write the JSON result to the file instead of stdout')
+    analyze_parser.add_argument('--cache', help='Merge the gcode analysis results into the plugin cache file, copies '
+                                                'of the files at other paths are matched by their content')
+    args = parser.parse_args(argv)
+
+    sections = OfflineConfig.read_sections(args.config) if args.config else dict()
+    bed_mesh_section = sections.setdefault('bed_mesh', dict())
+    if args.mesh_min is not None:
+        bed_mesh_section['mesh_min'] = '{},{}'.format(*args.mesh_min)
+    if args.mesh_max is not None:
+        bed_mesh_section['mesh_max'] = '{},{}'.format(*args.mesh_max)
+    if args.fade_end is not None:
+        bed_mesh_section['fade_end'] = str(args.fade_end)
+    if 'mesh_min' not in bed_mesh_section or 'mesh_max' not in bed_mesh_section:
+        parser.error('[bed_mesh] mesh_min and mesh_max are required, from --config or --mesh-min and --mesh-max')
+    sections.setdefault('virtual_sdcard', dict()).setdefault('path', os.getcwd())
+
+    adaptive_bed_mesh_section = sections.setdefault('adaptive_bed_mesh', dict())
+    for option in args.set:
+        name, separator, value = option.partition('=')
+        if not separator:
+            parser.error('--set expects OPTION=VALUE, got {}'.format(option))
+        adaptive_bed_mesh_section[name.strip()] = value.strip()
+    # The files are analysed in parallel already
+    if args.jobs > 1:
+        adaptive_bed_mesh_section['gcode_analysis_workers'] = '1'
+
+    gcode_filepaths = find_gcode_files(args.paths)
+    start_time = time.monotonic()
+    if args.jobs > 1 and len(gcode_filepaths) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(min(args.jobs, len(gcode_filepaths)),
+                                                          mp_context=multiprocessing.get_context('spawn'),
+                                                          initializer=init_offline_worker, initargs=(sections,))
+        with executor:
+            results = list(executor.map(analyse_gcode_file_offline, gcode_filepaths))
+    else:
+        init_offline_worker(sections)
+        results = [analyse_gcode_file_offline(gcode_filepath) for gcode_filepath in gcode_filepaths]
+
+    if args.cache:
+        cache_size = int(adaptive_bed_mesh_section.get('gcode_analysis_cache_size', 32))
+        cache = GcodeAnalysisCache(os.path.normpath(os.path.expanduser(args.cache)), cache_size,
+                                   int(adaptive_bed_mesh_section.get('gcode_analysis_index_cache_size', cache_size)))
+        for _, entries in results:
+            cache.update(entries)
+
+    output = {'files': {gcode_filepath: result for gcode_filepath, (result, _) in zip(gcode_filepaths, results)},
+              'total_time': time.monotonic() - start_time}
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(output, fp, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    return 1 if any('error' in result for result, _ in results) else 0
+
+
+def add_counters(stats, **counters):
+    for key, value in counters.items():
+        stats[key] = stats.get(key, 0) + value
+
+
+def count_lines(data, pos, endpos):
+    # mmap has no count(), count a block at a time
+    block_size = 1024 * 1024
+    return sum(data[start:min(start + block_size, endpos)].count(b'\n') for start in range(pos, endpos, block_size))
+
+
+def split_line_ranges(data, count, min_size):
+    """
+    Split data into up to count (pos, endpos) ranges of at least min_size bytes, each ends at a line boundary.
+    """
+    size = max(min_size, -(-len(data) // count))
+    ranges = []
+    pos = 0
+    while pos < len(data):
+        end = data.find(b'\n', min(pos + size, len(data)) - 1) + 1 or len(data)
+        ranges.append((pos, end))
+        pos = end
+
+    return ranges
+
+
+def find_resolved_position(data, pos, endpos, is_absolute):
+    """
+    Find the first motion command in data[pos:endpos] after which X, Y and Z have all been set by absolute positioning,
+    i.e. the toolhead position no longer depends on the state before pos.
+    :return: the offset of the end of that command, or None
+    """
+    unknown_axes = {'X', 'Y', 'Z'}
+    for match in gcode_motion_pattern.finditer(data, pos, endpos):
+        header = match.group(1).upper()
+        if header == b'G90':
+            is_absolute = True
+        elif header == b'G91':
+            is_absolute = False
+        elif is_absolute:
+            unknown_axes.difference_update(key for key, value in zip(gcode_motion_params, match.groups()[1:]) if value)
+            if not unknown_axes:
+                return match.end()
+
+    return None
+
+
+def analyse_gcode_range(gcode_filepath, pos, endpos, chunk_size, fade_end):
+    """
+    Worker process of the parallel gcode analysis. Analyse data[pos:endpos] from an unknown toolhead position,
+    assuming absolute positioning.
+    :return: {'layer_extents': [[layer_height, x_min, y_min, x_max, y_max], ...] of the moves from a known position,
+              'resolved_pos': the offset where the toolhead position is known (see find_resolved_position()),
+              'is_stopped': True if the analysis shall stop,
+              'offsets': {layer_height: byte offset of the chunk the layer starts in},
+              'stop_z': the layer height of the move that stopped the analysis,
+              'state': the modal state at the end of the range,
+              'stats': the counters described in AdaptiveBedMesh.get_layer_extents()}
+    """
+    layer_index = LayerIndex()
+    state = {'absolute': True, 'X': math.nan, 'Y': math.nan, 'Z': math.nan}
+    stats = dict()
+
+    with open_gcode_mmap(gcode_filepath) as data:
+        resolved_pos = find_resolved_position(data, pos, endpos, True)
+        is_stopped = False
+        if resolved_pos is not None:
+            is_stopped = AdaptiveBedMesh._analyse_range(data, pos, endpos, chunk_size, state,
+                                                        layer_index.layer_extents, fade_end, False, stats=stats,
+                                                        layer_index=layer_index)
+
+    return {'layer_extents': [[layer] + extents for layer, extents in layer_index.layer_extents.items()],
+            'offsets': layer_index.offsets,
+            'resolved_pos': resolved_pos,
+            'is_stopped': is_stopped,
+            'stop_z': layer_index.next['z'] if is_stopped else None,
+            'state': state,
+            'stats': stats}
+
+
+def diamond_angle(x, y):
+    """
+    Monotonic substitute of atan2 in [0, 4), where 0, 1, 2, 3 are the +X, +Y, -X, -Y directions. Unlike atan2 it only
+    uses basic arithmetic, so the numpy backend gives bit identical results.
+    """
+    if y >= 0:
+        if x >= 0:
+            return y / (x + y) if x + y > 0 else 0.
+        return 1 - x / (y - x)
+    if x < 0:
+        return 2 - y / (-x - y)
+    return 3 + x / (x - y)
+
+
+def get_arc_center_from_radius(start_coord, end_coord, radius, is_clockwise):
+    """
+    Find the center of an R form arc. A positive radius selects the arc less than 180 degrees.
+    Reference: Marlin G2_G3.cpp
+    """
+    dx = end_coord[0] - start_coord[0]
+    dy = end_coord[1] - start_coord[1]
+    distance = math.sqrt(dx * dx + dy * dy)
+    if distance == 0:
+        # Undefined, treat as a linear move
+        return start_coord
+
+    # Distance from the mid point to the center
+    h_sq = radius * radius - (distance * 0.5) * (distance * 0.5)
+    h = math.sqrt(h_sq) if h_sq > 0 else 0.
+    e = -1. if is_clockwise != (radius < 0) else 1.
+
+    return ((start_coord[0] + end_coord[0]) * 0.5 + e * h * (-dy / distance),
+            (start_coord[1] + end_coord[1]) * 0.5 + e * h * (dx / distance))
+
+
+def get_arc_extents(start_coord, end_coord, center_coord, is_clockwise):
+    """
+    Points defining the bounding box of the arc: the start point, the axis extremes within the sweep of the arc, and the
+    end point. An arc that ends where it starts is a full circle.
+    """
+    cx, cy = center_coord
+    ax = start_coord[0] - cx
+    ay = start_coord[1] - cy
+    radius = math.sqrt(ax * ax + ay * ay)
+
+    points = [start_coord]
+
+    if radius > 0:
+        start_angle = diamond_angle(ax, ay)
+        end_angle = diamond_angle(end_coord[0] - cx, end_coord[1] - cy)
+
+        sweep = start_angle - end_angle if is_clockwise else end_angle - start_angle
+        if sweep < 0:
+            sweep += 4.
+        elif sweep == 0 and start_coord == end_coord:
+            sweep = 4.
+
+        for direction, point in enumerate([(cx + radius, cy), (cx, cy + radius), (cx - radius, cy), (cx, cy - radius)]):
+            offset = start_angle - direction if is_clockwise else direction - start_angle
+            if offset < 0:
+                offset += 4.
+            if offset <= sweep:
+                points.append(point)
+
+    points.append(end_coord)
+
+    return points
+
+
+def diamond_angles(x, y):
+    # Vectorized diamond_angle()
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        angles = numpy.where(
+            y >= 0,
+            numpy.where(x >= 0, numpy.where(x + y > 0, y / (x + y), 0.), 1 - x / (y - x)),
+            numpy.where(x < 0, 2 - y / (-x - y), 3 + x / (x - y)))
+    return angles
+
+
+def get_arc_centers_from_radius(start_x, start_y, end_x, end_y, radius, is_clockwise):
+    # Vectorized get_arc_center_from_radius()
+    dx = end_x - start_x
+    dy = end_y - start_y
+    distance = numpy.sqrt(dx * dx + dy * dy)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        h_sq = radius * radius - (distance * 0.5) * (distance * 0.5)
+        h = numpy.where(h_sq > 0, numpy.sqrt(numpy.maximum(h_sq, 0.)), 0.)
+        e = numpy.where(is_clockwise != (radius < 0), -1., 1.)
+        center_x = (start_x + end_x) * 0.5 + e * h * (-dy / distance)
+        center_y = (start_y + end_y) * 0.5 + e * h * (dx / distance)
+
+    is_undefined = distance == 0
+    return numpy.where(is_undefined, start_x, center_x), numpy.where(is_undefined, start_y, center_y)
+
+
+def get_arcs_extents(start_x, start_y, end_x, end_y, center_x, center_y, is_clockwise):
+    """
+    Vectorized get_arc_extents()
+    :return: (points_x, points_y, is_point), each a list of arrays for the start point, the 4 axis extremes and the end
+        point. is_point tells whether the axis extreme is within the sweep of the arc.
+    """
+    ax = start_x - center_x
+    ay = start_y - center_y
+    radius = numpy.sqrt(ax * ax + ay * ay)
+
+    start_angle = diamond_angles(ax, ay)
+    end_angle = diamond_angles(end_x - center_x, end_y - center_y)
+
+    sweep = numpy.where(is_clockwise, start_angle - end_angle, end_angle - start_angle)
+    is_full_circle = (sweep == 0) & (start_x == end_x) & (start_y == end_y)
+    sweep = numpy.where(sweep < 0, sweep + 4., numpy.where(is_full_circle, 4., sweep))
+
+    is_arc = radius > 0
+    points_x = [start_x, center_x + radius, center_x, center_x - radius, center_x, end_x]
+    points_y = [start_y, center_y, center_y + radius, center_y, center_y - radius, end_y]
+    is_point = [numpy.ones(len(start_x), dtype=bool)]
+    for direction in range(4):
+        offset = numpy.where(is_clockwise, start_angle - direction, direction - start_angle)
+        offset = numpy.where(offset < 0, offset + 4., offset)
+        is_point.append(is_arc & (offset <= sweep))
+    is_point.append(is_point[0])
+
+    return points_x, points_y, is_point
+
+
+def resolve_axis_positions(values, is_set, is_delta, initial):
+    """
+    Resolve the position of one axis after each row. The is_set rows move the axis to the value, the is_delta rows move
+    the axis by the value, and the other rows keep the previous position.
+    :return: (positions, last_set) where positions is valid at the rows that move the axis, and last_set is the index
+        of the last row that moved the axis, or -1 if the axis is still at the initial position.
+    """
+    positions = values.copy()
+    row_index = numpy.arange(len(values))
+    last_set = numpy.maximum.accumulate(numpy.where(is_set, row_index, -1))
+
+    delta_rows = numpy.flatnonzero(is_delta)
+    if len(delta_rows):
+        # A relative move depends on the previous position, resolve them one at a time so the floating point result is
+        #   the same as the python backend
+        last_delta = -1
+        for row in delta_rows.tolist():
+            previous = max(last_set[row - 1] if row > 0 else -1, last_delta)
+            positions[row] = (positions[previous] if previous >= 0 else initial) + values[row]
+            last_delta = row
+
+        last_set = numpy.maximum.accumulate(numpy.where(is_set | is_delta, row_index, -1))
+
+    return positions, last_set
+
+
+def resample_mesh(points, mesh_params, x_coords, y_coords):
+    """
+    Bilinear interpolation of a bed_mesh profile, probed on the regular grid described by the mesh_params.
+    :param points: probed heights, one row per Y
+    :return: heights at the x_coords, y_coords grid, one row per Y
+    """
+    points = numpy.asarray(points, dtype=numpy.float64)
+    mesh_x = numpy.linspace(mesh_params['min_x'], mesh_params['max_x'], mesh_params['x_count'])
+    mesh_y = numpy.linspace(mesh_params['min_y'], mesh_params['max_y'], mesh_params['y_count'])
+
+    # Along X on every probed row, then along Y on every column
+    rows = numpy.array([numpy.interp(x_coords, mesh_x, row) for row in points])
+    return numpy.array([numpy.interp(y_coords, mesh_y, column) for column in rows.T]).T
+
 
 def is_even(number):
     if number % 2 == 0:
@@ -460,42 +3744,4 @@ def load_config(config):
 
 
 if __name__ == '__main__':
-    pass
-    from matplotlib import pyplot as plt
-
-    # # gcode_file = r'C:\Users\rba90\Downloads\g-all.gcode'
-    # # gcode_file = r'C:\Users\rba90\Downloads\leg2.gcode'
-    # # gcode_file = r'C:\Users\rba90\Downloads\V350_demo.gcode'
-    # # gcode_file = r'C:\Users\Ran Bao\Downloads\OrcaCube_PLA_34m48s.gcode'
-    # # gcode_file = r'C:\Users\Ran Bao\Downloads\VaseShape-Cylinder-Voron 0.1-PLA+.gcode'
-    # gcode_file = r'C:\Users\Ran Bao\Downloads\G2_Cylinder_PLA_12s.gcode'
-    # # gcode_file = r'C:\Users\Ran Bao\Downloads\Cylinder_PLA_12s.gcode'
-    # gcode_file = r'C:\Users\Ran Bao\Downloads\mygcode.txt'
-    #
-    # bed_mesh = AdaptiveBedMesh()
-    # bed_mesh.extract_first_layer_from_gcode_file(gcode_file)
-    # bed_mesh.get_min_max_square()
-    #
-    # fig = plt.figure()
-    # ax = fig.subplots()
-    #
-    # x_moves = []
-    # y_moves = []
-    # for move in bed_mesh._first_layer_move_vertices:
-    #     x_moves.append(move['X'])
-    #     y_moves.append(move['Y'])
-    #
-    # ax.plot(x_moves, y_moves)
-    #
-    # (x_min, x_max), (y_min, y_max) = bed_mesh.get_min_max_square()
-    #
-    # probe_points, zero_reference_position = bed_mesh.get_probe_points()
-    # probe_points_x, probe_points_y = zip(*probe_points)
-    #
-    # ax.plot([x_min, x_min, x_max, x_max, x_min], [y_min, y_max, y_max, y_min, y_min], label='Print Boundary')
-    #
-    # ax.plot(probe_points_x, probe_points_y, marker='x', linestyle='--', label='Probe points')
-    # ax.scatter(zero_reference_position[0], zero_reference_position[1], marker='o', label='Zero Reference Point')
-    #
-    # ax.legend(*ax.get_legend_handles_labels())
-    # plt.show()
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Benchmark the gcode analysis throughput, memory usage and the end to end calibration latency over the gcode files in
+test_data/.
+
+Usage:
+    python benchmark_adaptive_bed_mesh.py --output result.json
+    python benchmark_adaptive_bed_mesh.py --baseline result.json --threshold 0.2
+    python benchmark_adaptive_bed_mesh.py --sweep 1 10 100 1000
+    python benchmark_adaptive_bed_mesh.py --sweep 1 10 --bgcode
+
+The comparison against the baseline fails (exit code 1) if any timing is slower than the baseline by more than the
+threshold. The --sweep option benchmarks synthetic gcode files of the given sizes (in MB) instead, to show how the
+analysis scales. With --bgcode, each synthetic file is benchmarked as a binary gcode file too, heatshrink compressed
+and MeatPack encoded as PrusaSlicer writes it. Each file is benchmarked in a fresh process, so the peak RSS is the one
+of that file.
+"""
+import argparse
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+from adaptive_bed_mesh import AdaptiveBedMesh, get_gcode_format, open_gcode_blocks
+from fake_klipper import FakeReactor
+from synthetic_gcode import generate_synthetic_gcode, write_bgcode
+
+test_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_data')
+
+
+def create_adaptive_bed_mesh(work_dir, **options):
+    """
+    Build the AdaptiveBedMesh against a mocked Klipper printer, gcode and bed_mesh stack. The options override the
+    [adaptive_bed_mesh] defaults. The stores next to the virtual sdcard directory are written to the work_dir.
+    """
+    def get_option(name, default=None, **kwargs):
+        return options.get(name, default)
+
+    bed_mesh_config = mock.MagicMock()
+    bed_mesh_config.getfloatlist.side_effect = lambda name, count: (0, 0) if name == 'mesh_min' else (350, 350)
+    bed_mesh_config.getfloat.side_effect = lambda name, default, **kwargs: default
+    bed_mesh_config.get.side_effect = lambda name, default: default
+
+    virtual_sdcard_config = mock.MagicMock()
+    virtual_sdcard_config.get.return_value = os.path.join(work_dir, 'gcodes')
+
+    config = mock.MagicMock()
+    config.getsection.side_effect = lambda name: {'bed_mesh': bed_mesh_config,
+                                                  'virtual_sdcard': virtual_sdcard_config}.get(name, mock.MagicMock())
+    config.has_section.side_effect = lambda name: name in ['bed_mesh', 'virtual_sdcard']
+    config.getfloat.side_effect = get_option
+    config.getint.side_effect = get_option
+    config.getboolean.side_effect = get_option
+    config.get.side_effect = get_option
+    config.getchoice.side_effect = lambda name, choices, default: choices[options.get(name, default)]
+    config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+
+    adaptive_bed_mesh = AdaptiveBedMesh(config)
+    adaptive_bed_mesh.exclude_object.objects = []
+
+    return adaptive_bed_mesh
+
+
+def measure(func, repeat):
+    # The best wall time of the repeats, then the peak allocation of one more run under tracemalloc
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        wall_times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak_allocation = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(wall_times), peak_allocation
+
+
+def benchmark_file(gcode_filepath, repeat, include_vertices, work_dir):
+    # Size of the gcode text, a compressed file is counted after decoding so the throughput is comparable
+    num_bytes = 0
+    num_lines = 0
+    if get_gcode_format(gcode_filepath) == 'text':
+        num_bytes = os.path.getsize(gcode_filepath)
+        with open(gcode_filepath, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                num_lines += block.count(b'\n')
+    else:
+        with open_gcode_blocks(gcode_filepath, 1024 * 1024) as blocks:
+            for _, block in blocks:
+                num_bytes += len(block)
+                num_lines += block.count(b'\n')
+
+    result = {'bytes': num_bytes, 'file_bytes': os.path.getsize(gcode_filepath), 'lines': num_lines}
+
+    # Throughput of the full file analysis
+    for backend in ['python', 'numpy']:
+        adaptive_bed_mesh = create_adaptive_bed_mesh(work_dir, gcode_analysis_backend=backend,
+                                                     gcode_analysis_cache_size=0)
+        wall_time, peak_allocation = measure(lambda: adaptive_bed_mesh.get_layer_extents(gcode_filepath), repeat)
+        result['get_layer_extents_' + backend] = {
+            'wall_time': wall_time,
+            'lines_per_second': num_lines / wall_time,
+            'mb_per_second': num_bytes / wall_time / 1e6,
+            'peak_allocation': peak_allocation,
+        }
+
+    adaptive_bed_mesh = create_adaptive_bed_mesh(work_dir, gcode_analysis_cache_size=0)
+
+    # The debug vertex output grows with the file size
+    if include_vertices:
+        wall_time, peak_allocation = measure(lambda: adaptive_bed_mesh.get_layer_vertices(gcode_filepath), 1)
+        result['get_layer_vertices'] = {'wall_time': wall_time, 'peak_allocation': peak_allocation}
+
+    wall_time, peak_allocation = measure(
+        lambda: adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath), repeat)
+    result['generate_mesh_with_gcode_analysis'] = {'wall_time': wall_time, 'peak_allocation': peak_allocation}
+
+    # End to end, from the gcode command to the BED_MESH_CALIBRATE
+    gcmd = mock.MagicMock()
+    gcmd.get.side_effect = lambda name, default=None: gcode_filepath if name == 'GCODE_FILEPATH' else default
+    gcmd.get_int.side_effect = lambda name, default=None, **kwargs: default
+    wall_time, peak_allocation = measure(lambda: adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd), repeat)
+    result['cmd_ADAPTIVE_BED_MESH_CALIBRATE'] = {'wall_time': wall_time, 'peak_allocation': peak_allocation}
+
+    # Of the process benchmarking this file, without the worker processes of the parallel backend. In KiB on Linux
+    result['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return result
+
+
+def benchmark_file_in_subprocess(gcode_filepath, repeat, include_vertices=True):
+    # A fresh process per file, so that the peak RSS isn't the one of the largest file benchmarked so far
+    with tempfile.TemporaryDirectory() as work_dir, \
+            concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(benchmark_file, gcode_filepath, repeat, include_vertices, work_dir).result()
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    :return: list of (gcode_filename, benchmark, baseline wall time, wall time) that regressed more than the threshold
+    """
+    regressions = []
+    for gcode_filename, file_result in results['files'].items():
+        baseline_file_result = baseline['files'].get(gcode_filename, {})
+        for name, metrics in file_result.items():
+            if not isinstance(metrics, dict) or name not in baseline_file_result:
+                continue
+            baseline_wall_time = baseline_file_result[name]['wall_time']
+            if metrics['wall_time'] > baseline_wall_time * (1 + threshold):
+                regressions.append((gcode_filename, name, baseline_wall_time, metrics['wall_time']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('gcode_files', nargs='*', help='Gcode files to benchmark, all files in test_data/ by default')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per benchmark, the best one is reported')
+    parser.add_argument('--output', help='Write the result to the JSON file')
+    parser.add_argument('--baseline', help='Compare the result against the JSON file written by --output')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slow down relative to the baseline')
+    parser.add_argument('--sweep', type=float, nargs='+', metavar='SIZE',
+                        help='Benchmark synthetic gcode files of the sizes in MB')
+    parser.add_argument('--bgcode', action='store_true',
+                        help='Benchmark the synthetic files as binary gcode too, which is slow to write')
+    args = parser.parse_args()
+
+    results = {'python': sys.version, 'platform': platform.platform(), 'files': {}}
+
+    def run(gcode_filename, gcode_filepath, include_vertices):
+        file_result = benchmark_file_in_subprocess(gcode_filepath, args.repeat, include_vertices)
+        results['files'][gcode_filename] = file_result
+
+        print('{}: {:.1f} MB ({:.1f} MB on disk), {} lines'.format(
+            gcode_filename, file_result['bytes'] / 1e6, file_result['file_bytes'] / 1e6, file_result['lines']))
+        for name, metrics in file_result.items():
+            if isinstance(metrics, dict):
+                print('    {:<40} {:8.3f} s {:10.1f} KiB peak'.format(
+                    name, metrics['wall_time'], metrics['peak_allocation'] / 1024))
+        print('    {:<40} {:10} KiB'.format('peak RSS', file_result['max_rss']))
+
+    if args.sweep:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for size in args.sweep:
+                gcode_filename = 'synthetic_{:g}MB.gcode'.format(size)
+                gcode_filepath = os.path.join(temp_dir, gcode_filename)
+                generate_synthetic_gcode(gcode_filepath, int(size * 1e6))
+                run(gcode_filename, gcode_filepath, include_vertices=False)
+
+                if args.bgcode:
+                    bgcode_filepath = os.path.splitext(gcode_filepath)[0] + '.bgcode'
+                    with open(gcode_filepath, 'rb') as fp:
+                        write_bgcode(fp.read(), bgcode_filepath, compression=3, encoding=1)
+                    run(os.path.basename(bgcode_filepath), bgcode_filepath, include_vertices=False)
+                    os.remove(bgcode_filepath)
+                os.remove(gcode_filepath)
+    else:
+        for gcode_filepath in args.gcode_files or sorted(glob.glob(os.path.join(test_data_dir, '*.gcode'))):
+            run(os.path.basename(gcode_filepath), gcode_filepath, include_vertices=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        for gcode_filename, name, baseline_wall_time, wall_time in regressions:
+            print('REGRESSION {} {}: {:.3f} s -> {:.3f} s'.format(gcode_filename, name, baseline_wall_time, wall_time))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""
+Fakes of the Klipper objects shared by the unit test and the benchmark.
+"""
+import threading
+import time
+
+
+class FakeReactor(object):
+    # Minimum subset of the Klipper reactor, the completion is woken up from the worker thread directly
+    class Completion(object):
+        def __init__(self):
+            self.event = threading.Event()
+
+        def complete(self, result):
+            self.event.set()
+
+        def wait(self, waketime, waiting_result=None):
+            if self.event.wait(max(0., waketime - time.monotonic())):
+                return True
+            return waiting_result
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def completion(self):
+        return self.Completion()
+
+    def register_async_callback(self, callback):
+        callback(self.monotonic())
@@ -0,0 +1,285 @@
+"""
+Deterministic generator of realistic gcode files of any size, with the true print bounds known analytically.
+
+Each object is a rectangle with a half circle (G3 R form) on its right side and a full circle (G3 I/J form) on its top
+side, filled by zigzag moves in relative positioning. Objects are separated by Z-hop travel moves, and the file
+comes with a thumbnail, slicer metadata comments and EXCLUDE_OBJECT_DEFINE headers like a sliced file. The objects
+shrink every few layers, and the number of layers grows with the requested file size.
+
+All coordinates lie on a 0.5mm grid, so the arc extents can be calculated without rounding error and the analytic
+bounds are exact.
+
+The gcode can be converted to a binary gcode file (.bgcode, see the libbgcode specification) with write_bgcode(), with
+reference MeatPack and heatshrink encoders. The encoders aim for simplicity rather than the compression ratio.
+
+Usage:
+    python synthetic_gcode.py output.gcode --size 100
+    python synthetic_gcode.py output.bgcode --size 1 --compression 2
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import struct
+import tempfile
+import zlib
+
+
+def get_layer_object(obj, layer):
+    # Shrink the object every 5 layers, down to 2mm
+    cx, cy, w, h, r = obj
+    shrink = 0.5 * (layer // 5)
+    w = max(2., w - shrink)
+    h = max(2., h - shrink)
+    r = min(w, max(1., r - shrink))
+    return cx, cy, w, h, r
+
+
+def get_object_extents(cx, cy, w, h, r):
+    # Rectangle (cx +/- w, cy +/- h), half circle of radius h on the right side, circle of radius r (r <= w) standing on
+    #   the top side
+    return [cx - w, cy - h, cx + w + h, cy + h + 2 * r]
+
+
+def merge_extents(extents_list):
+    return [min(e[0] for e in extents_list), min(e[1] for e in extents_list),
+            max(e[2] for e in extents_list), max(e[3] for e in extents_list)]
+
+
+def format_number(value):
+    return '{:.3f}'.format(value).rstrip('0').rstrip('.')
+
+
+def write_object_layer(lines, name, z, cx, cy, w, h, r):
+    f = format_number
+    lines.append('EXCLUDE_OBJECT_START NAME={}'.format(name))
+
+    # Z-hop travel to the object
+    lines.append('G1 Z{} F600'.format(f(z + 0.4)))
+    lines.append('G0 X{} Y{} F12000'.format(f(cx - w), f(cy - h)))
+    lines.append('G1 Z{} F600'.format(f(z)))
+
+    # Perimeter, with the half circle on the right side (R form) and the full circle on the top side (I/J form)
+    lines.append('G1 X{} E{} F3000'.format(f(cx + w), f(2 * w * 0.05)))
+    lines.append('G3 X{} Y{} R{} E{}'.format(f(cx + w), f(cy + h), f(h), f(3.1416 * h * 0.05)))
+    lines.append('G1 X{} E{}'.format(f(cx), f(w * 0.05)))
+    lines.append('G3 X{} Y{} I0 J{} E{}'.format(f(cx), f(cy + h), f(r), f(6.2832 * r * 0.05)))
+    lines.append('G1 X{} E{}'.format(f(cx - w), f(w * 0.05)))
+    lines.append('G1 Y{} E{}'.format(f(cy - h), f(2 * h * 0.05)))
+
+    # Zigzag infill inside the rectangle in relative positioning
+    lines.append('G0 X{} Y{}'.format(f(cx - w + 0.5), f(cy - h + 0.5)))
+    lines.append('G91')
+    step = 1.
+    for i in range(int((2 * h - 1) / step)):
+        dx = 2 * w - 1 if i % 2 == 0 else -(2 * w - 1)
+        lines.append('G1 X{} E{}'.format(f(dx), f(abs(dx) * 0.05)))
+        lines.append('G1 Y{} E{}'.format(f(step), f(step * 0.05)))
+    lines.append('G90')
+
+    lines.append('EXCLUDE_OBJECT_END NAME={}'.format(name))
+
+
+def generate_synthetic_gcode(gcode_filepath, target_size, seed=0, num_objects=None, layer_height=0.2,
+                             thumbnail_size=32 * 1024):
+    """
+    Write a gcode file of at least target_size bytes.
+    :return: {'layer_extents': {layer_height: [x_min, y_min, x_max, y_max]}, in the order of printing,
+              'mesh_min': (x_min, y_min), 'mesh_max': (x_max, y_max) of all layers,
+              'first_layer_min': (x_min, y_min), 'first_layer_max': (x_max, y_max)}
+    """
+    rng = random.Random(seed)
+    if num_objects is None:
+        num_objects = rng.randint(2, 9)
+
+    # Objects on a grid of 80mm cells, each (cx, cy, w, h, r) on the 0.5mm grid
+    objects = []
+    cells = rng.sample([(i, j) for i in range(4) for j in range(4)], num_objects)
+    for i, j in cells:
+        w = rng.randint(10, 40) * 0.5
+        h = rng.randint(10, 30) * 0.5
+        r = rng.randint(2, 10) * 0.5
+        objects.append((30 + i * 80 + rng.randint(0, 10) * 0.5, 30 + j * 80 + rng.randint(0, 10) * 0.5, w, h, r))
+
+    first_layer_extents = merge_extents([get_object_extents(*get_layer_object(obj, 0)) for obj in objects])
+
+    layer_extents = dict()
+    with open(gcode_filepath, 'w', newline='\n') as fp:
+        # Header
+        lines = ['; generated by synthetic_gcode.py seed={}'.format(seed), ';']
+        thumbnail = base64.b64encode(bytes(rng.getrandbits(8) for _ in range(thumbnail_size * 3 // 4))).decode()
+        lines.append('; thumbnail begin 300x300 {}'.format(len(thumbnail)))
+        lines.extend('; ' + thumbnail[i:i + 78] for i in range(0, len(thumbnail), 78))
+        lines.append('; thumbnail end')
+        lines.append(';')
+        lines.append(';FLAVOR:Klipper')
+        for name, value in zip(['MINX', 'MINY', 'MAXX', 'MAXY'], first_layer_extents):
+            lines.append(';{}:{}'.format(name, format_number(value)))
+        lines.append('; first_layer_print_min = {},{}'.format(*map(format_number, first_layer_extents[:2])))
+        lines.append('; first_layer_print_max = {},{}'.format(*map(format_number, first_layer_extents[2:])))
+        for n, obj in enumerate(objects):
+            x_min, y_min, x_max, y_max = get_object_extents(*get_layer_object(obj, 0))
+            polygon = [[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max], [x_min, y_min]]
+            lines.append('EXCLUDE_OBJECT_DEFINE NAME=object_{} CENTER={},{} POLYGON={}'.format(
+                n, format_number(obj[0]), format_number(obj[1]), json.dumps(polygon, separators=(',', ':'))))
+        lines.extend(['G90', 'M83', 'G28', 'G1 Z5 F600', ''])
+        fp.write('\n'.join(lines))
+        size = fp.tell()
+
+        layer = 0
+        while size < target_size:
+            z = round(layer_height * (layer + 1), 3)
+            lines = [';LAYER_CHANGE', ';Z:{}'.format(format_number(z)), 'G1 Z{} F600'.format(format_number(z))]
+            extents_list = []
+            for n, obj in enumerate(objects):
+                layer_object = get_layer_object(obj, layer)
+                write_object_layer(lines, 'object_{}'.format(n), z, *layer_object)
+                extents_list.append(get_object_extents(*layer_object))
+            lines.append('')
+
+            layer_extents[float(format_number(z))] = merge_extents(extents_list)
+            fp.write('\n'.join(lines))
+            size = fp.tell()
+            layer += 1
+
+        fp.write('; end of print\nM84\n')
+
+    mesh = merge_extents(list(layer_extents.values())) if layer_extents else first_layer_extents
+    return {'layer_extents': layer_extents,
+            'mesh_min': (mesh[0], mesh[1]), 'mesh_max': (mesh[2], mesh[3]),
+            'first_layer_min': (first_layer_extents[0], first_layer_extents[1]),
+            'first_layer_max': (first_layer_extents[2], first_layer_extents[3])}
+
+
+def heatshrink_compress(data, window_sz2, lookahead_sz2):
+    """
+    Greedy LZSS encoder in the heatshrink bit stream format, MSB first: a 1 bit and 8 bits for a literal byte, or a
+    0 bit, window_sz2 bits of the distance - 1 and lookahead_sz2 bits of the count - 1 for a back reference.
+    """
+    window_size, max_count = 1 << window_sz2, 1 << lookahead_sz2
+    backref_bits = 1 + window_sz2 + lookahead_sz2
+    bits = []
+    pos = 0
+    while pos < len(data):
+        # The longest match that starts in the window, it may overlap the bytes being encoded
+        count, distance = 0, 0
+        start = max(0, pos - window_size)
+        while count < min(max_count, len(data) - pos):
+            i = data.rfind(data[pos:pos + count + 1], start, pos + count)
+            if i < 0:
+                break
+            count, distance = count + 1, pos - i
+
+        if count * 9 > backref_bits:
+            bits.append('0{:0{}b}{:0{}b}'.format(distance - 1, window_sz2, count - 1, lookahead_sz2))
+            pos += count
+        else:
+            bits.append('1{:08b}'.format(data[pos]))
+            pos += 1
+
+    bits = ''.join(bits)
+    bits += '0' * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big') if bits else b''
+
+
+def meatpack_encode(text, no_spaces=True):
+    """
+    Pack two characters of the gcode text in a byte where both are in the MeatPack table, the others follow as full
+    bytes. In the no spaces mode, the spaces of the command lines are removed and E takes the place of the space in the
+    table.
+    """
+    table = b'0123456789. \nGX'
+    lookup = {c: i for i, c in enumerate(table)}
+    output = bytearray(b'\xff\xff\xfb')
+    if no_spaces:
+        output += b'\xff\xff\xf7'
+        lookup.pop(ord(' '))
+        lookup[ord('E')] = table.index(b' ')
+
+    for line in text.splitlines(keepends=True):
+        if no_spaces and re.match(rb'[GMT]\d', line):
+            command, separator, comment = line.partition(b';')
+            parameters = command.rstrip(b' ')
+            line = parameters.replace(b' ', b'') + command[len(parameters):] + separator + comment
+
+        i = 0
+        while i < len(line):
+            first = line[i]
+            # A newline ends the byte
+            second = line[i + 1] if first != ord('\n') and i + 1 < len(line) else ord('\n')
+            i += 1 if first == ord('\n') else 2
+
+            first_code, second_code = lookup.get(first, 0xF), lookup.get(second, 0xF)
+            output.append(first_code | second_code << 4)
+            if first_code == 0xF:
+                output.append(first)
+            if second_code == 0xF and first != ord('\n'):
+                output.append(second)
+
+    return bytes(output)
+
+
+def write_bgcode(text, bgcode_filepath, compression=1, encoding=1, metadata=None, block_size=65536):
+    """
+    Write the gcode text as a binary gcode file, with CRC32 checksums.
+    :param compression: of the gcode blocks, 0 (none), 1 (deflate), 2 (heatshrink 11,4) or 3 (heatshrink 12,4)
+    :param encoding: of the gcode blocks, 0 (none) or 1 (MeatPack)
+    :param metadata: {key: value} of the printer metadata block
+    """
+    def compress(payload):
+        if compression == 1:
+            return zlib.compress(payload)
+        if compression in (2, 3):
+            return heatshrink_compress(payload, 11 if compression == 2 else 12, 4)
+        return payload
+
+    def write_block(fp, block_type, block_compression, payload, params):
+        compressed_payload = compress(payload) if block_compression else payload
+        header = struct.pack('<HHI', block_type, block_compression, len(payload))
+        if block_compression:
+            header += struct.pack('<I', len(compressed_payload))
+        block = header + params + compressed_payload
+        fp.write(block + struct.pack('<I', zlib.crc32(block)))
+
+    with open(bgcode_filepath, 'wb') as fp:
+        fp.write(b'GCDE' + struct.pack('<IH', 1, 1))
+        ini = ''.join('{}={}\n'.format(key, value) for key, value in (metadata or {}).items())
+        write_block(fp, 3, 0, ini.encode(), struct.pack('<H', 0))
+        # A 2x2 PNG thumbnail, skipped by the readers
+        write_block(fp, 5, 0, b'\x89PNG' + bytes(12), struct.pack('<HHH', 0, 2, 2))
+
+        pos = 0
+        while pos < len(text):
+            end = text.rfind(b'\n', pos, pos + block_size) + 1 or len(text)
+            block = text[pos:end]
+            if encoding:
+                block = meatpack_encode(block)
+            write_block(fp, 1, compression, block, struct.pack('<H', encoding))
+            pos = end
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('gcode_filepath')
+    parser.add_argument('--size', type=float, default=10, help='Size of the gcode file in MB')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compression', type=int, default=1, choices=[0, 1, 2, 3],
+                        help='Compression of the gcode blocks of a .bgcode file')
+    args = parser.parse_args()
+
+    if args.gcode_filepath.endswith('.bgcode'):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            text_filepath = os.path.join(temp_dir, 'synthetic.gcode')
+            result = generate_synthetic_gcode(text_filepath, int(args.size * 1e6), args.seed)
+            with open(text_filepath, 'rb') as fp:
+                write_bgcode(fp.read(), args.gcode_filepath, args.compression)
+    else:
+        result = generate_synthetic_gcode(args.gcode_filepath, int(args.size * 1e6), args.seed)
+    print('{} layers, mesh_min: {}, mesh_max: {}'.format(len(result['layer_extents']), result['mesh_min'],
+                                                         result['mesh_max']))
+
+
+if __name__ == '__main__':
+    main()
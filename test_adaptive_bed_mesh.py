@@ -1,8 +1,23 @@
 import unittest
 from unittest import mock
-from adaptive_bed_mesh import AdaptiveBedMesh
+import adaptive_bed_mesh
+from adaptive_bed_mesh import AdaptiveBedMesh, GcodeAnalysisCache, GcodePreAnalyser, LayerIndex, OccupancyGrid
+from synthetic_gcode import generate_synthetic_gcode, heatshrink_compress, meatpack_encode, write_bgcode
+from fake_klipper import FakeReactor
 import os
 import glob
+import tempfile
+import shutil
+import json
+import threading
+import time
+import pstats
+import tracemalloc
+import re
+import numpy
+import math
+import itertools
+import gzip
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 test_data_dir = os.path.join(dir_path, 'test_data')
@@ -18,13 +33,19 @@ class TestAdaptiveBedMesh(unittest.TestCase):
 
         # Mock mocked_virtual_sdcard_config
         self.mocked_virtual_sdcard_config = mock.MagicMock()
-        self.mocked_virtual_sdcard_config.get.return_value = 'my_path'
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.mocked_virtual_sdcard_config.get.return_value = os.path.join(self.temp_dir.name, 'gcodes')
 
         # Mock config
         self.mocked_config = mock.MagicMock()
         self.mocked_config.getsection.side_effect = self.mocked_get_section
+        self.mocked_config.has_section.side_effect = lambda name: name in ['bed_mesh', 'virtual_sdcard']
         self.mocked_config.getfloat.side_effect = self.mocked_get_float
         self.mocked_config.getint.side_effect = self.mocked_get_float
+        self.mocked_config.getboolean.side_effect = self.mocked_get_float
+        self.mocked_config.get.side_effect = self.mocked_get_float
+        self.mocked_config.getchoice.side_effect = lambda name, choices, default: choices[default]
 
         self.adaptive_bed_mesh = AdaptiveBedMesh(self.mocked_config)
 
@@ -42,7 +63,7 @@ class TestAdaptiveBedMesh(unittest.TestCase):
 
         return mock.MagicMock()
 
-    def mocked_get_float(self, name, default):
+    def mocked_get_float(self, name, default, **kwargs):
         return default
 
     def test_generate_bed_mesh_with_exclude_object(self):
@@ -52,6 +73,43 @@ class TestAdaptiveBedMesh(unittest.TestCase):
         self.assertTupleEqual(mesh_min, (68.0779, 68.0779))
         self.assertTupleEqual(mesh_max, (181.922, 181.922))
 
+    def test_generate_bed_mesh_with_excluded_objects(self):
+        def get_square(x, y, size=10, num_points=100):
+            # A detailed hull of a square
+            t = numpy.linspace(0, 1, num_points)
+            return [[x + size * u, y] for u in t] + [[x + size, y + size * u] for u in t] + \
+                   [[x + size * (1 - u), y + size] for u in t] + [[x, y + size * (1 - u)] for u in t]
+
+        # A 200 part plate
+        objects = [{'name': 'part_{}'.format(i), 'polygon': get_square(20 + (i % 20) * 15, 20 + (i // 20) * 15)}
+                   for i in range(200)]
+
+        with self.subTest('all'):
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_exclude_object(objects),
+                                  ((20, 20), (315, 165)))
+            self.assertEqual(len(self.adaptive_bed_mesh.object_bounds_cache), 200)
+
+        with self.subTest('excluded'):
+            # Klipper names the objects in upper case
+            excluded_objects = ['PART_{}'.format(i) for i in range(200) if i % 20 == 19 or i >= 180]
+            cached = dict(self.adaptive_bed_mesh.object_bounds_cache)
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_exclude_object(objects, excluded_objects),
+                                  ((20, 20), (300, 150)))
+
+            # Served from the cache, which keeps only the remaining objects
+            self.assertEqual(len(self.adaptive_bed_mesh.object_bounds_cache), 171)
+            for name, entry in self.adaptive_bed_mesh.object_bounds_cache.items():
+                self.assertIs(entry, cached[name])
+
+        with self.subTest('redefined'):
+            objects[0] = {'name': 'part_0', 'polygon': get_square(5, 5)}
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_exclude_object(objects),
+                                  ((5, 5), (315, 165)))
+
+        with self.subTest('all_excluded'):
+            with self.assertRaises(ValueError):
+                self.adaptive_bed_mesh.generate_mesh_with_exclude_object(objects, [obj['name'] for obj in objects])
+
     def test_generate_bed_mesh_param_with_gcode_analysis(self):
         # Generate file list
         gcode_with_bed_mesh_min_max = {
@@ -83,19 +141,13 @@ class TestAdaptiveBedMesh(unittest.TestCase):
         gcode_file = os.path.join(test_data_dir, '2x_3d_benchy.gcode')
 
         layer_vertices = self.adaptive_bed_mesh.get_layer_vertices(gcode_file)
-        first_layer_move_vertices = layer_vertices[min(layer_vertices.keys())]
+        first_layer_moves = layer_vertices[min(layer_vertices.keys())]
 
         fig = plt.figure()
         ax = fig.subplots()
 
         # Plot XY move on the first layer
-        x_moves = []
-        y_moves = []
-        for move in first_layer_move_vertices:
-            x_moves.append(move['X'])
-            y_moves.append(move['Y'])
-
-        ax.plot(x_moves, y_moves, label='Toolhead Move')
+        ax.plot(first_layer_moves.x, first_layer_moves.y, label='Toolhead Move')
 
         # Plot print boundary
         (x_min, y_min), (x_max, y_max) = self.adaptive_bed_mesh.get_layer_min_max_before_fade(layer_vertices, 10)
@@ -135,6 +187,1164 @@ class TestAdaptiveBedMesh(unittest.TestCase):
             self.assertTupleEqual(mesh_min, (23.154, 16.381))
             self.assertTupleEqual(mesh_max, (89.637, 95.344))
 
+    def test_layer_vertices(self):
+        gcode_filepath = os.path.join(self.temp_dir.name, 'layers.gcode')
+        with open(gcode_filepath, 'w') as fp:
+            # Revisit the first layer after the second one, e.g. sequential printing
+            fp.write('G1 Z0.2\nG1 X1 Y2 E1\nG1 X3 Y4 E1\nG1 Z0.4\nG1 X5 Y6 E1\nG1 Z0.2\nG1 X-7 Y8 E1\n')
+
+        layer_vertices = self.adaptive_bed_mesh.get_layer_vertices(gcode_filepath)
+
+        self.assertListEqual(layer_vertices.keys(), [0.2, 0.4])
+        self.assertListEqual(list(layer_vertices[0.2]), [(1, 2), (3, 4), (-7, 8)])
+        self.assertListEqual(list(layer_vertices[0.4]), [(5, 6)])
+        self.assertNotIn(0.6, layer_vertices)
+
+        self.assertTupleEqual(self.adaptive_bed_mesh.get_move_min_max(layer_vertices[0.2]), ((-7, 2), (3, 8)))
+        self.assertTupleEqual(self.adaptive_bed_mesh.get_layer_min_max_before_fade(layer_vertices), ((-7, 2), (5, 8)))
+        self.assertTupleEqual(self.adaptive_bed_mesh.get_layer_min_max_before_fade(layer_vertices, 0.3),
+                              ((-7, 2), (3, 8)))
+
+    def test_get_layer_extents(self):
+        gcode_filepath = os.path.join(test_data_dir, '3d_benchy_arc_fitting.gcode')
+
+        layer_vertices = self.adaptive_bed_mesh.get_layer_vertices(gcode_filepath)
+        layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath)
+
+        self.assertListEqual(list(layer_extents.keys()), list(layer_vertices.keys()))
+
+        for fade_end in [0, 10]:
+            with self.subTest(fade_end=fade_end):
+                self.assertTupleEqual(
+                    self.adaptive_bed_mesh.get_layer_extents_min_max_before_fade(layer_extents, fade_end),
+                    self.adaptive_bed_mesh.get_layer_min_max_before_fade(layer_vertices, fade_end))
+
+    def test_get_layer_extents_early_termination(self):
+        gcode_filepath = os.path.join(test_data_dir, '3d_benchy_arc_fitting.gcode')
+        layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath)
+
+        with self.subTest('fade_end'):
+            partial_layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end=10)
+            self.assertLess(max(partial_layer_extents.keys()), 10)
+            self.assertTupleEqual(
+                self.adaptive_bed_mesh.get_layer_extents_min_max_before_fade(partial_layer_extents, 10),
+                self.adaptive_bed_mesh.get_layer_extents_min_max_before_fade(layer_extents, 10))
+
+        with self.subTest('first_layer_only'):
+            first_layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, first_layer_only=True)
+            first_layer = min(layer_extents.keys())
+            self.assertDictEqual(first_layer_extents, {first_layer: layer_extents[first_layer]})
+
+        with self.subTest('z_hop'), tempfile.TemporaryDirectory() as tmp_dir:
+            gcode_filepath = os.path.join(tmp_dir, 'z_hop.gcode')
+            with open(gcode_filepath, 'w') as fp:
+                fp.write('G1 Z0.2\nG1 X10 Y10 E1\nG1 Z20 ; hop\nG1 X100 Y100\nG1 Z0.2\nG1 X90 Y80 E1\nG1 Z0.4\nG1 X5 Y5 E1\n')
+
+            self.assertDictEqual(self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end=10),
+                                 {0.2: [10, 10, 90, 80], 0.4: [5, 5, 5, 5]})
+            self.assertDictEqual(self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, first_layer_only=True),
+                                 {0.2: [10, 10, 90, 80]})
+
+    def test_gcode_analysis_backend(self):
+        relative_gcode_filepath = os.path.join(self.temp_dir.name, 'relative.gcode')
+        with open(relative_gcode_filepath, 'w') as fp:
+            fp.write('g1 z0.2\nG1 X10 Y10 E1 ; comment\nG91\nG1 X0.1 Y-0.3 E1\nG1 Z0.2\nG1 X-3.3 E.5\n'
+                     'G90\n  G1 Y20 E1\nG1X50Y50E1\nG1 X30 E-1\nG0 Z0.6 X1 Y1 E2\n')
+
+        self.adaptive_bed_mesh.gcode_analysis_chunk_size = 4096
+        for gcode_filepath in [os.path.join(test_data_dir, '3d_benchy_arc_fitting.gcode'),
+                               os.path.join(test_data_dir, 'z-locks-200_PLA_57m7s.gcode'),
+                               relative_gcode_filepath]:
+            for kwargs in [{}, {'fade_end': 10}, {'first_layer_only': True}]:
+                with self.subTest(os.path.basename(gcode_filepath), **kwargs):
+                    self.adaptive_bed_mesh.gcode_analysis_backend = 'python'
+                    ref_layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, **kwargs)
+
+                    self.adaptive_bed_mesh.gcode_analysis_backend = 'numpy'
+                    layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, **kwargs)
+
+                    self.assertListEqual(list(layer_extents.items()), list(ref_layer_extents.items()))
+
+        with self.subTest('python_fallback'):
+            # Relative arcs are only supported by the python backend
+            gcode_filepath = os.path.join(self.temp_dir.name, 'relative_arc.gcode')
+            with open(gcode_filepath, 'w') as fp:
+                fp.write('G1 Z0.2\nG1 X10 Y10 E1\n' * 1000 + 'G91\nG2 X10 Y0 I5 J0 E1\nG90\n')
+
+            stats = dict()
+            self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, stats=stats)
+            self.assertEqual(stats['backend'], 'python')
+            self.assertFalse(stats['cache_hit'])
+            self.assertFalse(stats['index_hit'])
+            self.assertEqual(stats['bytes'], os.path.getsize(gcode_filepath))
+            self.assertEqual(stats['moves'], 2001)
+
+        with self.subTest('no_fallback_on_errors'):
+            with mock.patch.object(self.adaptive_bed_mesh, '_get_layer_extents_numpy',
+                                   side_effect=NotImplementedError), \
+                    self.assertRaises(NotImplementedError):
+                self.adaptive_bed_mesh.get_layer_extents(gcode_filepath)
+
+    def test_gcode_analysis_workers(self):
+        # Switch to relative positioning in the middle of the file, and keep the layer change far from the range
+        #   boundaries
+        relative_gcode_filepath = os.path.join(self.temp_dir.name, 'relative.gcode')
+        with open(relative_gcode_filepath, 'w') as fp:
+            fp.write('G1 Z0.2\n' + 'G1 X10 Y10 E1\nG1 X20.3 Y5.1 E1\n' * 500 + 'G91\n' + 'G1 X0.1 Y-0.3 E1\n' * 2000 +
+                     'G1 Z0.2\n' + 'G1 X-0.2 Y0.1 E1\n' * 2000 + 'G90\nG1 Z0.6\nG1 X1 Y1 E1\n')
+
+        self.adaptive_bed_mesh.gcode_analysis_backend = 'numpy'
+        self.adaptive_bed_mesh.gcode_analysis_chunk_size = 4096
+        for gcode_filepath in [os.path.join(test_data_dir, '3d_benchy_arc_fitting.gcode'),
+                               os.path.join(test_data_dir, 'z-locks-200_PLA_57m7s.gcode'),
+                               relative_gcode_filepath]:
+            for fade_end in [0, 10]:
+                with self.subTest(os.path.basename(gcode_filepath), fade_end=fade_end):
+                    self.adaptive_bed_mesh.gcode_analysis_workers = 1
+                    ref_stats = dict()
+                    ref_layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end,
+                                                                                 stats=ref_stats)
+
+                    self.adaptive_bed_mesh.gcode_analysis_workers = 3
+                    stats = dict()
+                    layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end, stats=stats)
+
+                    self.assertListEqual(list(layer_extents.items()), list(ref_layer_extents.items()))
+                    if fade_end == 0:
+                        # The heads analysed again after the merge are not counted twice
+                        self.assertDictEqual(stats, ref_stats)
+                        self.assertEqual(stats['bytes'], os.path.getsize(gcode_filepath))
+
+    def test_synthetic_gcode(self):
+        gcode_filepath = os.path.join(self.temp_dir.name, 'synthetic.gcode')
+        synthetic = generate_synthetic_gcode(gcode_filepath, 300 * 1024, seed=1)
+        ref_layer_extents = synthetic['layer_extents']
+
+        self.adaptive_bed_mesh.gcode_analysis_chunk_size = 4096
+        for backend, workers in [('python', 1), ('numpy', 1), ('numpy', 3)]:
+            self.adaptive_bed_mesh.gcode_analysis_backend = backend
+            self.adaptive_bed_mesh.gcode_analysis_workers = workers
+
+            with self.subTest(backend, workers=workers):
+                layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath)
+                self.assertListEqual(list(layer_extents.items()), list(ref_layer_extents.items()))
+
+            with self.subTest(backend, workers=workers, fade_end=10):
+                layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end=10)
+                self.assertListEqual(list(layer_extents.items()),
+                                     [(z, extents) for z, extents in ref_layer_extents.items() if z < 10])
+
+        with self.subTest('metadata'):
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(gcode_filepath),
+                                  (synthetic['first_layer_min'], synthetic['first_layer_max']))
+
+    def test_calibration_stats(self):
+        self.mocked_config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+        self.adaptive_bed_mesh.exclude_object.objects = []
+        gcode_filepath = os.path.join(self.temp_dir.name, 'synthetic.gcode')
+        generate_synthetic_gcode(gcode_filepath, 100 * 1024, seed=2)
+        gcmd = mock.MagicMock()
+        gcmd.get.side_effect = lambda name, default=None: gcode_filepath if name == 'GCODE_FILEPATH' else default
+        gcmd.get_int.side_effect = lambda name, default=None, **kwargs: default
+
+        with self.subTest('no_calibration'):
+            self.assertIsNone(self.adaptive_bed_mesh.get_status()['last_calibration'])
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_STATS(gcmd)
+            gcmd.respond_info.assert_called_with('AdaptiveBedMesh:No calibration recorded')
+
+        self.adaptive_bed_mesh.disable_gcode_metadata_boundary_detection = True
+        counters = dict()
+        for backend in ['python', 'numpy']:
+            # A variant of the file per backend, so that neither is served from the cache
+            self.adaptive_bed_mesh.gcode_analysis_backend = backend
+            gcode_filepath = os.path.join(self.temp_dir.name, backend + '.gcode')
+            shutil.copy(os.path.join(self.temp_dir.name, 'synthetic.gcode'), gcode_filepath)
+            with open(gcode_filepath, 'a') as fp:
+                fp.write('; {}\n'.format(backend[0]))
+            with self.subTest(backend):
+                self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+                stats = self.adaptive_bed_mesh.get_status()['last_calibration']
+                self.assertEqual(stats['method'], 'gcode_analysis')
+                self.assertListEqual(list(stats['method_times'].keys()),
+                                     ['slicer_min_max', 'exclude_object', 'gcode_analysis'])
+                self.assertGreaterEqual(stats['total_time'], stats['detection_time'])
+                self.assertEqual(len(stats['probe_count']), 2)
+                self.assertGreater(stats['estimated_probe_time'], 0)
+                self.assertEqual(stats['gcode_analysis']['backend'], backend)
+                self.assertFalse(stats['gcode_analysis']['cache_hit'])
+                self.assertEqual(stats['gcode_analysis']['bytes'], os.path.getsize(gcode_filepath))
+                self.assertGreater(stats['gcode_analysis']['arcs'], 0)
+                counters[backend] = {key: stats['gcode_analysis'][key] for key in ['bytes', 'lines', 'moves', 'arcs']}
+
+        with self.subTest('backends'):
+            self.assertDictEqual(counters['python'], counters['numpy'])
+
+        with self.subTest('cache_hit'):
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertTrue(self.adaptive_bed_mesh.get_status()['last_calibration']['gcode_analysis']['cache_hit'])
+
+        with self.subTest('history'):
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_STATS(gcmd)
+            self.assertEqual(len(gcmd.respond_info.call_args[0][0].splitlines()), 3)
+
+    def test_calibration_profile(self):
+        self.mocked_config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+        self.mocked_config.get_printer.return_value.get_start_args.return_value = {
+            'log_file': os.path.join(self.temp_dir.name, 'klippy.log')}
+        self.adaptive_bed_mesh.exclude_object.objects = []
+        self.adaptive_bed_mesh.disable_gcode_metadata_boundary_detection = True
+        gcode_filepath = os.path.join(self.temp_dir.name, 'synthetic.gcode')
+        generate_synthetic_gcode(gcode_filepath, 100 * 1024, seed=3)
+
+        gcmd = mock.MagicMock()
+        gcmd.get.side_effect = lambda name, default=None: gcode_filepath if name == 'GCODE_FILEPATH' else default
+        gcmd.get_int.side_effect = lambda name, default=None, **kwargs: 1 if name == 'PROFILE' else default
+        self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+
+        profile_filepath = self.adaptive_bed_mesh.get_status()['last_calibration']['profile']
+        self.assertEqual(os.path.dirname(profile_filepath), self.temp_dir.name)
+        self.assertFalse(tracemalloc.is_tracing())
+
+        with self.subTest('worker_thread'):
+            # The gcode analysis in the worker thread is included
+            functions = [name for filename, line, name in pstats.Stats(profile_filepath).stats.keys()]
+            self.assertIn('get_layer_extents', functions)
+
+        with self.subTest('memory'):
+            with open(profile_filepath[:-len('.prof')] + '-memory.txt') as fp:
+                self.assertTrue(fp.readline().startswith('Peak traced memory'))
+
+        with self.subTest('summary'):
+            summary = next(call[0][0] for call in gcmd.respond_info.call_args_list if 'Profile saved' in call[0][0])
+            self.assertEqual(len(summary.splitlines()), 7)
+
+    def test_gcode_analysis_raw_bytes(self):
+        gcode_filepath = os.path.join(self.temp_dir.name, 'thumbnail.gcode')
+        with open(gcode_filepath, 'wb') as fp:
+            fp.write(b'; thumbnail begin 32x32 1234\r\n' + b'; iVBORw0KGgoAAAANSUhEUgAAACAAAAAgCAYAAABzenr0\r\n' * 100 +
+                     b'; thumbnail end\r\n;\xff\xfe not utf-8\r\nG10 ; retract\r\nG1 Z0.2\r\nG1 X10 Y20 E1 ;\xe4\xbd\xa0\r\n'
+                     b'G1X99Y99E1\r\n  g1 x5\ty6 e1\r\nG1 X30 Y40 E1')
+        empty_gcode_filepath = os.path.join(self.temp_dir.name, 'empty.gcode')
+        open(empty_gcode_filepath, 'w').close()
+
+        self.adaptive_bed_mesh.gcode_analysis_chunk_size = 4096
+        for backend in ['python', 'numpy']:
+            with self.subTest(backend):
+                self.adaptive_bed_mesh.gcode_analysis_backend = backend
+                self.assertDictEqual(self.adaptive_bed_mesh.get_layer_extents(gcode_filepath), {0.2: [5, 6, 30, 40]})
+                self.assertDictEqual(self.adaptive_bed_mesh.get_layer_extents(empty_gcode_filepath), {})
+
+    def test_compressed_gcode(self):
+        text_filepath = os.path.join(self.temp_dir.name, 'synthetic.gcode')
+        generate_synthetic_gcode(text_filepath, 150 * 1024)
+        with open(text_filepath, 'rb') as fp:
+            text = fp.read()
+
+        gcode_filepaths = dict()
+        gcode_filepaths['gzip'] = os.path.join(self.temp_dir.name, 'synthetic.gcode.gz')
+        with gzip.open(gcode_filepaths['gzip'], 'wb') as fp:
+            fp.write(text)
+        for compression, encoding in [(0, 0), (1, 1), (2, 1), (3, 0)]:
+            name = 'bgcode_{}_{}'.format(compression, encoding)
+            gcode_filepaths[name] = os.path.join(self.temp_dir.name, name + '.bgcode')
+            write_bgcode(text, gcode_filepaths[name], compression, encoding, block_size=8 * 1024)
+
+        self.adaptive_bed_mesh.gcode_analysis_chunk_size = 16 * 1024
+        for backend in ['python', 'numpy']:
+            self.adaptive_bed_mesh.gcode_analysis_backend = backend
+            ref_layer_extents = self.adaptive_bed_mesh.get_layer_extents(text_filepath)
+            ref_partial_layer_extents = self.adaptive_bed_mesh.get_layer_extents(text_filepath, fade_end=1)
+
+            for name, gcode_filepath in gcode_filepaths.items():
+                with self.subTest(name, backend=backend):
+                    # Decompressed block by block, each ends at a line boundary
+                    with adaptive_bed_mesh.open_gcode_blocks(gcode_filepath, 16 * 1024) as blocks:
+                        blocks = list(blocks)
+                    self.assertGreater(len(blocks), 5)
+                    self.assertTrue(all(data.endswith(b'\n') for _, data in blocks))
+                    self.assertEqual(b''.join(data for _, data in blocks), text)
+
+                    stats = dict()
+                    layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, stats=stats)
+                    self.assertListEqual(list(layer_extents.items()), list(ref_layer_extents.items()))
+                    self.assertEqual(stats['bytes'], len(text))
+
+                    # Continued from the layer index
+                    layer_index = LayerIndex()
+                    self.assertDictEqual(self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end=1,
+                                                                                  layer_index=layer_index),
+                                         ref_partial_layer_extents)
+                    layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, layer_index=layer_index)
+                    self.assertListEqual(list(layer_extents.items()), list(ref_layer_extents.items()))
+
+        with self.subTest('metadata'):
+            # The metadata follows the thumbnail
+            self.adaptive_bed_mesh.gcode_metadata_scan_size = 64 * 1024
+            ref_mesh_min_max = self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(text_filepath)
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(gcode_filepaths['gzip']),
+                                  ref_mesh_min_max)
+
+            # Only the head of the gzip file is decompressed
+            truncated_filepath = os.path.join(self.temp_dir.name, 'truncated.gcode.gz')
+            with open(gcode_filepaths['gzip'], 'rb') as fp, open(truncated_filepath, 'wb') as truncated_fp:
+                truncated_fp.write(fp.read()[:-1024])
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(truncated_filepath),
+                                  ref_mesh_min_max)
+
+            # The bgcode metadata block is read without reading any gcode block
+            gcode_filepath = os.path.join(self.temp_dir.name, 'metadata.bgcode')
+            polygons = [[[10, 20], [30, 20], [30, 40]], [[50, 5], [60, 5], [60, 15]]]
+            for metadata, mesh_min_max in [
+                ({'first_layer_print_min': '10.5,20', 'first_layer_print_max': '100,110'}, ((10.5, 20), (100, 110))),
+                ({'objects_info': json.dumps({'objects': [{'name': 'part {}'.format(i), 'polygon': polygon}
+                                                          for i, polygon in enumerate(polygons)]})},
+                 ((10, 5), (60, 40))),
+            ]:
+                write_bgcode(text, gcode_filepath, 2, 1, metadata)
+                with mock.patch.object(adaptive_bed_mesh, 'heatshrink_decompress') as heatshrink_decompress:
+                    self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(gcode_filepath),
+                                          mesh_min_max)
+                    heatshrink_decompress.assert_not_called()
+
+            # Decompressing stops at the timeout, rather than running on in a worker thread the caller gave up on
+            for gcode_filepath in [gcode_filepaths['gzip'], gcode_filepath]:
+                with self.assertRaises(TimeoutError):
+                    self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(gcode_filepath, timeout=0)
+
+    def test_meatpack_heatshrink(self):
+        text = (b'; comment: G1 X1\nM104 S200\nEXCLUDE_OBJECT_START NAME=part_1\nG1 X10.5 Y-3 E.25 F3000 ; move\n' +
+                b'G1 X120.125 Y80.5 E0.0125\n' * 5) * 10
+        for no_spaces in [False, True]:
+            with self.subTest(no_spaces=no_spaces):
+                data = meatpack_encode(text, no_spaces)
+                self.assertLess(len(data), len(text))
+                decoder = adaptive_bed_mesh.MeatPackDecoder()
+                # Split in the middle of the signal bytes and the bytes of full characters
+                decoded = b''.join(decoder.decode(data[i:i + 7]) for i in range(0, len(data), 7)) + decoder.flush()
+                self.assertEqual(decoded, text)
+
+        for window_sz2 in [11, 12]:
+            with self.subTest(window_sz2=window_sz2):
+                data = heatshrink_compress(text, window_sz2, 4)
+                self.assertLess(len(data), len(text) // 4)
+                self.assertEqual(adaptive_bed_mesh.heatshrink_decompress(data, window_sz2, 4, len(text)), text)
+
+    def test_arc_extents(self):
+        gcode_filepath = os.path.join(self.temp_dir.name, 'arcs.gcode')
+        with open(gcode_filepath, 'w') as fp:
+            # Quarter arc (I/J), half arc (R), full circle, and an arc with the J omitted
+            fp.write('G1 X10 Y0 Z0.2\nG3 X0 Y10 I-10 J0 E1\n'
+                     'G1 Z0.4\nG1 X10 Y0\nG2 X-10 Y0 R10 E1\n'
+                     'G1 Z0.6\nG1 X10 Y0\nG2 X10 Y0 I-10 J0 E1\n'
+                     'G1 Z0.8\nG1 X10 Y0\nG3 X-10 I-10 E1\n')
+
+        ref_layer_extents = {0.2: [0, 0, 10, 10], 0.4: [-10, -10, 10, 0], 0.6: [-10, -10, 10, 10],
+                             0.8: [-10, 0, 10, 10]}
+        for backend in ['python', 'numpy']:
+            with self.subTest(backend):
+                self.adaptive_bed_mesh.gcode_analysis_backend = backend
+                self.assertDictEqual(self.adaptive_bed_mesh.get_layer_extents(gcode_filepath), ref_layer_extents)
+
+        # The sampled arcs of the debug output lie within the exact extents
+        layer_vertices = self.adaptive_bed_mesh.get_layer_vertices(gcode_filepath)
+        for layer, (x_min, y_min, x_max, y_max) in ref_layer_extents.items():
+            with self.subTest('sampled', layer=layer):
+                self.assertEqual(len(layer_vertices[layer]), self.adaptive_bed_mesh.arc_segments + 1)
+                for x, y in layer_vertices[layer]:
+                    self.assertTrue(x_min - 1e-9 <= x <= x_max + 1e-9 and y_min - 1e-9 <= y <= y_max + 1e-9)
+
+    def test_run_in_worker_thread(self):
+        reactor = FakeReactor()
+        self.mocked_config.get_printer.return_value.get_reactor.return_value = reactor
+
+        with self.subTest('result'):
+            self.assertEqual(self.adaptive_bed_mesh.run_in_worker_thread(lambda a, b: a + b, 10, 1, 2), 3)
+
+        with self.subTest('exception'):
+            with self.assertRaises(ValueError):
+                self.adaptive_bed_mesh.run_in_worker_thread(int, 10, 'not a number')
+
+        with self.subTest('timeout'):
+            blocker = threading.Event()
+            with self.assertRaises(TimeoutError):
+                self.adaptive_bed_mesh.run_in_worker_thread(blocker.wait, 0.1)
+            blocker.set()
+
+    def test_gcode_analysis_cache(self):
+        gcode_filepath = os.path.join(self.temp_dir.name, 'cylinder.gcode')
+        shutil.copy(os.path.join(test_data_dir, 'G2_Cylinder_PLA_12s.gcode'), gcode_filepath)
+
+        mesh_min_max = self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath)
+        self.assertTrue(os.path.exists(self.adaptive_bed_mesh.gcode_analysis_cache.cache_filepath))
+
+        with self.subTest('hit'), mock.patch.object(self.adaptive_bed_mesh, 'get_layer_extents') as get_layer_extents:
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath), mesh_min_max)
+            get_layer_extents.assert_not_called()
+
+        with self.subTest('invalidated'):
+            with open(gcode_filepath, 'a') as fp:
+                fp.write('G1 X200 Y200 Z0.2 E1\n')
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath)[1],
+                                  (200, 200))
+
+        with self.subTest('eviction'):
+            self.adaptive_bed_mesh.gcode_analysis_cache.max_entries = 1
+            self.adaptive_bed_mesh.bed_mesh_config_fade_end = 10
+            self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath)
+            with open(self.adaptive_bed_mesh.gcode_analysis_cache.cache_filepath) as fp:
+                entries = json.load(fp)
+            results = [key for key, entry in entries.items() if 'layer_index' not in entry]
+            self.assertEqual(len(results), 1)
+            self.assertEqual(json.loads(results[0])[1]['fade_end'], 10)
+            # The layer index of the file is kept along with the result
+            self.assertEqual(len(entries), 2)
+
+        with self.subTest('hit_without_write'):
+            mtime_ns = os.stat(self.adaptive_bed_mesh.gcode_analysis_cache.cache_filepath).st_mtime_ns
+            with mock.patch('json.dump') as dump:
+                self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath)
+                dump.assert_not_called()
+            self.assertEqual(os.stat(self.adaptive_bed_mesh.gcode_analysis_cache.cache_filepath).st_mtime_ns,
+                             mtime_ns)
+
+        with self.subTest('other_process'):
+            # Written by the offline analyzer while the plugin runs with the same cache file
+            cache = self.adaptive_bed_mesh.gcode_analysis_cache
+            other_filepath = os.path.join(self.temp_dir.name, 'other.gcode')
+            shutil.copy(os.path.join(test_data_dir, '3DBenchy-Voron 0.1-ABS.gcode'), other_filepath)
+            other_cache = GcodeAnalysisCache(cache.cache_filepath, 32)
+            other_cache.put(other_filepath, {'arc_segments': 1}, (1, 2), (3, 4), {})
+            self.assertEqual(cache.get(other_filepath, {'arc_segments': 1})['mesh_max'], [3, 4])
+
+            # Neither side loses the entries of the other
+            cache.put(gcode_filepath, {'arc_segments': 2}, (5, 6), (7, 8), {})
+            other_cache.put(gcode_filepath, {'arc_segments': 3}, (5, 6), (7, 8), {})
+            for settings in [{'arc_segments': 1}, {'arc_segments': 2}, {'arc_segments': 3}]:
+                self.assertTrue(GcodeAnalysisCache(cache.cache_filepath, 32).contains(
+                    other_filepath if settings['arc_segments'] == 1 else gcode_filepath, settings))
+
+        with self.subTest('copy'):
+            # Uploaded to the printer at another path, with another modification time
+            copy_filepath = os.path.join(self.temp_dir.name, 'uploaded', 'other.gcode')
+            os.makedirs(os.path.dirname(copy_filepath))
+            shutil.copyfile(other_filepath, copy_filepath)
+            os.utime(copy_filepath, ns=(0, 0))
+            self.assertEqual(cache.get(copy_filepath, {'arc_segments': 1})['mesh_max'], [3, 4])
+            self.assertIsNone(cache.get(copy_filepath, {'arc_segments': 2}))
+
+            # Edited in place
+            with open(copy_filepath, 'r+') as fp:
+                fp.write('G')
+            self.assertIsNone(cache.get(copy_filepath, {'arc_segments': 1}))
+
+        with self.subTest('edited_middle'):
+            # Same size, the head and the tail unchanged
+            large_filepath = os.path.join(self.temp_dir.name, 'large.gcode')
+            with open(large_filepath, 'w') as fp:
+                fp.write('G1 X10 Y10 E1\n' * 100000)
+            cache.put(large_filepath, {'arc_segments': 1}, (5, 6), (7, 8), {})
+            with open(large_filepath, 'r+') as fp:
+                fp.seek(len('G1 X10 Y10 E1\n') * 50000)
+                fp.write('G1 X90 Y90 E1\n')
+            self.assertIsNone(cache.get(large_filepath, {'arc_segments': 1}))
+
+    def test_layer_index(self):
+        gcode_filepath = os.path.join(self.temp_dir.name, 'synthetic.gcode')
+        generate_synthetic_gcode(gcode_filepath, 2 * 1024 * 1024, layer_height=0.5)
+        self.adaptive_bed_mesh.gcode_analysis_chunk_size = 64 * 1024
+
+        for backend, workers in [('python', 1), ('numpy', 1), ('numpy', 3)]:
+            with self.subTest(backend=backend, workers=workers):
+                self.adaptive_bed_mesh.gcode_analysis_backend = backend
+                self.adaptive_bed_mesh.gcode_analysis_workers = workers
+                ref_layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end=5)
+
+                layer_index = LayerIndex()
+                self.assertTrue(layer_index.is_empty())
+                self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end=1, layer_index=layer_index)
+                self.assertFalse(layer_index.covers(5))
+                self.assertTrue(layer_index.covers(1))
+                self.assertTrue(layer_index.covers(0, first_layer_only=True))
+                self.assertEqual(list(layer_index.offsets), list(layer_index.layer_extents))
+
+                # Continued from where the first analysis stopped
+                stats = dict()
+                layer_index = LayerIndex.from_json(json.loads(json.dumps(layer_index.to_json())))
+                layer_extents = self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end=5, stats=stats,
+                                                                         layer_index=layer_index)
+                self.assertListEqual(list(layer_extents.items()), list(ref_layer_extents.items()))
+                self.assertLess(stats['bytes'], os.path.getsize(gcode_filepath) * 0.9)
+
+                self.assertDictEqual(layer_index.query(1), self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, 1))
+                self.assertDictEqual(layer_index.query(0, first_layer_only=True),
+                                     self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, first_layer_only=True))
+
+                # To the end of the file
+                self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, layer_index=layer_index)
+                self.assertIsNone(layer_index.next)
+                self.assertTrue(layer_index.covers(0))
+                self.assertListEqual(list(layer_index.query(0).items()),
+                                     list(self.adaptive_bed_mesh.get_layer_extents(gcode_filepath).items()))
+
+        with self.subTest('cache'):
+            self.adaptive_bed_mesh.gcode_analysis_backend = 'numpy'
+            self.adaptive_bed_mesh.gcode_analysis_workers = 1
+            self.adaptive_bed_mesh.bed_mesh_config_fade_end = 5
+            mesh_min_max = self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath)
+
+            # Any lower fade height is answered from the index
+            stats = dict()
+            self.adaptive_bed_mesh.bed_mesh_config_fade_end = 2
+            with mock.patch.object(self.adaptive_bed_mesh, 'get_layer_extents') as get_layer_extents:
+                self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, stats=stats)
+                get_layer_extents.assert_not_called()
+            self.assertFalse(stats['cache_hit'])
+            self.assertTrue(stats['index_hit'])
+
+            # A higher fade height continues the analysis
+            stats = dict()
+            self.adaptive_bed_mesh.bed_mesh_config_fade_end = 10
+            self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, stats=stats)
+            self.assertFalse(stats['index_hit'])
+            self.assertLess(stats['bytes'], os.path.getsize(gcode_filepath) * 0.9)
+
+            self.adaptive_bed_mesh.bed_mesh_config_fade_end = 5
+            self.adaptive_bed_mesh.gcode_analysis_cache.max_entries = 0
+            self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath),
+                                  mesh_min_max)
+
+    def test_gcode_analysis_time_budget(self):
+        gcode_filepath = os.path.join(self.temp_dir.name, 'synthetic.gcode')
+        generate_synthetic_gcode(gcode_filepath, 2 * 1024 * 1024, layer_height=0.5)
+        self.adaptive_bed_mesh.gcode_analysis_chunk_size = 64 * 1024
+        self.adaptive_bed_mesh.bed_mesh_config_fade_end = 20
+        self.adaptive_bed_mesh.budget_check_interval = 100
+
+        for backend in ['python', 'numpy']:
+            with self.subTest(backend=backend):
+                self.adaptive_bed_mesh.gcode_analysis_backend = backend
+                self.adaptive_bed_mesh.gcode_analysis_cache = GcodeAnalysisCache(
+                    os.path.join(self.temp_dir.name, backend + '.json'), 8)
+                ref_mesh_min, ref_mesh_max = self.adaptive_bed_mesh.get_layer_extents_min_max_before_fade(
+                    self.adaptive_bed_mesh.get_layer_extents(gcode_filepath, fade_end=20), 20)
+
+                # Each deadline check takes a second
+                clock = itertools.count()
+                stats = dict()
+                with mock.patch('time.monotonic', side_effect=lambda: float(next(clock))):
+                    mesh_min, mesh_max = self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(
+                        gcode_filepath, stats=stats, time_budget=3)
+                self.assertEqual(stats['mode'], 'partial')
+                self.assertLess(stats['bytes'], 256 * 1024)
+                self.assertTrue(all(ref <= v for ref, v in zip(ref_mesh_min, mesh_min)))
+                self.assertTrue(all(v <= ref for ref, v in zip(ref_mesh_max, mesh_max)))
+                self.assertIn('partial', self.adaptive_bed_mesh.format_calibration_stats(
+                    {'time': 0, 'method': 'gcode_analysis', 'detection_time': 0, 'method_times': {},
+                     'gcode_analysis': stats, 'probe_count': [3, 3], 'bed_mesh_calibrate_time': 0,
+                     'estimated_probe_time': 0, 'total_time': 0}))
+
+                # The partial result isn't cached, the analysis continues from where it stopped
+                stats = dict()
+                self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(
+                    gcode_filepath, stats=stats, time_budget=60), (ref_mesh_min, ref_mesh_max))
+                self.assertEqual(stats['mode'], 'complete')
+                self.assertFalse(stats['cache_hit'])
+                self.assertLess(stats['bytes'], os.path.getsize(gcode_filepath) * 0.9)
+
+                stats = dict()
+                self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, stats=stats)
+                self.assertTrue(stats['cache_hit'])
+                self.assertEqual(stats['mode'], 'complete')
+
+        with self.subTest('fallback'):
+            self.adaptive_bed_mesh.gcode_analysis_cache = None
+            with self.assertRaises(ValueError):
+                self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, time_budget=0)
+
+        with self.subTest('timeout'):
+            self.adaptive_bed_mesh.gcode_analysis_backend = 'python'
+            self.adaptive_bed_mesh.gcode_analysis_cache = GcodeAnalysisCache(
+                os.path.join(self.temp_dir.name, 'timeout.json'), 8)
+            clock = itertools.count()
+            with mock.patch('time.monotonic', side_effect=lambda: float(next(clock))):
+                with self.assertRaises(TimeoutError):
+                    self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, time_budget=60, timeout=3)
+
+                # A time budget shorter than the timeout still gives a partial result
+                stats = dict()
+                self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, stats=stats, time_budget=3,
+                                                                         timeout=60)
+                self.assertEqual(stats['mode'], 'partial')
+
+            # The analysis continues from where the timeout stopped it
+            stats = dict()
+            self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, stats=stats)
+            self.assertEqual(stats['mode'], 'complete')
+            self.assertLess(stats['bytes'], os.path.getsize(gcode_filepath) * 0.9)
+
+        with self.subTest('worker_timeout'):
+            # The stats of a worker that timed out are dropped, it may still be running
+            blocker = threading.Event()
+            self.addCleanup(blocker.set)
+
+            def blocked_analysis(gcode_filepath, checkpoint, stats, time_budget, timeout):
+                stats['bytes'] = 1
+                blocker.wait()
+
+            self.mocked_config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+            self.adaptive_bed_mesh.exclude_object.objects = []
+            self.adaptive_bed_mesh.disable_gcode_metadata_boundary_detection = True
+            self.adaptive_bed_mesh.gcode_analysis_timeout = 0.1
+            gcmd = mock.MagicMock()
+            gcmd.get.side_effect = lambda name, default=None: gcode_filepath if name == 'GCODE_FILEPATH' else default
+            stats = {'method_times': dict(), 'gcode_analysis': dict()}
+            with mock.patch.object(self.adaptive_bed_mesh, 'generate_mesh_with_gcode_analysis', blocked_analysis):
+                self.adaptive_bed_mesh.detect_mesh_boundary(gcmd, stats)
+            self.assertDictEqual(stats['gcode_analysis'], {'mode': 'fallback'})
+
+    def test_offline_analysis(self):
+        gcode_dir = os.path.join(self.temp_dir.name, 'farm')
+        os.makedirs(os.path.join(gcode_dir, 'plate'))
+        synthetic_results = dict()
+        for i, name in enumerate(['a.gcode', 'plate/b.gcode', 'plate/c.gcode']):
+            gcode_filepath = os.path.join(gcode_dir, name)
+            synthetic_results[gcode_filepath] = generate_synthetic_gcode(gcode_filepath, 100 * 1024, seed=i)
+        open(os.path.join(gcode_dir, 'readme.txt'), 'w').close()
+
+        output_filepath = os.path.join(self.temp_dir.name, 'result.json')
+        cache_filepath = os.path.join(self.temp_dir.name, 'cache.json')
+
+        with self.subTest('analysis'):
+            self.assertEqual(adaptive_bed_mesh.main(
+                ['analyze', gcode_dir, '--mesh-min', '0,0', '--mesh-max', '350,350', '--jobs', '2',
+                 '--set', 'disable_gcode_metadata_boundary_detection=True', '--output', output_filepath,
+                 '--cache', cache_filepath]), 0)
+            with open(output_filepath) as fp:
+                results = json.load(fp)['files']
+
+            self.assertListEqual(list(results), list(synthetic_results))
+            for gcode_filepath, result in results.items():
+                self.assertEqual(result['method'], 'gcode_analysis')
+                self.assertListEqual(result['mesh_min'], list(synthetic_results[gcode_filepath]['mesh_min']))
+                self.assertListEqual(result['mesh_max'], list(synthetic_results[gcode_filepath]['mesh_max']))
+                self.assertEqual(len(result['probe_points']), result['probe_count'][0] * result['probe_count'][1])
+                self.assertIn('PROBE_COUNT={},{}'.format(*result['probe_count']), result['params'])
+
+            # Served from the cache by the plugin
+            self.adaptive_bed_mesh.gcode_analysis_cache = GcodeAnalysisCache(cache_filepath, 32)
+            for gcode_filepath, result in results.items():
+                stats = dict()
+                self.assertTupleEqual(
+                    self.adaptive_bed_mesh.generate_mesh_with_gcode_analysis(gcode_filepath, stats=stats),
+                    (tuple(result['mesh_min']), tuple(result['mesh_max'])))
+                self.assertTrue(stats['cache_hit'])
+
+        with self.subTest('config'):
+            config_filepath = os.path.join(self.temp_dir.name, 'printer.cfg')
+            with open(config_filepath, 'w') as fp:
+                fp.write('[bed_mesh]\nmesh_min: 10, 10\nmesh_max: 200,200  # small bed\n\n'
+                         '[gcode_macro PRINT_START]\ngcode:\n    {% set x = 1 %}\n    ADAPTIVE_BED_MESH_CALIBRATE\n\n'
+                         '[adaptive_bed_mesh]\nmax_probe_horizontal_distance: 10\nmesh_area_clearance = 0\n')
+
+            gcode_filepath = os.path.join(gcode_dir, 'a.gcode')
+            self.assertEqual(adaptive_bed_mesh.main(['analyze', gcode_filepath, '--config', config_filepath, '--jobs',
+                                                     '1', '--output', output_filepath]), 0)
+            with open(output_filepath) as fp:
+                result = json.load(fp)['files'][gcode_filepath]
+
+            # The first layer bounds from the metadata, limited to the bed_mesh area
+            self.assertEqual(result['method'], 'gcode_metadata')
+            mesh_min = synthetic_results[gcode_filepath]['first_layer_min']
+            mesh_max = synthetic_results[gcode_filepath]['first_layer_max']
+            self.assertListEqual(result['mesh_min'], list(mesh_min))
+            self.assertEqual(result['probe_points'][0], [max(10, mesh_min[0]), max(10, mesh_min[1])])
+
+            self.adaptive_bed_mesh.max_probe_horizontal_distance = 10
+            self.adaptive_bed_mesh.mesh_area_clearance = 0
+            self.adaptive_bed_mesh.bed_mesh_config_mesh_min = (10., 10.)
+            self.adaptive_bed_mesh.bed_mesh_config_mesh_max = (200., 200.)
+            self.assertEqual(result['params'], self.adaptive_bed_mesh.generate_bed_mesh_params(mesh_min, mesh_max))
+
+        with self.subTest('probe_density'):
+            # Looks up the optional heater_bed, which the offline printer doesn't have
+            gcode_filepath = os.path.join(gcode_dir, 'a.gcode')
+            self.assertEqual(adaptive_bed_mesh.main(['analyze', gcode_filepath, '--mesh-min', '0,0', '--mesh-max',
+                                                     '350,350', '--set', 'probe_density_tolerance=0.05',
+                                                     '--output', output_filepath]), 0)
+            with open(output_filepath) as fp:
+                self.assertNotIn('error', json.load(fp)['files'][gcode_filepath])
+
+        with self.subTest('error'):
+            self.assertEqual(adaptive_bed_mesh.main(['analyze', os.path.join(gcode_dir, 'missing.gcode'),
+                                                     '--mesh-min', '0,0', '--mesh-max', '350,350',
+                                                     '--output', output_filepath]), 1)
+            with open(output_filepath) as fp:
+                self.assertIn('error', list(json.load(fp)['files'].values())[0])
+
+    def test_gcode_pre_analysis(self):
+        gcode_dir = self.adaptive_bed_mesh.virtual_sdcard_path
+        os.makedirs(gcode_dir)
+        for gcode_filename in ['G2_Cylinder_PLA_12s.gcode', 'z-locks-200_PLA_57m7s.gcode']:
+            shutil.copy(os.path.join(test_data_dir, gcode_filename), gcode_dir)
+
+        pre_analyser = GcodePreAnalyser(self.adaptive_bed_mesh, 60)
+        settings = self.adaptive_bed_mesh.get_gcode_analysis_settings()
+
+        with self.subTest('queue'):
+            pre_analyser.scan_directory()
+            self.assertEqual(pre_analyser.get_status()['queue_depth'], 2)
+
+        with self.subTest('interrupted'):
+            pre_analyser.is_printing.set()
+            gcode_filepath = pre_analyser.queue.popleft()
+            pre_analyser.analyse(gcode_filepath)
+            self.assertEqual(pre_analyser.queue[0], gcode_filepath)
+            self.assertFalse(self.adaptive_bed_mesh.gcode_analysis_cache.contains(gcode_filepath, settings))
+            pre_analyser.is_printing.clear()
+
+        with self.subTest('analysed'):
+            while pre_analyser.queue:
+                pre_analyser.analyse(pre_analyser.queue.popleft())
+            self.assertEqual(pre_analyser.get_status()['completed_files'], 2)
+            for gcode_filepath in pre_analyser.known_files:
+                self.assertTrue(self.adaptive_bed_mesh.gcode_analysis_cache.contains(gcode_filepath, settings))
+
+        with self.subTest('modified'):
+            pre_analyser.scan_directory()
+            self.assertEqual(len(pre_analyser.queue), 0)
+
+            with open(os.path.join(gcode_dir, 'G2_Cylinder_PLA_12s.gcode'), 'a') as fp:
+                fp.write('\n')
+            pre_analyser.scan_directory()
+            self.assertListEqual(list(pre_analyser.queue), [os.path.join(gcode_dir, 'G2_Cylinder_PLA_12s.gcode')])
+
+    def test_generate_mesh_with_gcode_metadata(self):
+        with self.subTest('exclude_object'):
+            mesh_min, mesh_max = self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(
+                os.path.join(test_data_dir, 'Rear Right Foot_one_piece_ABS_5h54m.gcode'))
+            self.assertTupleEqual(mesh_min, (40.2856, 39.8259))
+            self.assertTupleEqual(mesh_max, (77.6253, 77.1657))
+
+        with self.subTest('no_metadata'):
+            with self.assertRaises(ValueError):
+                self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(
+                    os.path.join(test_data_dir, '3DBenchy-Voron 0.1-ABS.gcode'))
+
+        # Metadata at both the head and the tail of a file larger than the scan size
+        self.adaptive_bed_mesh.gcode_metadata_scan_size = 1024
+        padding = 'G1 X1 Y1 E1\n' * 1000
+        for name, head, tail, ref_mesh_min_max in [
+            ('first_layer_print', '; first_layer_print_min = 10.5,20\n', '; first_layer_print_max = 100,-1.5\n',
+             ((10.5, 20), (100, -1.5))),
+            ('cura', ';FLAVOR:Marlin\n;MINX:1\n;MINY:2\n;MAXX:3\n;MAXY:4\n', '', ((1, 2), (3, 4))),
+        ]:
+            with self.subTest(name):
+                gcode_filepath = os.path.join(self.temp_dir.name, name + '.gcode')
+                with open(gcode_filepath, 'w') as fp:
+                    fp.write(head + padding + tail)
+
+                self.assertTupleEqual(self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata(gcode_filepath),
+                                      ref_mesh_min_max)
+
+        with self.subTest('worker_thread'):
+            # A gzip file is decompressed away from the reactor
+            gcode_filepath = os.path.join(self.temp_dir.name, 'first_layer_print.gcode.gz')
+            with gzip.open(gcode_filepath, 'wt') as gz_fp:
+                gz_fp.write('; first_layer_print_min = 10.5,20\n; first_layer_print_max = 100,-1.5\n' + padding)
+            self.mocked_config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+            self.adaptive_bed_mesh.exclude_object.objects = []
+            gcmd = mock.MagicMock()
+            gcmd.get.side_effect = lambda name, default=None: gcode_filepath if name == 'GCODE_FILEPATH' else default
+            stats = {'method_times': dict(), 'gcode_analysis': dict()}
+            with mock.patch.object(self.adaptive_bed_mesh, 'run_in_worker_thread',
+                                   wraps=self.adaptive_bed_mesh.run_in_worker_thread) as run_in_worker_thread:
+                self.assertTupleEqual(self.adaptive_bed_mesh.detect_mesh_boundary(gcmd, stats),
+                                      ((10.5, 20), (100, -1.5)))
+            self.assertEqual(stats['method'], 'gcode_metadata')
+            self.assertEqual(run_in_worker_thread.call_args[0][0],
+                             self.adaptive_bed_mesh.generate_mesh_with_gcode_metadata)
+            # The worker stops at the same timeout as the reactor gives up at
+            self.assertEqual(run_in_worker_thread.call_args[0][3], self.adaptive_bed_mesh.gcode_analysis_timeout)
+
+    def test_reuse_reference_mesh(self):
+        self.mocked_config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+        self.adaptive_bed_mesh.reuse_reference_mesh = True
+        self.adaptive_bed_mesh.bed_mesh = mock.MagicMock()
+        self.adaptive_bed_mesh.gcode = mock.MagicMock()
+
+        # A tilted bed, and a 7x7 reference mesh of the full bed
+        def bed_height(x, y):
+            return 0.001 * x + 0.002 * y
+
+        coords = numpy.linspace(0, 350, 7)
+        profiles = {'full': {'points': [[bed_height(x, y) for x in coords] for y in coords],
+                             'mesh_params': {'min_x': 0, 'max_x': 350, 'min_y': 0, 'max_y': 350, 'x_count': 7,
+                                             'y_count': 7, 'mesh_x_pps': 2, 'mesh_y_pps': 2, 'algo': 'lagrange',
+                                             'tension': 0.2}}}
+        self.adaptive_bed_mesh.bed_mesh.pmgr.get_profiles.return_value = profiles
+
+        heater_bed = mock.MagicMock()
+        heater_bed.get_status.return_value = {'temperature': 60.}
+        probe = mock.MagicMock()
+        probe.get_offsets.return_value = (-10, 20, 1)
+        self.mocked_config.get_printer.return_value.lookup_object.side_effect = \
+            lambda name, default=None: {'heater_bed': heater_bed, 'probe': probe}[name]
+
+        # PROBE reports the bed height under the probe, plus the drift since the reference
+        drift = {'offset': 0, 'tilt': 0}
+
+        def run_script_from_command(script):
+            match = re.search(r'X(\S+) Y(\S+) F\S+\nPROBE$', script)
+            if match is not None:
+                x, y = float(match.group(1)) - 10, float(match.group(2)) + 20
+                probe.get_status.return_value = {
+                    'last_z_result': bed_height(x, y) + drift['offset'] + drift['tilt'] * x}
+
+        self.adaptive_bed_mesh.gcode.run_script_from_command.side_effect = run_script_from_command
+
+        gcmd = mock.MagicMock()
+        gcmd.get.side_effect = lambda name, default=None: {'AREA_START': '100,100', 'AREA_END': '200,200',
+                                                           'NAME': 'full'}.get(name, default)
+        gcmd.get_int.side_effect = lambda name, default=None, **kwargs: default
+
+        def get_scripts():
+            return [call[0][0] for call in self.adaptive_bed_mesh.gcode.run_script_from_command.call_args_list]
+
+        with self.subTest('no_reference'):
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertTrue(get_scripts()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+
+        with self.subTest('reference'):
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_REFERENCE_CALIBRATE(gcmd)
+            self.assertEqual(get_scripts()[-1], 'BED_MESH_CALIBRATE PROFILE=full')
+            self.assertEqual(self.adaptive_bed_mesh.reference_meshes.load()['full']['bed_temperature'], 60.)
+
+        with self.subTest('reused'):
+            # An offset of the whole bed is not a drift
+            drift['offset'] = 0.3
+            self.adaptive_bed_mesh.gcode.run_script_from_command.reset_mock()
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertEqual(sum(script.endswith('PROBE') for script in get_scripts()), 5)
+            self.assertEqual(get_scripts()[-1], 'BED_MESH_PROFILE LOAD=adaptive_bed_mesh')
+
+            stats = self.adaptive_bed_mesh.get_status()['last_calibration']
+            self.assertEqual(stats['reused_profile'], 'full')
+            self.assertAlmostEqual(stats['drift'], 0)
+
+            # Resampled onto the adaptive grid, relative to the zero reference
+            reused = profiles['adaptive_bed_mesh']
+            mesh_params = reused['mesh_params']
+            self.assertListEqual([mesh_params['min_x'], mesh_params['min_y'], mesh_params['max_x'],
+                                  mesh_params['max_y']], [95, 95, 205, 205])
+            self.assertListEqual([mesh_params['x_count'], mesh_params['y_count']], stats['probe_count'])
+            x_coords = numpy.linspace(95, 205, mesh_params['x_count'])
+            y_coords = numpy.linspace(95, 205, mesh_params['y_count'])
+            _, probe_points, relative_reference_index = self.adaptive_bed_mesh.get_probe_points((95, 95), (205, 205))
+            zero_reference_height = bed_height(*probe_points[relative_reference_index])
+            numpy.testing.assert_allclose(reused['points'], [[bed_height(x, y) - zero_reference_height for x in x_coords]
+                                                              for y in y_coords], atol=1e-12)
+
+        with self.subTest('drifted'):
+            drift['tilt'] = 0.001
+            self.adaptive_bed_mesh.gcode.run_script_from_command.reset_mock()
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertTrue(get_scripts()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+            drift['tilt'] = 0
+
+        with self.subTest('temperature'):
+            heater_bed.get_status.return_value = {'temperature': 100.}
+            self.adaptive_bed_mesh.gcode.run_script_from_command.reset_mock()
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertFalse(any(script.endswith('PROBE') for script in get_scripts()))
+            self.assertTrue(get_scripts()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+            heater_bed.get_status.return_value = {'temperature': 60.}
+
+        with self.subTest('expired'):
+            self.adaptive_bed_mesh.reference_meshes.put('full', time.time() - 7200, 60.)
+            self.adaptive_bed_mesh.gcode.run_script_from_command.reset_mock()
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertTrue(get_scripts()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+
+        with self.subTest('not_covered'):
+            self.adaptive_bed_mesh.reference_meshes.put('full', time.time(), 60.)
+            profiles['full']['mesh_params']['max_x'] = 150
+            self.adaptive_bed_mesh.gcode.run_script_from_command.reset_mock()
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertTrue(get_scripts()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+
+    def test_probe_density_from_history(self):
+        self.adaptive_bed_mesh.probe_density_tolerance = 0.02
+        self.adaptive_bed_mesh.bed_mesh = mock.MagicMock()
+        self.adaptive_bed_mesh.gcode = mock.MagicMock()
+        self.mocked_config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+        heater_bed = mock.MagicMock()
+        heater_bed.get_status.return_value = {'temperature': 60.}
+        self.mocked_config.get_printer.return_value.lookup_object.side_effect = \
+            lambda name, default=None: {'heater_bed': heater_bed}.get(name, default)
+
+        coords = numpy.linspace(0, 350, 11)
+        mesh_params = {'min_x': 0, 'max_x': 350, 'min_y': 0, 'max_y': 350, 'x_count': 11, 'y_count': 11,
+                       'mesh_x_pps': 2, 'mesh_y_pps': 2, 'algo': 'lagrange', 'tension': 0.2}
+        profiles = dict()
+        self.adaptive_bed_mesh.bed_mesh.pmgr.get_profiles.return_value = profiles
+
+        def record(bed_height):
+            if os.path.exists(self.adaptive_bed_mesh.mesh_history.filepath):
+                os.remove(self.adaptive_bed_mesh.mesh_history.filepath)
+            profiles['default'] = {'points': [[bed_height(x, y) for x in coords] for y in coords],
+                                   'mesh_params': mesh_params}
+            self.adaptive_bed_mesh.record_mesh_history('default')
+
+        with self.subTest('no_history'):
+            stats = dict()
+            probe_count, _, _ = self.adaptive_bed_mesh.get_probe_points((20, 20), (320, 320), stats)
+            self.assertEqual(probe_count, (6, 6))
+            self.assertNotIn('predicted_interpolation_error', stats)
+
+        with self.subTest('tilted'):
+            # Exact from the corners
+            record(lambda x, y: 0.001 * x + 0.002 * y)
+            stats = dict()
+            probe_count, probe_points, _ = self.adaptive_bed_mesh.get_probe_points((20, 20), (320, 320), stats)
+            self.assertEqual(probe_count, (3, 3))
+            self.assertEqual(len(probe_points), 9)
+            self.assertListEqual(stats['full_probe_count'], [6, 6])
+            self.assertAlmostEqual(stats['predicted_interpolation_error'], 0)
+
+        with self.subTest('warped'):
+            record(lambda x, y: 0.2 * math.sin(x / 25) * math.sin(y / 25))
+            stats = dict()
+            probe_count, _, _ = self.adaptive_bed_mesh.get_probe_points((20, 20), (320, 320), stats)
+            self.assertEqual(probe_count, (6, 6))
+            self.assertNotIn('full_probe_count', stats)
+            self.assertGreater(stats['predicted_interpolation_error'], 0.02)
+
+        with self.subTest('temperature'):
+            record(lambda x, y: 0.001 * x + 0.002 * y)
+            heater_bed.get_status.return_value = {'temperature': 100.}
+            probe_count, _, _ = self.adaptive_bed_mesh.get_probe_points((20, 20), (320, 320))
+            self.assertEqual(probe_count, (6, 6))
+            heater_bed.get_status.return_value = {'temperature': 60.}
+
+        with self.subTest('expired'):
+            os.remove(self.adaptive_bed_mesh.mesh_history.filepath)
+            self.adaptive_bed_mesh.mesh_history.put(time.time() - 8 * 24 * 3600, 60., profiles['default']['points'],
+                                                    mesh_params)
+            probe_count, _, _ = self.adaptive_bed_mesh.get_probe_points((20, 20), (320, 320))
+            self.assertEqual(probe_count, (6, 6))
+
+        with self.subTest('calibrate'):
+            # Only the meshes probed at the full density are recorded
+            os.remove(self.adaptive_bed_mesh.mesh_history.filepath)
+            gcmd = mock.MagicMock()
+            gcmd.get.side_effect = lambda name, default=None: {'AREA_START': '20,20',
+                                                               'AREA_END': '320,320'}.get(name, default)
+            gcmd.get_int.side_effect = lambda name, default=None, **kwargs: default
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertEqual(len(self.adaptive_bed_mesh.mesh_history.load()), 1)
+
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            stats = self.adaptive_bed_mesh.get_status()['last_calibration']
+            self.assertListEqual(stats['probe_count'], [3, 3])
+            self.assertEqual(len(self.adaptive_bed_mesh.mesh_history.load()), 1)
+
+    def test_mesh_memo(self):
+        self.adaptive_bed_mesh.mesh_memo_size = 2
+        self.adaptive_bed_mesh.bed_mesh = mock.MagicMock()
+        self.adaptive_bed_mesh.gcode = mock.MagicMock()
+        self.mocked_config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+        heater_bed = mock.MagicMock()
+        heater_bed.get_status.return_value = {'temperature': 60.}
+        gcode_move = mock.MagicMock()
+        gcode_move.get_status.return_value = {'homing_origin': [0., 0., 0.]}
+        self.mocked_config.get_printer.return_value.lookup_object.side_effect = \
+            lambda name, default=None: {'heater_bed': heater_bed, 'gcode_move': gcode_move}.get(name, default)
+
+        # BED_MESH_CALIBRATE saves the probed mesh as the default profile
+        profiles = dict()
+        self.adaptive_bed_mesh.bed_mesh.pmgr.get_profiles.return_value = profiles
+
+        def run_script_from_command(script):
+            if script.startswith('BED_MESH_CALIBRATE'):
+                profiles['default'] = {'points': [[0.] * 3] * 3, 'mesh_params': {'script': script}}
+
+        self.adaptive_bed_mesh.gcode.run_script_from_command.side_effect = run_script_from_command
+
+        def calibrate(area_start='100,100', area_end='200,200'):
+            self.adaptive_bed_mesh.gcode.run_script_from_command.reset_mock()
+            gcmd = mock.MagicMock()
+            gcmd.get.side_effect = lambda name, default=None: {'AREA_START': area_start,
+                                                               'AREA_END': area_end}.get(name, default)
+            gcmd.get_int.side_effect = lambda name, default=None, **kwargs: default
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            return [call[0][0] for call in self.adaptive_bed_mesh.gcode.run_script_from_command.call_args_list]
+
+        with self.subTest('miss'):
+            self.assertTrue(calibrate()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+            self.assertIn('adaptive_bed_mesh_memo_1', profiles)
+
+        with self.subTest('hit'):
+            self.assertListEqual(calibrate(), ['BED_MESH_PROFILE LOAD=adaptive_bed_mesh_memo_1'])
+            stats = self.adaptive_bed_mesh.get_status()['last_calibration']
+            self.assertEqual(stats['memo_profile'], 'adaptive_bed_mesh_memo_1')
+            self.assertIn('memoized profile adaptive_bed_mesh_memo_1',
+                          self.adaptive_bed_mesh.format_calibration_stats(stats))
+
+        with self.subTest('temperature'):
+            heater_bed.get_status.return_value = {'temperature': 70.}
+            self.assertTrue(calibrate()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+            # Replaced by the mesh probed at the new temperature
+            self.assertNotIn('adaptive_bed_mesh_memo_1', profiles)
+            self.assertListEqual(calibrate(), ['BED_MESH_PROFILE LOAD=adaptive_bed_mesh_memo_2'])
+
+        with self.subTest('count'):
+            calibrate('50,50', '150,150')
+            calibrate('150,150', '250,250')
+            self.assertEqual(len(self.adaptive_bed_mesh.mesh_memo), 2)
+            self.assertNotIn('adaptive_bed_mesh_memo_2', profiles)
+            self.assertTrue(calibrate()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+
+        with self.subTest('age'):
+            for entry in self.adaptive_bed_mesh.mesh_memo.values():
+                entry['time'] -= 7200
+            self.assertTrue(calibrate()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+            self.assertEqual(len(self.adaptive_bed_mesh.mesh_memo), 1)
+
+        with self.subTest('z_offset'):
+            gcode_move.get_status.return_value = {'homing_origin': [0., 0., 0.05]}
+            self.assertTrue(calibrate()[-1].startswith('BED_MESH_CALIBRATE MESH_MIN'))
+            self.assertEqual(len(self.adaptive_bed_mesh.mesh_memo), 1)
+            self.assertListEqual(calibrate()[-1:], ['BED_MESH_PROFILE LOAD=adaptive_bed_mesh_memo_7'])
+
+        with self.subTest('clear'):
+            # On the motor_off event
+            self.adaptive_bed_mesh.clear_mesh_memo()
+            self.assertFalse(self.adaptive_bed_mesh.mesh_memo)
+            self.assertFalse([name for name in profiles if name.startswith('adaptive_bed_mesh_memo_')])
+
+    def test_idle_probe_points(self):
+        self.mocked_config.get_printer.return_value.get_reactor.return_value = FakeReactor()
+        self.adaptive_bed_mesh.occupancy_resolution = 2
+        self.adaptive_bed_mesh.gcode = mock.MagicMock()
+
+        # Two parts in opposite corners of the bed, probed on a 6x6 grid from 15 to 325
+        squares = [(20, 40), (300, 320)]
+        self.adaptive_bed_mesh.exclude_object.objects = [
+            {'name': 'part_{}'.format(n), 'polygon': [[a, a], [b, a], [b, b], [a, b], [a, a]]}
+            for n, (a, b) in enumerate(squares)]
+        gcode_filepath = os.path.join(self.temp_dir.name, 'corners.gcode')
+        with open(gcode_filepath, 'w') as fp:
+            for a, b in squares:
+                fp.write('G1 X{a} Y{a} Z0.2\nG1 X{b} E1\nG1 Y{b} E1\nG1 X{a} E1\nG1 Y{a} E1\n'.format(a=a, b=b))
+
+        gcmd = mock.MagicMock()
+        gcmd.get.side_effect = lambda name, default=None: gcode_filepath if name == 'GCODE_FILEPATH' else default
+        params = dict()
+        gcmd.get_int.side_effect = lambda name, default=None, **kwargs: params.get(name, default)
+        self.adaptive_bed_mesh.disable_gcode_metadata_boundary_detection = True
+
+        with self.subTest('opt_in'):
+            # The gcode isn't read for the footprint without OCCUPANCY=1
+            self.adaptive_bed_mesh.disable_exclude_object_boundary_detection = True
+            with mock.patch.object(self.adaptive_bed_mesh, 'get_gcode_occupancy',
+                                   wraps=self.adaptive_bed_mesh.get_gcode_occupancy) as get_gcode_occupancy:
+                self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            self.assertTrue(get_gcode_occupancy.call_args[0][-1])
+            stats = self.adaptive_bed_mesh.get_status()['last_calibration']
+            self.assertEqual(stats['method'], 'gcode_analysis')
+            self.assertNotIn('idle_probe_points', stats)
+
+        idle_probe_points = dict()
+        for method in ['exclude_object', 'gcode_analysis']:
+            with self.subTest(method):
+                # The exclude object polygons are used either way
+                params['OCCUPANCY'] = int(method == 'gcode_analysis')
+                self.adaptive_bed_mesh.disable_exclude_object_boundary_detection = method != 'exclude_object'
+                self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+
+                stats = self.adaptive_bed_mesh.get_status()['last_calibration']
+                self.assertEqual(stats['method'], method)
+                self.assertListEqual(stats['probe_count'], [6, 6])
+                idle_probe_points[method] = stats['idle_probe_points']
+
+                # The diagonal between the parts is away from the print, the points around the parts are not
+                self.assertIn([139, 139], stats['idle_probe_points'])
+                self.assertIn([201, 201], stats['idle_probe_points'])
+                self.assertIn([15, 325], stats['idle_probe_points'])
+                self.assertNotIn([77, 77], stats['idle_probe_points'])
+                self.assertNotIn([263, 263], stats['idle_probe_points'])
+                self.assertLess(stats['occupied_ratio'], 0.05)
+
+        with self.subTest('same_footprint'):
+            self.assertListEqual(idle_probe_points['exclude_object'], idle_probe_points['gcode_analysis'])
+
+        with self.subTest('cached'):
+            # The footprint isn't read again, and is used without OCCUPANCY=1 too
+            params.pop('OCCUPANCY')
+            with mock.patch.object(self.adaptive_bed_mesh, 'iter_extrude_moves') as iter_extrude_moves:
+                self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            iter_extrude_moves.assert_not_called()
+            stats = self.adaptive_bed_mesh.get_status()['last_calibration']
+            self.assertListEqual(stats['idle_probe_points'], idle_probe_points['gcode_analysis'])
+
+        with self.subTest('deadline'):
+            self.adaptive_bed_mesh.gcode_analysis_cache = None
+            self.adaptive_bed_mesh.budget_check_interval = 1
+            self.assertIsNone(self.adaptive_bed_mesh.get_gcode_occupancy(gcode_filepath, (15, 15), (325, 325),
+                                                                         time.monotonic()))
+
+        with self.subTest('no_time_left'):
+            self.adaptive_bed_mesh.gcode_analysis_timeout = 0
+            self.adaptive_bed_mesh.cmd_ADAPTIVE_BED_MESH_CALIBRATE(gcmd)
+            stats = self.adaptive_bed_mesh.get_status()['last_calibration']
+            self.assertNotIn('idle_probe_points', stats)
+
+    def test_occupancy_grid(self):
+        occupancy = OccupancyGrid((0, 0), (10, 10), 1)
+        self.assertTupleEqual(occupancy.cells.shape, (11, 11))
+
+        with self.subTest('polygon'):
+            # A triangle covers about half of the square
+            occupancy.add_polygon([[0, 0], [10, 0], [0, 10]])
+            self.assertTrue(occupancy.cells[1, 1])
+            self.assertFalse(occupancy.cells[8, 8])
+            self.assertAlmostEqual(occupancy.cells[:10, :10].mean(), 0.55 + 0.1, delta=0.1)
+
+        with self.subTest('segment'):
+            occupancy.add_segments([9.5], [0.5], [9.5], [9.5])
+            self.assertTrue(occupancy.cells[:10, 9].all())
+
+        with self.subTest('outside'):
+            occupancy.add_points([-5, 20], [5, 5])
+            self.assertFalse(occupancy.cells[5, 10])
+
+    def test_estimate_probe_time(self):
+        self.adaptive_bed_mesh.bed_mesh_config_speed = 100
+        self.adaptive_bed_mesh.bed_mesh_config_horizontal_move_z = 5
+        self.adaptive_bed_mesh.probe_speed = 5
+        self.adaptive_bed_mesh.probe_lift_speed = 10
+
+        # 3x3 serpentine over 100x100mm: 8 moves of 50mm, and each point probes down 1s then lifts 0.5s
+        (num_horizontal_probes, num_vertical_probes), probe_points, _ = self.adaptive_bed_mesh.get_probe_points(
+            (0, 0), (100, 100))
+        self.assertTupleEqual((num_horizontal_probes, num_vertical_probes), (3, 3))
+
+        with self.subTest('single_sample'):
+            self.adaptive_bed_mesh.probe_samples = 1
+            self.assertAlmostEqual(self.adaptive_bed_mesh.estimate_probe_time(probe_points), 9 * 1.5 + 4)
+
+        with self.subTest('multiple_samples'):
+            # Each extra sample retracts 2mm at 10mm/s and probes 2mm at 5mm/s
+            self.adaptive_bed_mesh.probe_samples = 3
+            self.adaptive_bed_mesh.probe_sample_retract_dist = 2
+            self.assertAlmostEqual(self.adaptive_bed_mesh.estimate_probe_time(probe_points), 9 * 2.7 + 4)
+
+        with self.subTest('order'):
+            # Travel back and forth costs more than the serpentine
+            shuffled = [probe_points[i] for i in [0, 8, 1, 7, 2, 6, 3, 5, 4]]
+            self.assertGreater(self.adaptive_bed_mesh.estimate_probe_time(shuffled),
+                               self.adaptive_bed_mesh.estimate_probe_time(probe_points))
+
     def test_apply_probe_point_limits(self):
 
         with self.subTest('min_probe_counts'):